@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+# coding=utf-8
+' benchmark module '
+__author__ = 'Loadstar'
+import os
+import sys
+import io
+import gzip
+import json
+import base64
+import threading
+import time
+import random
+import zipfile
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, parse_qsl, urlencode
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 离线基准测试：本地启动 app-api 与 i.pximg.net 替身服务，驱动 PixivDownloader 各下载模式，
+# 输出 作品/秒、MB/秒、CPU时间与峰值内存，便于性能改动前后对比。
+#
+#   python benchmark.py                                    # 运行全部模式
+#   python benchmark.py --modes ranking search --latency 0.05 --bandwidth 5 --failure-rate 0.02
+#   python benchmark.py --json baseline.json               # 保存结果作为基线
+#   python benchmark.py --baseline baseline.json           # 与基线对比
+#   python benchmark.py --replay session.jsonl.gz --modes ranking --replay-speed 0
+#                                                          # 回放 download.py --record 录制的会话
+#   python benchmark.py --startup-only                     # 仅检查 download.py 启动耗时与延迟导入
+#
+# 替身服务与每个模式均运行在独立子进程中，CPU与峰值内存只统计下载器本身。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+JST = datetime.timezone(datetime.timedelta(hours=9))
+MODES = ('ranking', 'following', 'follow_new', 'search', 'bookmarks')
+PAGE_SIZE = 30
+EXCLUDED_TAG = 'benchmark_excluded'  # 用于触发屏蔽标签过滤
+HEAVY_MODULES = ('pixivpy3', 'requests', 'cloudscraper', 'PIL', 'dateutil')  # import download 时不应加载
+
+
+# === 合成数据 ===================================================
+def _encode(image, fmt, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+
+class SyntheticAssets:
+    """预先生成的噪声图片与动图ZIP（噪声图的压缩体积接近真实插画原图）"""
+    def __init__(self, image_px=800, ugoira_frames=8, seed=0):
+        from PIL import Image
+        rng = random.Random(seed)
+
+        def noise(size):
+            return Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+
+        self.jpeg = _encode(noise(image_px), 'JPEG', quality=90)
+        self.png = _encode(noise(image_px // 2), 'PNG')
+        self.frames = [{'file': f"{idx:06d}.jpg", 'delay': 80} for idx in range(ugoira_frames)]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zf:
+            for frame in self.frames:
+                zf.writestr(frame['file'], _encode(noise(max(image_px // 4, 64)), 'JPEG', quality=85))
+        self.ugoira_zip = buffer.getvalue()
+
+
+class SyntheticDataset:
+    """合成的作品列表：ID随时间递增，发布时间均匀分布在最近一年内"""
+    def __init__(self, base_url, works=120, artists=6, max_pages=3,
+                 ugoira_ratio=0.05, png_ratio=0.2, seed=0):
+        rng = random.Random(seed)
+        now = datetime.datetime.now(JST).replace(microsecond=0)
+        self.artists = [{'id': 1000 + idx, 'name': f"artist{idx}", 'account': f"artist{idx}"}
+                        for idx in range(max(artists, 1))]
+        self.illusts = []  # 新作品在前
+        for idx in range(works):
+            illust_id = 100000000 + works - idx
+            created = now - datetime.timedelta(days=idx * 365 / max(works, 1))
+            date_path = created.strftime("%Y/%m/%d/%H/%M/%S")
+            tags = [{'name': 'オリジナル', 'translated_name': 'original'}]
+            if rng.random() < 0.05:
+                tags.append({'name': EXCLUDED_TAG, 'translated_name': None})
+            illust_type = 'illust'
+            if rng.random() < ugoira_ratio:
+                illust_type = 'ugoira'
+            elif rng.random() < 0.05:
+                illust_type = 'manga'
+            page_count = 1 if illust_type == 'ugoira' else rng.randint(1, max(max_pages, 1))
+            ext = 'png' if rng.random() < png_ratio else 'jpg'
+            urls = [f"{base_url}/img-original/img/{date_path}/{illust_id}_p{page}.{ext}"
+                    for page in range(page_count)]
+            self.illusts.append({
+                'id': illust_id,
+                'title': f"benchmark {illust_id}",
+                'type': illust_type,
+                'user': self.artists[idx % len(self.artists)],
+                'tags': tags,
+                'create_date': created.isoformat(),
+                'page_count': page_count,
+                'meta_single_page': {'original_image_url': urls[0]} if page_count == 1 else {},
+                'meta_pages': [{'image_urls': {'original': url}} for url in urls] if page_count > 1 else [],
+                'total_bookmarks': rng.randint(0, 5000),
+                'illust_ai_type': 1,
+                'x_restrict': 0,
+            })
+        self.by_id = {illust['id']: illust for illust in self.illusts}
+
+
+# === 会话回放 ===================================================
+class ReplayArchive:
+    """download.py --record 录制的会话归档，按请求逐条匹配回放"""
+    IGNORED_PARAMS = frozenset({'rand'})  # 下载重试时附加的随机参数
+
+    def __init__(self, path):
+        self.session = {}
+        self.api_hosts = set()
+        self.count = 0
+        self._exact = {}    # (方法, 路径, 查询参数) -> 录制记录列表
+        self._by_path = {}  # (方法, 路径) -> 录制记录列表
+        self._bodies = {}   # 路径 -> 图片响应体
+        self._lock = threading.Lock()
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('type') == 'session':
+                    self.session = record
+                    continue
+                key = self.key(record['method'], record['url'])
+                self._exact.setdefault(key, []).append(record)
+                self._by_path.setdefault(key[:2], []).append(record)
+                if record['kind'] == 'api':
+                    parts = urlsplit(record['url'])
+                    self.api_hosts.add(f"{parts.scheme}://{parts.netloc}")
+                if 'body_b64' in record:
+                    self._bodies[key[1]] = base64.b64decode(record['body_b64'])
+                self.count += 1
+
+    @classmethod
+    def key(cls, method, url):
+        parts = urlsplit(url)
+        query = tuple(sorted((k, v) for k, v in parse_qsl(parts.query) if k not in cls.IGNORED_PARAMS))
+        return method, parts.path, query
+
+    def match(self, method, url):
+        """优先精确匹配；查询参数不同（如录制与回放日期不同）时按同一路径的录制顺序回放"""
+        key = self.key(method, url)
+        with self._lock:
+            for candidates in (self._exact.get(key), self._by_path.get(key[:2])):
+                if candidates:
+                    record = next((r for r in candidates if not r.get('used')), candidates[-1])
+                    record['used'] = True
+                    return record
+        return None
+
+    def body(self, path):
+        return self._bodies.get(path)
+
+
+# === 替身服务 ===================================================
+class FakePixivServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options):
+        super().__init__(('127.0.0.1', options.get('port', 0)), FakePixivHandler)
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.latency = options.get('latency', 0)
+        self.bandwidth = options.get('bandwidth', 0) * 1024 * 1024  # 单连接 字节/秒
+        self.failure_rate = options.get('failure_rate', 0)
+        self.rng = random.Random(options.get('seed', 0))
+        self.assets = SyntheticAssets(options.get('image_px', 800), seed=options.get('seed', 0))
+        self.dataset = SyntheticDataset(
+            self.base_url, works=options.get('works', 120), artists=options.get('artists', 6),
+            max_pages=options.get('max_pages', 3), ugoira_ratio=options.get('ugoira_ratio', 0.05),
+            seed=options.get('seed', 0))
+        self.replay = ReplayArchive(options['replay']) if options.get('replay') else None
+        self.replay_speed = options.get('replay_speed', 1.0)
+
+    def rewrite_hosts(self, text):
+        """将录制响应中的 app-api / i.pximg.net 地址改写为本地服务"""
+        for host in self.replay.api_hosts | {'https://i.pximg.net'}:
+            text = text.replace(host, self.base_url)
+        return text
+
+    def handle_error(self, request, client_address):
+        # 客户端提前断开（重试、超时）属于正常情况，不打印堆栈
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def page(self, path, items, params):
+        """按offset分页，与app-api一致返回next_url"""
+        offset = int(params.get('offset', 0))
+        chunk = items[offset:offset + PAGE_SIZE]
+        next_url = None
+        if offset + PAGE_SIZE < len(items):
+            next_url = f"{self.base_url}{path}?{urlencode(dict(params, offset=offset + PAGE_SIZE))}"
+        return {'illusts': chunk, 'next_url': next_url}
+
+    def bookmark_page(self, path, items, params):
+        """收藏接口以 max_bookmark_id 翻页"""
+        max_id = int(params.get('max_bookmark_id', 0))
+        start = next((idx for idx, i in enumerate(items) if i['id'] <= max_id), len(items)) if max_id else 0
+        chunk = items[start:start + PAGE_SIZE]
+        next_url = None
+        if start + PAGE_SIZE < len(items):
+            query = dict(params, max_bookmark_id=items[start + PAGE_SIZE]['id'])
+            next_url = f"{self.base_url}{path}?{urlencode(query)}"
+        return {'illusts': chunk, 'next_url': next_url}
+
+    def api_response(self, path, params):
+        illusts = self.dataset.illusts
+        if path in ('/v1/illust/ranking', '/v2/illust/follow'):
+            return self.page(path, illusts, params)
+        if path == '/v1/user/bookmarks/illust':
+            return self.bookmark_page(path, illusts, params)
+        if path == '/v1/user/illusts':
+            user_id = int(params.get('user_id', 0))
+            return self.page(path, [i for i in illusts if i['user']['id'] == user_id], params)
+        if path == '/v1/search/illust':
+            start, end = params.get('start_date'), params.get('end_date')
+            matched = [i for i in illusts
+                       if (not start or i['create_date'][:10] >= start)
+                       and (not end or i['create_date'][:10] <= end)]
+            return self.page(path, matched, params)
+        if path == '/v1/user/following':
+            previews = [{'user': artist,
+                         'illusts': [i for i in illusts if i['user']['id'] == artist['id']][:3]}
+                        for artist in self.dataset.artists]
+            offset = int(params.get('offset', 0))
+            next_url = None
+            if offset + PAGE_SIZE < len(previews):
+                next_url = f"{self.base_url}{path}?{urlencode(dict(params, offset=offset + PAGE_SIZE))}"
+            return {'user_previews': previews[offset:offset + PAGE_SIZE], 'next_url': next_url}
+        if path == '/v1/illust/detail':
+            illust = self.dataset.by_id.get(int(params.get('illust_id', 0)))
+            return {'illust': illust} if illust else None
+        if path == '/v1/ugoira/metadata':
+            illust_id = params.get('illust_id')
+            return {'ugoira_metadata': {
+                'zip_urls': {'medium': f"{self.base_url}/img-zip-ugoira/img/{illust_id}_ugoira600x600.zip"},
+                'frames': self.assets.frames}}
+        return None
+
+    def image_response(self, path):
+        name = path.rsplit('/', 1)[-1]
+        if path.startswith('/img-zip-ugoira/'):
+            return self.assets.ugoira_zip, 'application/zip'
+        if name.endswith('.png'):
+            return self.assets.png, 'image/png'
+        if name.endswith('.jpg'):
+            return self.assets.jpeg, 'image/jpeg'
+        return None, None
+
+
+class FakePixivHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 保持连接，与真实CDN行为一致
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch(send_body=True)
+
+    def do_HEAD(self):
+        self._dispatch(send_body=False)
+
+    def _dispatch(self, send_body):
+        server = self.server
+        if server.replay:
+            return self._dispatch_replay(send_body)
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path.startswith('/img-'):
+            # 失败率只作用于图片请求（API失败会直接终止翻页，无法衡量吞吐）
+            if server.rng.random() < server.failure_rate:
+                return self._send(503, b'Service Unavailable', 'text/plain', send_body)
+            body, content_type = server.image_response(url.path)
+            if body is None:
+                return self._send(404, b'Not Found', 'text/plain', send_body)
+            return self._send(200, body, content_type, send_body, throttle=True)
+
+        payload = server.api_response(url.path, params)
+        if payload is None:
+            payload = {'error': {'message': f"Not found: {url.path}", 'user_message': ''}}
+            return self._send(404, json.dumps(payload).encode('utf-8'), 'application/json', send_body)
+        return self._send(200, json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                          'application/json', send_body)
+
+    def _dispatch_replay(self, send_body):
+        server = self.server
+        path = urlsplit(self.path).path
+        record = server.replay.match(self.command, self.path)
+        if record and server.replay_speed:
+            time.sleep(record['elapsed'] / server.replay_speed)  # 原始或按倍率压缩的响应耗时
+
+        is_image = path.startswith('/img-') or (record and record['kind'] == 'image')
+        if record is None and not is_image:
+            payload = {'error': {'message': f"No recorded response: {self.path}", 'user_message': ''}}
+            return self._send(404, json.dumps(payload).encode('utf-8'), 'application/json', send_body)
+        if is_image:
+            status = record['status'] if record else 200
+            content_type = (record or {}).get('headers', {}).get('Content-Type')
+            body = b''
+            if status == 200:
+                body = server.replay.body(path)
+                if body is None:  # 未录制响应体时使用合成图片
+                    body, synthetic_type = server.image_response(path)
+                    content_type = synthetic_type
+                    if body is None:
+                        status, body = 404, b'Not Found'
+            return self._send(status, body, content_type or 'application/octet-stream',
+                              send_body, throttle=True)
+
+        body = server.rewrite_hosts(record.get('body', '')).encode('utf-8')
+        content_type = record['headers'].get('Content-Type', 'application/json')
+        return self._send(record['status'], body, content_type, send_body)
+
+    def _send(self, status, body, content_type, send_body, throttle=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        bandwidth = self.server.bandwidth if throttle else 0
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        # 按带宽上限分块发送
+        start = time.monotonic()
+        view = memoryview(body)
+        for offset in range(0, len(body), 64 * 1024):
+            self.wfile.write(view[offset:offset + 64 * 1024])
+            ahead = (offset + 64 * 1024) / bandwidth - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def serve(options):
+    """替身服务进程入口：首行输出服务地址，随后持续服务直至被终止"""
+    server = FakePixivServer(options)
+    info = {'base_url': server.base_url}
+    if server.replay:
+        info['session'] = dict(server.replay.session, requests=server.replay.count)
+    print(json.dumps(info, ensure_ascii=False), flush=True)
+    server.serve_forever()
+
+
+# === 单个模式的测量 ==============================================
+def peak_rss_mb():
+    """当前进程峰值常驻内存（MB），无法获取时返回None"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) / 1024 / 1024
+
+
+MODE_RUNNERS = {
+    'ranking': lambda d: d.download_ranking('day', '一般向', 'benchmark', 8),
+    'following': lambda d: d.sync_following(d.get_all_following_users()),
+    'follow_new': lambda d: d.download_following_new(),
+    'search': lambda d: d.download_search('benchmark', exclude_ai=True, num_choice=False),
+    'bookmarks': lambda d: d.download_bookmarks(),
+}
+
+
+def run_mode(mode, base_url, options):
+    """在当前进程内对单个模式计时（由编排进程以子进程方式调用）"""
+    sys.path.insert(0, BASE_DIR)
+    import download
+    download.console.configure(quiet=not options.get('verbose'))
+
+    root_dir = tempfile.mkdtemp(prefix=f"pixiv_bench_{mode}_")
+    downloader = None
+    try:
+        works = options.get('works', 120)
+        downloader = download.PixivDownloader(
+            refresh_token='benchmark',
+            user_id='1',
+            root_dir=root_dir,
+            access_token='benchmark',
+            api_host=base_url,
+            pximg_host=base_url,
+            exclude_manga=True,
+            exclude_tags=[EXCLUDED_TAG],
+            ranking_max=works,
+            follow_max=works,
+            request_interval=0,
+            api_min_interval=options.get('api_min_interval', 0),
+            api_cache=False,
+            download_workers=options.get('download_workers', download.DOWNLOAD_WORKERS),
+            artist_workers=options.get('artist_workers', download.ARTIST_WORKERS),
+            search_workers=options.get('search_workers', download.SEARCH_WORKERS),
+            output_format=options.get('output_format', 'original'),
+            quality=90
+        )
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        stats = MODE_RUNNERS[mode](downloader) or {}
+        downloader.durability.close()  # 落盘计入耗时，且须在删除临时目录前完成
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+
+        metrics = downloader.metrics
+        downloaded = sum(value for (name, _), value in metrics.counters.items()
+                         if name == 'downloaded_bytes')
+        api_requests = metrics.timings.get('api_request', {}).get('count', 0)
+        return {
+            'mode': mode,
+            'works': stats.get('success', 0),
+            'failed': stats.get('failed', 0),
+            'seconds': elapsed,
+            'works_per_sec': stats.get('success', 0) / elapsed if elapsed else 0,
+            'mb': downloaded / 1024 / 1024,
+            'mb_per_sec': downloaded / 1024 / 1024 / elapsed if elapsed else 0,
+            'cpu_seconds': cpu,
+            'cpu_percent': cpu / elapsed * 100 if elapsed else 0,
+            'peak_rss_mb': peak_rss_mb(),
+            'api_requests': api_requests,
+        }
+    finally:
+        if downloader is not None:
+            downloader.durability.close()
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+
+# === 启动耗时 ===================================================
+def measure_startup(repeat=5):
+    """download.py 的导入耗时与 --help 进程耗时（各取最小值），以及导入时被提前加载的重型模块"""
+    probe = ("import sys, time, json\n"
+             "start = time.perf_counter()\n"
+             "import download\n"
+             "print(json.dumps({'seconds': time.perf_counter() - start,\n"
+             "                  'heavy': [m for m in %r if m in sys.modules]}))" % (HEAVY_MODULES,))
+    imports, helps, heavy = [], [], set()
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', probe], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True)
+        data = json.loads(proc.stdout.strip().splitlines()[-1])
+        imports.append(data['seconds'])
+        heavy.update(data['heavy'])
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(BASE_DIR, 'download.py'), '--help'],
+                       cwd=BASE_DIR, stdout=subprocess.DEVNULL, check=True)
+        helps.append(time.perf_counter() - start)
+    return {'import_seconds': min(imports), 'help_seconds': min(helps), 'heavy_modules': sorted(heavy)}
+
+
+def check_startup(startup, budget_ms, baseline=None):
+    """打印启动耗时并判断是否回退：加载了重型模块、超出预算或比基线慢20%以上"""
+    print(f"\n启动耗时: import download {startup['import_seconds'] * 1000:.0f}ms，"
+          f"download.py --help {startup['help_seconds'] * 1000:.0f}ms")
+    ok = True
+    if startup['heavy_modules']:
+        print(f"回退: import download 时加载了 {', '.join(startup['heavy_modules'])}")
+        ok = False
+    if startup['import_seconds'] * 1000 > budget_ms:
+        print(f"回退: 导入耗时超出预算 {budget_ms}ms")
+        ok = False
+    if baseline:
+        delta = (startup['import_seconds'] - baseline['import_seconds']) / baseline['import_seconds'] * 100
+        print(f"对比基线: 导入耗时 {delta:+.1f}%")
+        if delta > 20:
+            print("回退: 导入耗时比基线慢20%以上")
+            ok = False
+    return ok
+
+
+# === 编排与报告 =================================================
+def start_server(options):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', json.dumps(options)],
+        stdout=subprocess.PIPE, text=True, cwd=BASE_DIR)
+    line = proc.stdout.readline()
+    if not line:
+        proc.wait()
+        raise RuntimeError("替身服务启动失败")
+    return proc, json.loads(line)
+
+
+def measure(mode, base_url, options):
+    with tempfile.TemporaryDirectory() as tmp:
+        result_file = os.path.join(tmp, 'result.json')
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-mode', mode,
+             '--base-url', base_url, '--result-file', result_file, '--options', json.dumps(options)],
+            cwd=BASE_DIR, stdout=None if options.get('verbose') else subprocess.DEVNULL)
+        if proc.returncode != 0 or not os.path.exists(result_file):
+            return {'mode': mode, 'error': f"退出码 {proc.returncode}"}
+        with open(result_file, encoding='utf-8') as f:
+            return json.load(f)
+
+
+def print_report(results, baseline=None):
+    baseline = {r['mode']: r for r in (baseline or []) if 'error' not in r}
+    print(f"\n{'模式':<12}{'作品':>6}{'失败':>6}{'耗时s':>9}{'作品/s':>9}{'MB':>9}{'MB/s':>8}"
+          f"{'CPU s':>8}{'CPU%':>7}{'峰值MB':>9}{'API':>6}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['mode']:<12}运行失败: {r['error']}")
+            continue
+        rss = f"{r['peak_rss_mb']:.0f}" if r['peak_rss_mb'] is not None else '-'
+        print(f"{r['mode']:<12}{r['works']:>6}{r['failed']:>6}{r['seconds']:>9.2f}"
+              f"{r['works_per_sec']:>9.2f}{r['mb']:>9.1f}{r['mb_per_sec']:>8.2f}"
+              f"{r['cpu_seconds']:>8.2f}{r['cpu_percent']:>7.0f}{rss:>9}{r['api_requests']:>6}")
+        base = baseline.get(r['mode'])
+        if base:
+            def delta(key):
+                return (r[key] - base[key]) / base[key] * 100 if base[key] else 0
+            print(f"{'':<12}对比基线: 作品/s {delta('works_per_sec'):+.1f}%  "
+                  f"MB/s {delta('mb_per_sec'):+.1f}%  CPU {delta('cpu_seconds'):+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pixiv下载器离线基准测试")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help='要测试的下载模式')
+    parser.add_argument('--works', type=int, default=120, help='合成作品数')
+    parser.add_argument('--artists', type=int, default=6, help='合成画师数（关注列表）')
+    parser.add_argument('--max-pages', type=int, default=3, help='单个作品最大页数')
+    parser.add_argument('--ugoira-ratio', type=float, default=0.05, help='动图作品比例')
+    parser.add_argument('--image-px', type=int, default=800, help='合成JPEG边长（像素）')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的附加延迟（秒）')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='单连接带宽上限 MB/s（0为不限）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='图片请求返回503的比例')
+    parser.add_argument('--api-min-interval', type=float, default=0.0, help='API请求最小间隔（秒）')
+    parser.add_argument('--download-workers', type=int, help='同时进行的图片下载数')
+    parser.add_argument('--artist-workers', type=int, help='同时同步的画师数')
+    parser.add_argument('--search-workers', type=int, help='搜索并发时间窗口数')
+    parser.add_argument('--output-format', default='original', help='输出格式（original/jpg/webp/png）')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--replay', help='回放 download.py --record 录制的会话归档（替代合成数据）')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='回放速度倍率：1为原始响应耗时，N为压缩N倍，0为不等待')
+    parser.add_argument('--json', help='将结果保存为JSON文件')
+    parser.add_argument('--baseline', help='与此前保存的JSON结果对比')
+    parser.add_argument('--verbose', action='store_true', help='显示下载器明细输出')
+    parser.add_argument('--startup-only', action='store_true', help='只检查启动耗时（不启动替身服务）')
+    parser.add_argument('--startup-budget', type=float, default=300,
+                        help='import download 的耗时预算（毫秒），超出时以退出码1结束')
+    # 内部使用：子进程入口
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--run-mode', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(json.loads(args.serve))
+        return
+    if args.run_mode:
+        result = run_mode(args.run_mode, args.base_url, json.loads(args.options or '{}'))
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    startup = measure_startup()
+    startup_ok = check_startup(startup, args.startup_budget, baseline.get('startup'))
+    if args.startup_only:
+        sys.exit(0 if startup_ok else 1)
+
+    options = {k: v for k, v in vars(args).items()
+               if v is not None and k not in ('modes', 'json', 'baseline', 'serve', 'run_mode',
+                                              'base_url', 'result_file', 'options',
+                                              'startup_only', 'startup_budget')}
+    if args.replay:
+        options['replay'] = os.path.abspath(args.replay)  # 服务进程的工作目录不同
+    server, info = start_server(options)
+    base_url = info['base_url']
+    session = info.get('session')
+    if session:
+        print(f"回放会话: 录制于 {session.get('started')}，命令 {' '.join(session.get('command') or []) or '交互模式'}，"
+              f"{session['requests']} 个请求，速度倍率 {args.replay_speed}")
+    else:
+        print(f"替身服务已启动: {base_url}（{args.works} 个作品，延迟 {args.latency}s，"
+              f"带宽 {args.bandwidth or '不限'} MB/s，失败率 {args.failure_rate:.0%}）")
+    results = []
+    try:
+        for mode in args.modes:
+            print(f"\n▶ 测试模式: {mode}", flush=True)
+            results.append(measure(mode, base_url, options))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_report(results, baseline.get('results'))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'options': options, 'startup': startup, 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.json}")
+    if not startup_ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 # coding=utf-8
 ' download module '
 __author__ = 'Loadstar'
-from pixivpy3 import AppPixivAPI
+import atexit
 import os
 import sys
 import io
@@ -12,24 +12,24 @@ import json
 import re
 import hashlib
 import random
-import zipfile
+import gzip
+import zlib
+import threading
+import contextvars
 import shutil
 import sqlite3
 import argparse
-from dateutil import parser
-from PIL import Image
+import base64
+from urllib.parse import urlencode, urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from contextlib import contextmanager
+# pixivpy3（requests/cloudscraper）、Pillow、dateutil、zipfile 在首次使用处导入，
+# 帮助信息、参数错误与缓存/进度查询无需加载网络和图像库
 
-sys.stdout = io.TextIOWrapper(
-    open(sys.stdout.fileno(), 'wb', 0),
-    encoding='utf-8',
-    write_through=True,
-)
-sys.stderr = io.TextIOWrapper(
-    open(sys.stderr.fileno(), 'wb', 0),
-    encoding='utf-8',
-    write_through=True
-)
+# 行缓冲输出：整行交给终端或管道读取方（manager.py），避免逐字节无缓冲写入
+for _stream in (sys.stdout, sys.stderr):
+    if _stream is not None:
+        _stream.reconfigure(encoding='utf-8', line_buffering=True)
 
 if not os.path.exists("config.py"):
     print("错误: 未找到 config.py 配置文件。\n请先运行 set_config 进行初始化配置。")
@@ -37,47 +37,548 @@ if not os.path.exists("config.py"):
     sys.exit(1)
 
 # 优先处理路径配置
-if getattr(sys, 'frozen', False):
-    # 打包环境：获取exe所在目录
+IS_FROZEN = getattr(sys, 'frozen', False)
+if IS_FROZEN:
+    # 打包环境：获取exe所在目录，config需从该目录导入
     base_path = os.path.dirname(sys.executable) 
-    # 导入config需要特殊处理
     sys.path.insert(0, base_path)  # 添加exe目录到模块搜索路径
-    from config import DOWNLOAD_DIR as original_download_dir
+import config as user_config
+
+download_dir = user_config.DOWNLOAD_DIR
+if IS_FROZEN and not os.path.isabs(download_dir):
     # 将相对路径转换为绝对路径
-    if os.path.isabs(original_download_dir):
-        download_dir = original_download_dir
-    else:
-        download_dir = os.path.join(base_path, original_download_dir)
-else:
-    # 开发环境：直接从config导入
-    from config import DOWNLOAD_DIR as download_dir
-
-# 确保下载目录存在（无论是否打包）
-os.makedirs(download_dir, exist_ok=True)
-
-from config import (
-    REFRESH_TOKEN,
-    USER_ID,
-    PROXY,
-    DEBUG_API_RESPONSE,
-    EXCLUDE_MANGA,
-    EXCLUDE_TAGS,
-    RANKING_MAX_ITEMS,
-    FOLLOW_MAX_ITEMS,
-    REQUEST_INTERVAL,
-    OUTPUT_FORMAT,
-    QUALITY
-)
+    download_dir = os.path.join(base_path, download_dir)
+# 下载目录在创建数据库或下载器时才建立，帮助信息与参数错误不产生副作用
+
+REFRESH_TOKEN = user_config.REFRESH_TOKEN
+USER_ID = user_config.USER_ID
+PROXY = user_config.PROXY
+DEBUG_API_RESPONSE = user_config.DEBUG_API_RESPONSE
+EXCLUDE_MANGA = user_config.EXCLUDE_MANGA
+EXCLUDE_TAGS = user_config.EXCLUDE_TAGS
+RANKING_MAX_ITEMS = user_config.RANKING_MAX_ITEMS
+FOLLOW_MAX_ITEMS = user_config.FOLLOW_MAX_ITEMS
+REQUEST_INTERVAL = user_config.REQUEST_INTERVAL
+OUTPUT_FORMAT = user_config.OUTPUT_FORMAT
+QUALITY = user_config.QUALITY
+
+# 可选高级配置（旧版config.py中可能没有，缺失时使用默认值）
+API_CACHE_ENABLED = getattr(user_config, 'API_CACHE_ENABLED', True)
+API_CACHE_MAX_MB = getattr(user_config, 'API_CACHE_MAX_MB', 200)
+API_CACHE_TTL = getattr(user_config, 'API_CACHE_TTL', {}) or {}
+FOLLOW_INCREMENTAL = getattr(user_config, 'FOLLOW_INCREMENTAL', True)
+FOLLOW_FULL_SYNC_DAYS = getattr(user_config, 'FOLLOW_FULL_SYNC_DAYS', 30)
+ARTIST_WORKERS = getattr(user_config, 'ARTIST_WORKERS', 4)
+DOWNLOAD_WORKERS = getattr(user_config, 'DOWNLOAD_WORKERS', 8)
+API_MIN_INTERVAL = getattr(user_config, 'API_MIN_INTERVAL', 1.0)
+SEARCH_WORKERS = getattr(user_config, 'SEARCH_WORKERS', 3)
+TASK_WORKERS = getattr(user_config, 'TASK_WORKERS', 0)
+PROGRESS_REFRESH_HZ = getattr(user_config, 'PROGRESS_REFRESH_HZ', 4)
+METRICS_FILE = getattr(user_config, 'METRICS_FILE', '')
+HTTP_POOL_SIZE = getattr(user_config, 'HTTP_POOL_SIZE', {}) or {}
+HTTP_RETRIES = getattr(user_config, 'HTTP_RETRIES', 3)
+HTTP_BACKOFF = getattr(user_config, 'HTTP_BACKOFF', 1.0)
+BANDWIDTH_LIMIT_KBPS = getattr(user_config, 'BANDWIDTH_LIMIT_KBPS', 0)
+BANDWIDTH_SCHEDULE = getattr(user_config, 'BANDWIDTH_SCHEDULE', []) or []
+HOST_CONNECTION_LIMITS = getattr(user_config, 'HOST_CONNECTION_LIMITS', {}) or {}
+DURABILITY = str(getattr(user_config, 'DURABILITY', 'batch')).lower()
+DURABILITY_BATCH_FILES = getattr(user_config, 'DURABILITY_BATCH_FILES', 50)
+DURABILITY_BATCH_SECONDS = getattr(user_config, 'DURABILITY_BATCH_SECONDS', 10)
+SHARDED_LAYOUT = getattr(user_config, 'SHARDED_LAYOUT', False)
+SHARD_SIZE = getattr(user_config, 'SHARD_SIZE', 10000)
+CONVERT_QUEUE = getattr(user_config, 'CONVERT_QUEUE', False)
+CONVERT_WORKERS = getattr(user_config, 'CONVERT_WORKERS', 0)
+SEARCH_EARLIEST_DATE = datetime.date(2007, 9, 10)  # Pixiv最早作品日期
+MANGA_TAGS = frozenset({'漫画', 'manga'})
+SEARCH_OFFSET_LIMIT = 5000       # 搜索接口可翻页的最大偏移
+SEARCH_WINDOW_DAYS = (1, 365)    # 自适应时间窗口的最小/最大天数
+SEARCH_SPARSE_RESULTS = 30       # 窗口结果少于一页时视为稀疏，放大下一个窗口
+PROGRESS_PIPE_INTERVAL = 5       # 输出被管道读取时进度行的最小间隔(秒)
+STREAM_BUFFER_SIZE = 256 * 1024  # 流式下载的读缓冲（每个下载线程复用一块）
+CONVERT_MAX_ATTEMPTS = 3         # 转换任务失败后的最大尝试次数
+OUTPUT_FORMATS = {               # 格式名 -> (Pillow格式, 扩展名, 色彩模式)
+    'jpg': ('JPEG', '.jpg', 'RGB'),
+    'webp': ('WEBP', '.webp', 'RGB'),
+    'png': ('PNG', '.png', 'RGBA'),
+}
+FORMAT_ALIASES = {'g': 'jpg', 'j': 'jpg', 'w': 'webp', 'p': 'png'}
+
+
+class JsonLogStream(io.TextIOBase):
+    """--json-log 模式下替换 sys.stdout：把普通 print 输出逐行包装为JSON记录"""
+    def __init__(self, stream):
+        self.stream = stream
+        self._pending = ''
+        self._lock = threading.RLock()
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def write(self, text):
+        with self._lock:
+            self._pending += text
+            *lines, self._pending = self._pending.split('\n')
+            for line in lines:
+                line = line.rsplit('\r', 1)[-1].strip()  # 丢弃被回车覆盖的内容
+                if line:
+                    self.write_record({'event': 'log', 'message': line})
+        return len(text)
+
+    def write_record(self, record):
+        record = {'ts': datetime.datetime.now().isoformat(timespec='seconds'), **record}
+        task = console.task_label()
+        if task:
+            record.setdefault('task', task)
+        with self._lock:
+            self.stream.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def flush(self):
+        self.stream.flush()
+
+
+class TaskPrefixStream(io.TextIOBase):
+    """批量并发执行任务时替换 sys.stdout：每行加上所属任务的前缀，各任务的半行输出互不混杂"""
+    def __init__(self, stream):
+        self.stream = stream
+        self._pending = {}  # 线程 -> 尚未换行的输出
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def write(self, text):
+        label = console.task_label()
+        if label is None or text.startswith('\r'):
+            # 任务之外的输出与原地刷新的进度行原样写出
+            self.stream.write(text)
+            return len(text)
+        key = threading.get_ident()
+        with self._lock:
+            *lines, rest = (self._pending.pop(key, '') + text).split('\n')
+            if rest:
+                self._pending[key] = rest
+            if lines:
+                self.stream.write(''.join(f"[{label}] {line}\n" if line else '\n' for line in lines))
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class ConsoleOutput:
+    """控制台输出：普通模式逐条打印；quiet 只保留汇总与错误；json 每行一个JSON对象"""
+    def __init__(self):
+        self.quiet = False
+        self.json_log = None  # JsonLogStream，仅 --json-log 时启用
+        self.progress = ProgressRenderer(self)
+        self._task = contextvars.ContextVar('console_task', default=None)
+
+    def configure(self, quiet=False, json_log=False):
+        self.quiet = quiet
+        if json_log and self.json_log is None:
+            self.json_log = JsonLogStream(sys.stdout)
+            sys.stdout = self.json_log
+
+    def prefix_tasks(self):
+        """并发执行多个任务时按任务区分输出（JSON日志改为附加task字段）"""
+        if self.json_log is None and not isinstance(sys.stdout, TaskPrefixStream):
+            sys.stdout = TaskPrefixStream(sys.stdout)
+
+    @contextmanager
+    def task(self, label):
+        """当前线程内的输出归属于指定任务"""
+        token = self._task.set(label)
+        try:
+            yield
+        finally:
+            self._task.reset(token)
+
+    def task_label(self):
+        return self._task.get()
+
+    def detail(self, message, **fields):
+        """逐作品、逐文件的明细信息（quiet 模式下不输出）"""
+        if not self.quiet:
+            self.event('detail', message, **fields)
+
+    def event(self, event, message, **fields):
+        if self.json_log:
+            self.json_log.write_record({'event': event, 'message': message, **fields})
+        else:
+            self.progress.clear_line()
+            print(message)
+
+
+class ProgressRenderer:
+    """节流的下载进度显示：汇总所有并发传输，每秒最多刷新 PROGRESS_REFRESH_HZ 次"""
+    def __init__(self, output):
+        self.output = output
+        self._lock = threading.Lock()
+        self._transfers = {}  # 传输编号 -> [已下载字节, 预期字节]
+        self._next_id = 0
+        self._interval = 0
+        self._last_render = 0.0
+        self._window_bytes = 0
+        self._line_width = 0
+
+    def _refresh_interval(self):
+        # 终端中原地刷新；输出被管道读取（如manager.py）或为JSON日志时降低频率并逐行输出
+        if not self.output.json_log and sys.stdout is not None and sys.stdout.isatty():
+            return 1 / max(PROGRESS_REFRESH_HZ, 0.1)
+        return PROGRESS_PIPE_INTERVAL
+
+    def start(self, total=0):
+        with self._lock:
+            if not self._transfers:
+                self._interval = self._refresh_interval()
+                self._last_render = time.monotonic()
+                self._window_bytes = 0
+            self._next_id += 1
+            self._transfers[self._next_id] = [0, total]
+            return self._next_id
+
+    def update(self, token, nbytes):
+        now = time.monotonic()
+        with self._lock:
+            transfer = self._transfers.get(token)
+            if transfer:
+                transfer[0] += nbytes
+            self._window_bytes += nbytes
+            if self.output.quiet or now - self._last_render < self._interval:
+                return
+            speed = self._window_bytes / (now - self._last_render)
+            self._last_render = now
+            self._window_bytes = 0
+            self._render(speed)
+
+    def finish(self, token):
+        with self._lock:
+            self._transfers.pop(token, None)
+            idle = not self._transfers
+        if idle:
+            self.clear_line()
+
+    def clear_line(self):
+        """清除终端中原地刷新的进度行，避免与后续输出混在同一行"""
+        with self._lock:
+            if self._line_width:
+                sys.stdout.write('\r' + ' ' * self._line_width + '\r')
+                sys.stdout.flush()
+                self._line_width = 0
+
+    def _render(self, speed):
+        done = sum(t[0] for t in self._transfers.values())
+        total = sum(t[1] for t in self._transfers.values())
+        if self.output.json_log:
+            self.output.json_log.write_record({
+                'event': 'progress', 'active': len(self._transfers),
+                'bytes': done, 'total': total, 'speed': int(speed)})
+            return
+        size_info = format_size(done) + (f"/{format_size(total)}" if total else "")
+        line = f"下载中 {len(self._transfers)} 个文件: {size_info} | {format_size(speed)}/s"
+        if self._interval >= PROGRESS_PIPE_INTERVAL:
+            sys.stdout.write(line + '\n')
+        else:
+            sys.stdout.write('\r' + line.ljust(self._line_width))
+            sys.stdout.flush()
+            self._line_width = max(self._line_width, len(line))
+
+
+def format_size(size):
+    """自动选择显示单位"""
+    if size > 1024 * 1024:
+        return f"{size/1024/1024:.2f}MB"
+    return f"{size/1024:.1f}KB"
+
+
+console = ConsoleOutput()
+
+
+class Metrics:
+    """运行指标（线程安全）：分阶段耗时直方图与计数器（传输字节、缓存命中、重试等）"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    STAGE_NAMES = {
+        'api_request': 'API请求',
+        'rate_limit_wait': '限速等待',
+        'request_interval': '作品间隔等待',
+        'download': '文件下载',
+        'validation': '文件校验',
+        'conversion': '格式转换',
+        'gif': 'GIF生成',
+        'retry_wait': '重试等待',
+        'bandwidth_wait': '带宽限速等待',
+        'fsync': '落盘同步',
+        'db': '数据库',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.timings = {}   # 阶段 -> {'count', 'sum', 'max', 'buckets'}
+        self.counters = {}  # (名称, 标签元组) -> 数值
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                timing = self.timings[stage] = {
+                    'count': 0, 'sum': 0.0, 'max': 0.0,
+                    'buckets': [0] * (len(self.BUCKETS) + 1)}
+            timing['count'] += 1
+            timing['sum'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            idx = next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound), len(self.BUCKETS))
+            timing['buckets'][idx] += 1
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def _quantile(self, timing, q):
+        """按直方图估算分位数（返回所在桶的上界）"""
+        target = q * timing['count']
+        seen = 0
+        for bound, count in zip(self.BUCKETS, timing['buckets']):
+            seen += count
+            if seen >= target:
+                return bound
+        return timing['max']
+
+    def set(self, name, value, **labels):
+        """直接设置计数值（用于在外部累计的计数，如连接池统计）"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = value
+
+    def summary_lines(self):
+        with self._lock:
+            lines = [f"运行指标汇总（运行 {time.time() - self.started:.1f} 秒）:"]
+            for stage, timing in sorted(self.timings.items(), key=lambda item: -item[1]['sum']):
+                lines.append(
+                    f"- {self.STAGE_NAMES.get(stage, stage)}: {timing['count']} 次, "
+                    f"合计 {timing['sum']:.1f}s, 平均 {timing['sum'] / timing['count'] * 1000:.0f}ms, "
+                    f"p95≤{self._quantile(timing, 0.95)}s, 最大 {timing['max']:.2f}s")
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ",".join(f"{k}={v}" for k, v in labels)
+                shown = format_size(value) if name.endswith('bytes') else value
+                lines.append(f"- {name}{f'[{label_text}]' if label_text else ''}: {shown}")
+            return lines
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'duration': time.time() - self.started,
+                'timings': {stage: dict(timing, buckets=dict(zip(
+                                [str(b) for b in self.BUCKETS] + ['+Inf'], timing['buckets'])))
+                            for stage, timing in self.timings.items()},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self.counters.items()],
+            }
+
+    def to_prometheus(self):
+        """Prometheus textfile 格式（供 node_exporter textfile collector 采集）"""
+        data = self.to_dict()
+        lines = ['# TYPE pixiv_stage_seconds histogram']
+        for stage, timing in data['timings'].items():
+            cumulative = 0
+            for bound, count in timing['buckets'].items():
+                cumulative += count
+                lines.append(f'pixiv_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'pixiv_stage_seconds_sum{{stage="{stage}"}} {timing["sum"]:.6f}')
+            lines.append(f'pixiv_stage_seconds_count{{stage="{stage}"}} {timing["count"]}')
+        names = sorted({c['name'] for c in data['counters']})
+        for name in names:
+            lines.append(f'# TYPE pixiv_{name}_total counter')
+            for counter in data['counters']:
+                if counter['name'] == name:
+                    labels = ",".join(f'{k}="{v}"' for k, v in sorted(counter['labels'].items()))
+                    lines.append(f'pixiv_{name}_total{f"{{{labels}}}" if labels else ""} {counter["value"]}')
+        lines.append('# TYPE pixiv_run_duration_seconds gauge')
+        lines.append(f'pixiv_run_duration_seconds {data["duration"]:.3f}')
+        lines.append('# TYPE pixiv_run_finished_timestamp_seconds gauge')
+        lines.append(f'pixiv_run_finished_timestamp_seconds {time.time():.0f}')
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        """写入指标文件：.prom 为Prometheus文本格式，其余为JSON（先写临时文件再替换）"""
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+class Durability:
+    """文件与数据库的落盘策略
+
+    none:   只做原子替换，不主动fsync，崩溃后最近写入的文件可能为空或丢失
+    batch:  每 batch_files 个文件或 batch_seconds 秒统一fsync文件、所在目录并检查点WAL
+    strict: 每个文件替换前fsync内容、替换后fsync目录，数据库每次提交都落盘
+    """
+    MODES = ('none', 'batch', 'strict')
+    SQLITE_SYNCHRONOUS = {'none': 'OFF', 'batch': 'NORMAL', 'strict': 'FULL'}
+
+    def __init__(self, mode='batch', batch_files=50, batch_seconds=10, metrics=None):
+        if mode not in self.MODES:
+            print(f"无效的落盘模式: {mode}，使用batch")
+            mode = 'batch'
+        self.mode = mode
+        self.batch_files = max(1, int(batch_files))
+        self.batch_seconds = float(batch_seconds)
+        self.metrics = metrics or Metrics()
+        self.sqlite_synchronous = self.SQLITE_SYNCHRONOUS[mode]
+        self._lock = threading.Lock()
+        self._pending = set()      # 已替换但尚未fsync的文件
+        self._removals = []        # 待下一批落盘后再删除的文件（如转换前的原图）
+        self._hooks = []           # 每批落盘时附带执行的回调（数据库检查点）
+        self._last_flush = time.monotonic()
+        self._timer = None         # 空闲时保证 batch_seconds 内落盘的定时器
+        if mode == 'batch':
+            atexit.register(self.flush)
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def commit(self, temp_path, path):
+        """原子替换临时文件为正式文件，并按模式安排落盘"""
+        if self.mode == 'strict':
+            with self.metrics.timer('fsync'):
+                _fsync_path(temp_path)
+                os.replace(temp_path, path)
+                _fsync_path(os.path.dirname(path) or '.', directory=True)
+            return
+        os.replace(temp_path, path)
+        if self.mode == 'batch':
+            with self._lock:
+                self._pending.add(path)
+                due = (len(self._pending) >= self.batch_files
+                       or time.monotonic() - self._last_flush >= self.batch_seconds)
+                if not due:
+                    self._arm_timer()
+            if due:
+                self.flush()
+
+    def remove(self, path):
+        """删除已被新文件取代的文件；batch模式下等取代它的文件落盘后再删"""
+        if self.mode != 'batch':
+            os.remove(path)
+            return
+        with self._lock:
+            self._removals.append(path)
+            self._arm_timer()
+
+    def _arm_timer(self):
+        """有待落盘内容时启动定时器（调用方持有锁），进程空闲下来也会按时落盘"""
+        if self._timer is None:
+            self._timer = threading.Timer(self.batch_seconds, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def close(self):
+        """落盘剩余批次并停止定时落盘（目录即将被删除或进程即将退出时调用）"""
+        self.flush()
+        if self.mode == 'batch':
+            atexit.unregister(self.flush)
+
+    def flush(self):
+        """落盘当前批次：文件内容 → 所在目录 → 数据库WAL，随后删除被取代的文件"""
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            removals, self._removals = self._removals, []
+            self._last_flush = time.monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending and not removals:
+            return
+        with self.metrics.timer('fsync'):
+            for path in pending:
+                _fsync_path(path)
+            for directory in {os.path.dirname(path) or '.' for path in pending}:
+                _fsync_path(directory, directory=True)
+            for hook in self._hooks:
+                try:
+                    hook()
+                except sqlite3.Error as e:
+                    print(f"数据库检查点失败: {str(e)}")
+        for path in removals:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"删除原文件失败: {str(e)}", end="\n", flush=True)
+
+def _fsync_path(path, directory=False):
+    """fsync单个文件或目录（Windows不支持目录fsync，直接跳过）"""
+    if directory and os.name == 'nt':
+        return
+    flags = os.O_RDONLY if os.name != 'nt' else os.O_RDWR | getattr(os, 'O_BINARY', 0)
+    try:
+        fd = os.open(path, flags)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def shard_name(illust_id, shard_size):
+    """分片子目录名：作品ID按 shard_size 分段"""
+    return str(int(illust_id) // shard_size)
+
+def _is_dir_empty(path):
+    """判断目录是否为空（scandir取到第一项即返回，不列出整个目录）"""
+    with os.scandir(path) as entries:
+        return next(entries, None) is None
+
+def _remove_empty_shards(base_dir):
+    """删除分片布局下已空的分片子目录"""
+    with os.scandir(base_dir) as entries:
+        shards = [entry.path for entry in entries if entry.is_dir() and entry.name.isdigit()]
+    for path in shards:
+        if _is_dir_empty(path):
+            os.rmdir(path)
+
+def meta_version(illust):
+    """作品元数据的版本标识（有更新日期时用更新日期，否则用发布日期）"""
+    return str(illust.get('update_date') or illust.get('create_date') or '')
 
 class DBCache:
-    def __init__(self, root_dir=download_dir, db_name='pixiv_cache.db'):
+    def __init__(self, root_dir=download_dir, db_name='pixiv_cache.db', metrics=None, durability=None):
+        os.makedirs(root_dir, exist_ok=True)
         self.db_path = os.path.join(root_dir, db_name)
+        self.metrics = metrics or Metrics()
+        self.durability = durability or Durability(DURABILITY, DURABILITY_BATCH_FILES,
+                                                   DURABILITY_BATCH_SECONDS, self.metrics)
+        self.durability.add_hook(self.checkpoint)
         self._init_db()
 
     @contextmanager
     def _get_connection(self):
         """获取数据库连接（增加超时和错误处理）"""
         conn = None
+        start = time.perf_counter()
         try:
             conn = sqlite3.connect(
                 self.db_path,
@@ -86,6 +587,7 @@ class DBCache:
             )
             conn.row_factory = sqlite3.Row
             conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.durability.sqlite_synchronous}')
             yield conn
             conn.commit()
         except sqlite3.Error as e:
@@ -96,6 +598,12 @@ class DBCache:
         finally:
             if conn:
                 conn.close()
+            self.metrics.observe('db', time.perf_counter() - start)
+
+    def checkpoint(self):
+        """把WAL中已提交的事务写回主库（检查点过程会fsync WAL与数据库文件）"""
+        with self._get_connection() as conn:
+            conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
 
     def _init_db(self):
         """初始化全新数据库结构"""
@@ -125,6 +633,64 @@ class DBCache:
                     )
                 ''')
 
+                # 作品元数据表（列表接口返回的完整作品信息，zlib压缩）
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS illust_meta (
+                        illust_id INTEGER PRIMARY KEY,
+                        version TEXT NOT NULL,
+                        payload BLOB NOT NULL,
+                        updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+                    )
+                ''')
+
+                # 画师同步水位线表
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS artist_watermark (
+                        user_id TEXT PRIMARY KEY CHECK(length(user_id) > 0),
+                        last_illust_id INTEGER NOT NULL,
+                        last_create_date TEXT,
+                        last_full_sync DATETIME,
+                        updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+                    )
+                ''')
+
+                # 搜索时间窗口大小（按搜索词自适应）
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS search_window (
+                        word TEXT PRIMARY KEY CHECK(length(word) > 0),
+                        window_days INTEGER NOT NULL CHECK(window_days > 0),
+                        updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+                    )
+                ''')
+
+                # 写入过临时文件的目录（启动时只清理这些目录，无需遍历整个图库）
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS temp_dirs (
+                        dir TEXT PRIMARY KEY CHECK(length(dir) > 0),
+                        created_at DATETIME DEFAULT (datetime('now', 'localtime'))
+                    )
+                ''')
+
+                # 已完整完成的任务（如某日排行榜），供定时调度跳过
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS task_completion (
+                        task_key TEXT PRIMARY KEY CHECK(length(task_key) > 0),
+                        completed_at DATETIME DEFAULT (datetime('now', 'localtime'))
+                    )
+                ''')
+
+                # 格式转换队列（file_path为待转换的原图，完成后记录输出路径，删除原图后移除）
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS convert_queue (
+                        file_path TEXT PRIMARY KEY CHECK(length(file_path) > 0),
+                        status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'running', 'done')),
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        output_path TEXT,
+                        last_error TEXT,
+                        updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+                    )
+                ''')
+
                 # 创建索引
                 conn.execute('''
                     CREATE INDEX IF NOT EXISTS idx_cache_key 
@@ -172,40 +738,80 @@ class DBCache:
                 ''', (cache_key,)).fetchone()
 
                 if not row:
+                    self.metrics.incr('cache_lookups', cache='file', result='miss')
                     return False
 
                 # 检查优先级
                 if priority > row['priority']:
+                    self.metrics.incr('cache_lookups', cache='file', result='miss')
                     return False
 
                 # 检查文件实际状态
                 if not os.path.exists(row['file_path']):
+                    self.metrics.incr('cache_lookups', cache='file', result='stale')
                     self.delete_cache(cache_key)
                     return False
 
                 actual_size = os.path.getsize(row['file_path'])
                 if actual_size != row['file_size'] or actual_size < 1024*10:
+                    self.metrics.incr('cache_lookups', cache='file', result='stale')
                     self.delete_cache(cache_key)
                     return False
 
+                self.metrics.incr('cache_lookups', cache='file', result='hit')
                 return True
 
         except Exception as e:
             print(f"[缓存检查错误] {str(e)}")
             return False
 
+    def get_cache_entry(self, illust_id, page_idx):
+        """读取作品页的缓存记录（文件仍存在且大小一致时），返回 (file_path, priority) 或 None"""
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute('''
+                    SELECT file_path, file_size, priority FROM illust_cache WHERE cache_key = ?
+                ''', (f"illust_{illust_id}_p{page_idx}",)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[缓存检查错误] {str(e)}")
+            return None
+        if not row or not os.path.exists(row['file_path']):
+            return None
+        if os.path.getsize(row['file_path']) != row['file_size']:
+            return None
+        return row['file_path'], row['priority']
+
+    def relocate_cache(self, illust_id, page_idx, priority, old_path, new_path, tags=None):
+        """文件被移到更高优先级任务的目录后，同一事务内改写缓存记录与转换队列中的路径"""
+        tags_json = json.dumps([tag.lower().strip() for tag in (tags or [])], ensure_ascii=False)
+        with self._get_connection() as conn:
+            conn.execute('''
+                UPDATE illust_cache SET file_path = ?, priority = ?, tags_json = ?,
+                    updated_at = datetime('now', 'localtime')
+                WHERE cache_key = ? AND file_path = ?
+            ''', (new_path, priority, tags_json, f"illust_{illust_id}_p{page_idx}", old_path))
+            conn.execute('UPDATE convert_queue SET file_path = ? WHERE file_path = ?', (new_path, old_path))
+
     def update_cache(self, illust_id, page_idx, priority, file_path, tags=None):
-        """更新缓存记录"""
+        """更新缓存记录，已有更高优先级的记录时不覆盖；返回是否写入"""
         cache_key = f"illust_{illust_id}_p{page_idx}"
         file_size = os.path.getsize(file_path)
         tags_json = json.dumps([tag.lower().strip() for tag in (tags or [])], ensure_ascii=False)
 
         try:
             with self._get_connection() as conn:
+                before = conn.total_changes
                 conn.execute('''
-                    INSERT OR REPLACE INTO illust_cache 
+                    INSERT INTO illust_cache 
                     (cache_key, illust_id, page_idx, priority, file_path, file_size, tags_json)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(cache_key) DO UPDATE SET
+                        priority = excluded.priority,
+                        file_path = excluded.file_path,
+                        file_size = excluded.file_size,
+                        tags_json = excluded.tags_json,
+                        updated_at = datetime('now', 'localtime')
+                    WHERE excluded.priority >= illust_cache.priority
                 ''', (
                     cache_key,
                     illust_id,
@@ -215,7 +821,10 @@ class DBCache:
                     file_size,
                     tags_json
                 ))
-            return True
+                written = conn.total_changes > before
+            if not written:
+                console.detail(f"已有更高优先级的缓存记录，保留原记录: {cache_key}")
+            return written
         except sqlite3.Error as e:
             print(f"[缓存更新失败] SQL错误: {str(e)}")
             print(f"参数详情: "
@@ -242,14 +851,256 @@ class DBCache:
                 cached_tags = set(json.loads(result['tags_json']))  # 修改这里 tags -> tags_json
                 exclude_tags = set(current_exclude_tags)
                 
-                print(f"[CACHE DEBUG] 缓存标签：{cached_tags}")
-                print(f"[CACHE DEBUG] 排除标签：{exclude_tags}")
+                if DEBUG_API_RESPONSE:
+                    print(f"[CACHE DEBUG] 缓存标签：{cached_tags}")
+                    print(f"[CACHE DEBUG] 排除标签：{exclude_tags}")
                 
                 return len(cached_tags & exclude_tags) > 0
                 
             except json.JSONDecodeError:
                 return False
 
+    def save_illust_meta(self, illusts):
+        """批量保存列表接口返回的作品元数据，只压缩并写入新作品或版本变化的作品"""
+        versions = {}
+        for illust in illusts or []:
+            illust_id = illust.get('id') if isinstance(illust, dict) else None
+            if illust_id:
+                versions[illust_id] = (illust, meta_version(illust))
+        if not versions:
+            return 0
+
+        try:
+            with self._get_connection() as conn:
+                placeholders = ",".join("?" * len(versions))
+                stored = dict(conn.execute(
+                    f"SELECT illust_id, version FROM illust_meta WHERE illust_id IN ({placeholders})",
+                    list(versions)).fetchall())
+                rows = [(illust_id, version,
+                         zlib.compress(json.dumps(illust, ensure_ascii=False).encode('utf-8')))
+                        for illust_id, (illust, version) in versions.items()
+                        if stored.get(illust_id) != version]
+                conn.executemany('''
+                    INSERT INTO illust_meta (illust_id, version, payload)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(illust_id) DO UPDATE SET
+                        version = excluded.version,
+                        payload = excluded.payload,
+                        updated_at = datetime('now', 'localtime')
+                ''', rows)
+            return len(rows)
+        except sqlite3.Error as e:
+            print(f"[元数据保存失败] {str(e)}")
+            return 0
+
+    def load_illust_meta(self, illust_id, version=None):
+        """读取本地作品元数据（JSON字符串）；指定 version 时版本不一致视为过期，返回None"""
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute('''
+                    SELECT version, payload FROM illust_meta WHERE illust_id = ?
+                ''', (int(illust_id),)).fetchone()
+            if not row or (version is not None and row['version'] != version):
+                return None
+            return zlib.decompress(row['payload']).decode('utf-8')
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            print(f"[元数据读取失败] {illust_id}: {str(e)}")
+            return None
+
+    def get_watermark(self, user_id):
+        """获取画师同步水位线（最新已同步作品）"""
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute('''
+                    SELECT last_illust_id, last_create_date, last_full_sync
+                    FROM artist_watermark WHERE user_id = ?
+                ''', (str(user_id),)).fetchone()
+                return dict(row) if row else None
+        except sqlite3.Error as e:
+            print(f"[水位线读取失败] {str(e)}")
+            return None
+
+    def update_watermark(self, user_id, illust_id, create_date, full_sync=False):
+        """更新画师同步水位线，全量扫描时同时记录扫描时间"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''
+                    INSERT INTO artist_watermark
+                    (user_id, last_illust_id, last_create_date, last_full_sync)
+                    VALUES (?, ?, ?, CASE WHEN ? THEN datetime('now', 'localtime') END)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        last_illust_id = MAX(last_illust_id, excluded.last_illust_id),
+                        last_create_date = CASE
+                            WHEN excluded.last_illust_id >= last_illust_id
+                            THEN excluded.last_create_date ELSE last_create_date END,
+                        last_full_sync = COALESCE(excluded.last_full_sync, last_full_sync),
+                        updated_at = datetime('now', 'localtime')
+                ''', (str(user_id), int(illust_id), create_date, bool(full_sync)))
+            return True
+        except sqlite3.Error as e:
+            print(f"[水位线更新失败] {str(e)}")
+            return False
+
+    def get_search_window(self, word):
+        """获取搜索词上次使用的时间窗口天数"""
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute('''
+                    SELECT window_days FROM search_window WHERE word = ?
+                ''', (word,)).fetchone()
+                return row['window_days'] if row else None
+        except sqlite3.Error as e:
+            print(f"[窗口大小读取失败] {str(e)}")
+            return None
+
+    def save_search_window(self, word, window_days):
+        """保存搜索词的时间窗口天数"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO search_window (word, window_days)
+                    VALUES (?, ?)
+                ''', (word, int(window_days)))
+        except sqlite3.Error as e:
+            print(f"[窗口大小保存失败] {str(e)}")
+
+    def register_temp_dir(self, directory):
+        """登记将要写入临时文件的目录"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''
+                    INSERT OR IGNORE INTO temp_dirs (dir) VALUES (?)
+                ''', (directory,))
+        except sqlite3.Error as e:
+            print(f"[临时目录登记失败] {str(e)}")
+
+    def get_temp_dirs(self):
+        try:
+            with self._get_connection() as conn:
+                return [row['dir'] for row in conn.execute('SELECT dir FROM temp_dirs')]
+        except sqlite3.Error as e:
+            print(f"[临时目录读取失败] {str(e)}")
+            return []
+
+    def remove_temp_dirs(self, dirs):
+        try:
+            with self._get_connection() as conn:
+                conn.executemany('DELETE FROM temp_dirs WHERE dir = ?', [(d,) for d in dirs])
+        except sqlite3.Error as e:
+            print(f"[临时目录登记清除失败] {str(e)}")
+
+    def mark_task_complete(self, task_key):
+        """记录任务已完整完成（进度记录在完成时会被清除，无法据此区分未开始与已完成）"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO task_completion (task_key) VALUES (?)
+                ''', (task_key,))
+        except sqlite3.Error as e:
+            print(f"[任务完成标记失败] {str(e)}")
+
+    def is_task_complete(self, task_key):
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute('''
+                    SELECT 1 FROM task_completion WHERE task_key = ?
+                ''', (task_key,)).fetchone()
+                return row is not None
+        except sqlite3.Error as e:
+            print(f"[任务完成标记读取失败] {str(e)}")
+            return False
+
+    def enqueue_conversions(self, paths):
+        """加入格式转换队列（已在队列中的任务重置为待处理）"""
+        try:
+            with self._get_connection() as conn:
+                conn.executemany('''
+                    INSERT INTO convert_queue (file_path) VALUES (?)
+                    ON CONFLICT(file_path) DO UPDATE SET
+                        status = 'pending', attempts = 0, last_error = NULL,
+                        updated_at = datetime('now', 'localtime')
+                ''', [(path,) for path in paths])
+        except sqlite3.Error as e:
+            print(f"[转换任务入队失败] {str(e)}")
+
+    def enqueue_library_conversions(self):
+        """把缓存中的全部图片（动图GIF除外）加入转换队列，返回任务数"""
+        with self._get_connection() as conn:
+            before = conn.total_changes
+            conn.execute('''
+                INSERT INTO convert_queue (file_path)
+                SELECT file_path FROM illust_cache WHERE lower(file_path) NOT LIKE '%.gif'
+                ON CONFLICT(file_path) DO UPDATE SET
+                    status = 'pending', attempts = 0, last_error = NULL,
+                    updated_at = datetime('now', 'localtime')
+            ''')
+            return conn.total_changes - before
+
+    def recover_conversions(self):
+        """上次中断时仍在处理的任务恢复为待处理，返回已完成但尚未清理原图的任务"""
+        with self._get_connection() as conn:
+            conn.execute("UPDATE convert_queue SET status = 'pending' WHERE status = 'running'")
+            return [(row['file_path'], row['output_path']) for row in conn.execute(
+                "SELECT file_path, output_path FROM convert_queue WHERE status = 'done'")]
+
+    def claim_conversions(self, limit):
+        """领取一批待处理的转换任务"""
+        with self._get_connection() as conn:
+            paths = [row['file_path'] for row in conn.execute('''
+                SELECT file_path FROM convert_queue
+                WHERE status = 'pending' AND attempts < ?
+                ORDER BY rowid LIMIT ?
+            ''', (CONVERT_MAX_ATTEMPTS, limit))]
+            conn.executemany('''
+                UPDATE convert_queue SET status = 'running', attempts = attempts + 1,
+                    updated_at = datetime('now', 'localtime')
+                WHERE file_path = ?
+            ''', [(path,) for path in paths])
+            return paths
+
+    def complete_conversion(self, original_path, output_path):
+        """同一事务内把缓存路径改为转换结果并标记任务完成"""
+        with self._get_connection() as conn:
+            conn.execute('''
+                UPDATE illust_cache SET file_path = ?, file_size = ?,
+                    updated_at = datetime('now', 'localtime')
+                WHERE file_path = ?
+            ''', (output_path, os.path.getsize(output_path), original_path))
+            conn.execute('''
+                UPDATE convert_queue SET status = 'done', output_path = ?, last_error = NULL,
+                    updated_at = datetime('now', 'localtime')
+                WHERE file_path = ?
+            ''', (output_path, original_path))
+
+    def fail_conversion(self, path, error):
+        """记录失败并放回队列（超过最大尝试次数后不再领取）"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''
+                    UPDATE convert_queue SET status = 'pending', last_error = ?,
+                        updated_at = datetime('now', 'localtime')
+                    WHERE file_path = ?
+                ''', (error, path))
+        except sqlite3.Error as e:
+            print(f"[转换任务状态更新失败] {str(e)}")
+
+    def remove_conversions(self, paths):
+        try:
+            with self._get_connection() as conn:
+                conn.executemany('DELETE FROM convert_queue WHERE file_path = ?', [(p,) for p in paths])
+        except sqlite3.Error as e:
+            print(f"[转换任务清除失败] {str(e)}")
+
+    def get_conversion_counts(self):
+        """按状态统计转换队列（失败次数用尽的任务单独计为failed）"""
+        with self._get_connection() as conn:
+            rows = conn.execute('''
+                SELECT CASE WHEN status = 'pending' AND attempts >= ? THEN 'failed' ELSE status END AS state,
+                       COUNT(*) AS count
+                FROM convert_queue GROUP BY state
+            ''', (CONVERT_MAX_ATTEMPTS,))
+            return {row['state']: row['count'] for row in rows}
+
     def clear_following_cache(self, user_id=None):
         """清理关注缓存"""
         base_pattern = os.path.join("following", "%")
@@ -343,14 +1194,13 @@ class DBCache:
                 params['user_id'] = str(user_id)
 
             with self._get_connection() as conn:
-                conn.execute("PRAGMA synchronous = NORMAL;")
                 conn.execute('''
                     INSERT OR REPLACE INTO download_progress 
                     (user_id, next_qs)
                     VALUES (?, ?)
                 ''', (str(user_id), json.dumps(params)))
                 conn.commit()
-            print(f"进度已更新", end="\n", flush=True)
+            console.detail("进度已更新")
         except Exception as e:
             print(f"进度保存失败: {str(e)}", end="\n", flush=True)
 
@@ -382,19 +1232,625 @@ class DBCache:
             return None
 
     def clear_progress(self, user_id):
-        print(f"清除 {user_id} 的进度")
+        console.detail(f"清除 {user_id} 的进度")
         with self._get_connection() as conn:
-            conn.execute("PRAGMA synchronous = OFF;")
             conn.execute('DELETE FROM download_progress WHERE user_id = ?', (user_id,))
             conn.commit()
 
+class RateLimiter:
+    """线程安全的全局请求限速器（保证相邻请求的最小间隔）"""
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+class BandwidthLimiter:
+    """全局下载带宽限制（令牌桶，字节/秒，允许1秒突发），上限可按本地时段切换"""
+    SCHEDULE_CHECK_INTERVAL = 30  # 重新判断所处时段的间隔(秒)
+
+    def __init__(self, limit_kbps=0, schedule=(), metrics=None):
+        self.limit_kbps = limit_kbps
+        self.schedule = [(self._minutes(start), self._minutes(end), kbps) for start, end, kbps in schedule]
+        self.metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._rate = 0
+        self._rate_checked = 0.0
+
+    @staticmethod
+    def _minutes(text):
+        hour, minute = str(text).split(':')
+        return int(hour) * 60 + int(minute)
+
+    def current_rate(self):
+        """当前时段的上限（字节/秒），0为不限"""
+        now = time.monotonic()
+        if now - self._rate_checked >= self.SCHEDULE_CHECK_INTERVAL:
+            local = time.localtime()
+            minute = local.tm_hour * 60 + local.tm_min
+            kbps = self.limit_kbps
+            for start, end, value in self.schedule:
+                inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+                if inside:
+                    kbps = value
+                    break
+            self._rate = int(kbps * 1024)
+            self._rate_checked = now
+        return self._rate
+
+    def consume(self, nbytes):
+        """取用令牌，不足时阻塞到补足为止"""
+        with self._lock:
+            rate = self.current_rate()
+            if not rate:
+                return
+            now = time.monotonic()
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate) - nbytes
+            self._last = now
+            deficit = -self._tokens
+        if deficit > 0:
+            with self.metrics.timer('bandwidth_wait'):
+                time.sleep(deficit / rate)
+
+class AuthSession:
+    """OAuth令牌管理：访问令牌缓存到仅本人可读的文件，临近过期时后台刷新，失效时同步重新认证"""
+    REFRESH_MARGIN = 300  # 过期前多少秒开始后台刷新
+    RETRY_DELAY = 60      # 后台刷新失败后的重试间隔(秒)
+
+    def __init__(self, api, refresh_token, cache_path, metrics=None):
+        self.api = api
+        self.refresh_token = refresh_token
+        self.cache_path = cache_path
+        self.metrics = metrics or Metrics()
+        self.expires_at = 0.0
+        self._lock = threading.Lock()
+        self._timer = None
+        # 配置的refresh_token变化（如切换账号）时旧缓存作废
+        self._owner = hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+    def login(self):
+        """优先使用缓存中仍有效的访问令牌，否则向OAuth服务器认证"""
+        cached = self._load()
+        if cached and cached['expires_at'] - time.time() > self.REFRESH_MARGIN:
+            self.api.set_auth(cached['access_token'], cached['refresh_token'])
+            self.expires_at = cached['expires_at']
+            console.detail(f"使用缓存的访问令牌（{int((self.expires_at - time.time()) / 60)} 分钟后过期）")
+        else:
+            self.refresh()
+        self._schedule(self.expires_at - self.REFRESH_MARGIN - time.time())
+
+    def refresh(self, stale_token=None):
+        """重新认证；stale_token 为调用方所用的失效令牌，若其他线程已完成刷新则直接返回"""
+        with self._lock:
+            if stale_token is not None and self.api.access_token != stale_token:
+                return
+            token = self.api.auth(refresh_token=self.api.refresh_token or self.refresh_token)
+            self.expires_at = time.time() + int(token.response.expires_in or 3600)
+            self.metrics.incr('auth_refresh')
+            self._save()
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+
+    def _schedule(self, delay):
+        self.close()
+        self._timer = threading.Timer(max(0, delay), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+            self._schedule(self.expires_at - self.REFRESH_MARGIN - time.time())
+        except Exception as e:
+            print(f"[令牌刷新失败] {str(e)}，{self.RETRY_DELAY}秒后重试")
+            self._schedule(self.RETRY_DELAY)
+
+    def _load(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('owner') != self._owner:
+                return None
+            return data
+        except (OSError, ValueError):
+            return None
+
+    def _save(self):
+        """写入令牌缓存（权限600，先写临时文件再替换）"""
+        data = {
+            'owner': self._owner,
+            'access_token': self.api.access_token,
+            'refresh_token': self.api.refresh_token,
+            'expires_at': self.expires_at
+        }
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print(f"[令牌缓存写入失败] {str(e)}")
+
+class ApiResponseCache:
+    """app-api列表接口的磁盘响应缓存（按接口设置有效期，超出容量按LRU淘汰）"""
+    RANKING_ROLLOVER = 'ranking_rollover'  # 有效期至下一次JST中午榜单更新
+
+    DEFAULT_TTL = {
+        'illust_ranking': RANKING_ROLLOVER,   # 未指定日期的榜单
+        'illust_ranking_dated': None,         # 指定日期的榜单永不变化
+        'user_following': 6 * 3600,
+        'user_illusts': 10 * 60,
+        'user_bookmarks_illust': 10 * 60,
+        'search_illust': 10 * 60,
+        'illust_follow': 5 * 60,
+    }
+
+    def __init__(self, cache_dir, max_bytes, ttl_overrides=None, metrics=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = dict(self.DEFAULT_TTL)
+        self.ttl.update(ttl_overrides or {})
+        self.metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_size = sum(
+            entry.stat().st_size for entry in os.scandir(cache_dir)
+            if entry.is_file() and entry.name.endswith('.json.gz')
+        )
+
+    @staticmethod
+    def _normalize(params):
+        """统一参数格式（next_qs中的值均为字符串，首次请求可能为整数）"""
+        return sorted((k, str(v)) for k, v in params.items() if v is not None)
+
+    def _path(self, method, params):
+        raw = json.dumps([method, self._normalize(params)], ensure_ascii=False)
+        digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json.gz")
+
+    def _ttl_key(self, method, params):
+        if method == 'illust_ranking' and params.get('date'):
+            return 'illust_ranking_dated'
+        return method
+
+    def _expired(self, ttl, stored_at):
+        if ttl is None:
+            return False
+        if ttl == self.RANKING_ROLLOVER:
+            jst = datetime.timezone(datetime.timedelta(hours=9))
+            stored = datetime.datetime.fromtimestamp(stored_at, jst)
+            rollover = stored.replace(hour=12, minute=0, second=0, microsecond=0)
+            if stored >= rollover:
+                rollover += datetime.timedelta(days=1)
+            return time.time() >= rollover.timestamp()
+        return time.time() - stored_at > ttl
+
+    def is_cacheable(self, method):
+        return method in self.ttl
+
+    def get(self, method, params):
+        """命中时返回响应JSON文本，否则返回None"""
+        path = self._path(method, params)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.metrics.incr('cache_lookups', cache='api', result='miss')
+            return None
+        except (OSError, ValueError, EOFError):
+            self._remove(path)
+            self.metrics.incr('cache_lookups', cache='api', result='miss')
+            return None
+
+        if self._expired(self.ttl.get(self._ttl_key(method, params)), entry['stored_at']):
+            self._remove(path)
+            self.metrics.incr('cache_lookups', cache='api', result='stale')
+            return None
+
+        try:
+            os.utime(path)  # 刷新访问时间，用于LRU淘汰
+        except OSError:
+            pass
+        self.metrics.incr('cache_lookups', cache='api', result='hit')
+        return entry['body']
+
+    def put(self, method, params, body):
+        path = self._path(method, params)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with gzip.open(temp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+                json.dump({'stored_at': time.time(), 'body': body}, f, ensure_ascii=False)
+            new_size = os.path.getsize(temp_path)
+            with self._lock:
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                os.replace(temp_path, path)
+                self._total_size += new_size - old_size
+                if self._total_size > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            print(f"[响应缓存写入失败] {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            with self._lock:
+                self._total_size -= size
+        except OSError:
+            pass
+
+    def _evict(self):
+        """按最近访问时间淘汰，直至低于容量上限的90%"""
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir)
+             if entry.is_file() and entry.name.endswith('.json.gz')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if self._total_size <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._total_size -= size
+            except OSError:
+                continue
+
+class Profiler:
+    """--profile 剖析：cprofile 统计各线程函数耗时，tracemalloc 统计内存分配
+
+    报告按 PROFILE_STAGES 中的函数分段汇总，写入下载目录的 profiles 子目录。
+    """
+    PROFILE_STAGES = (
+        ('PixivDownloader', '_download_file'),
+        ('PixivDownloader', '_download_with_retry'),
+        ('PixivDownloader', '_validate_file'),
+        ('PixivDownloader', 'convert_image'),
+        ('PixivDownloader', 'download_ugoira'),
+        ('PixivDownloader', '_create_animated_gif'),
+        ('PixivDownloader', '_iter_pages'),
+        ('DBCache', 'check_cache'),
+        ('DBCache', 'update_cache'),
+        ('DBCache', 'save_progress'),
+        ('DBCache', 'save_illust_meta'),
+        ('ApiResponseCache', 'get'),
+        ('ApiResponseCache', 'put'),
+    )
+    TOP_N = 30
+    SNAPSHOT_INTERVAL = 2  # tracemalloc 采样快照间隔(秒)，保留内存占用最高的一次
+
+    def __init__(self, mode='cprofile', output_dir=None):
+        self.mode = mode
+        self.output_dir = output_dir or os.path.join(download_dir, 'profiles')
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._peak_snapshot = None
+        self._peak_size = 0
+
+    def _stage_ranges(self):
+        """各阶段函数在本文件中的 (名称, 起始行, 结束行)
+
+        行号取自代码对象而非源码，打包后的exe没有.py源文件也能使用
+        """
+        ranges = []
+        for cls_name, func_name in self.PROFILE_STAGES:
+            code = getattr(globals()[cls_name], func_name).__code__
+            first = code.co_firstlineno
+            if hasattr(code, 'co_lines'):
+                last = max((line for _, _, line in code.co_lines() if line is not None), default=first)
+            else:
+                import dis
+                last = max((line for _, line in dis.findlinestarts(code)), default=first)
+            ranges.append((f"{cls_name}.{func_name}", first, last))
+        return ranges
+
+    def start(self):
+        self.started = datetime.datetime.now()
+        if self.mode == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.start(25)
+            threading.Thread(target=self._sample, daemon=True).start()
+            return
+        import cProfile
+
+        # 每个新线程首次触发profile事件时创建独立的profiler（cProfile只能剖析所在线程）
+        def start_thread_profile(frame, event, arg):
+            profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+            profile.enable()
+
+        # Python 3.12起cProfile基于sys.monitoring，单个profiler即可覆盖所有线程
+        if sys.version_info < (3, 12):
+            threading.setprofile(start_thread_profile)
+        main_profile = cProfile.Profile()
+        self._profiles.append(main_profile)
+        main_profile.enable()
+
+    def _sample(self):
+        import tracemalloc
+        while not self._stop.wait(self.SNAPSHOT_INTERVAL):
+            self._take_snapshot(tracemalloc)
+
+    def _take_snapshot(self, tracemalloc):
+        current, _ = tracemalloc.get_traced_memory()
+        if current >= self._peak_size:
+            self._peak_size = current
+            self._peak_snapshot = tracemalloc.take_snapshot()
+
+    def stop(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"profile_{self.started:%Y%m%d_%H%M%S}_{self.mode}")
+        header = [f"性能剖析报告（{self.mode}） {self.started:%Y-%m-%d %H:%M:%S}",
+                  f"命令: {' '.join(sys.argv[1:]) or '交互模式'}", ""]
+        if self.mode == 'tracemalloc':
+            lines = self._stop_tracemalloc()
+        else:
+            lines = self._stop_cprofile(base + '.pstats')
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write("\n".join(header + lines) + "\n")
+        print(f"剖析报告已写入: {base}.txt")
+
+    def _stop_cprofile(self, pstats_path):
+        import pstats
+        threading.setprofile(None)
+        for profile in self._profiles:
+            profile.disable()
+        stats = pstats.Stats(self._profiles[0])
+        for profile in self._profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:  # 线程未产生任何调用记录
+                continue
+        stats.dump_stats(pstats_path)
+        print(f"pstats文件已写入: {pstats_path}")
+
+        this_file = os.path.abspath(__file__)
+        lines = ["== 分阶段累计耗时（含所有线程） ==",
+                 f"{'阶段':<36}{'调用次数':>10}{'累计耗时s':>12}{'单次ms':>10}"]
+        for name, first, _ in self._stage_ranges():
+            func_name = name.rsplit('.', 1)[-1]
+            calls = cumtime = 0
+            for (filename, lineno, func), (_, ncalls, _, ct, _) in stats.stats.items():
+                if func == func_name and lineno == first and os.path.abspath(filename) == this_file:
+                    calls += ncalls
+                    cumtime += ct
+            per_call = cumtime / calls * 1000 if calls else 0
+            lines.append(f"{name:<36}{calls:>10}{cumtime:>12.3f}{per_call:>10.2f}")
+
+        buffer = io.StringIO()
+        stats.stream = buffer
+        stats.sort_stats('cumulative').print_stats(self.TOP_N)
+        lines += ["", f"== 累计耗时前 {self.TOP_N} 的函数 ==", buffer.getvalue()]
+        return lines
+
+    def _stop_tracemalloc(self):
+        import tracemalloc
+        self._stop.set()
+        self._take_snapshot(tracemalloc)
+        snapshot = self._peak_snapshot
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        this_file = os.path.abspath(__file__)
+        ranges = self._stage_ranges()
+        per_stage = {name: [0, 0] for name, _, _ in ranges}
+        for trace in snapshot.traces:
+            # 以调用栈中最内层的阶段函数归属该分配
+            for frame in trace.traceback:
+                if os.path.abspath(frame.filename) != this_file:
+                    continue
+                stage = next((name for name, first, last in ranges if first <= frame.lineno <= last), None)
+                if stage:
+                    per_stage[stage][0] += 1
+                    per_stage[stage][1] += trace.size
+                    break
+
+        lines = [f"峰值内存（tracemalloc）: {format_size(peak)}，"
+                 f"以下为占用最高时刻（{format_size(self._peak_size)}）的存活分配",
+                 "", "== 分阶段内存占用 ==",
+                 f"{'阶段':<36}{'分配块数':>10}{'大小':>12}"]
+        for name, (count, size) in sorted(per_stage.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<36}{count:>10}{format_size(size):>12}")
+        lines += ["", f"== 占用最多的前 {self.TOP_N} 个代码位置 =="]
+        for stat in snapshot.statistics('lineno')[:self.TOP_N]:
+            frame = stat.traceback[0]
+            lines.append(f"{format_size(stat.size):>12} {stat.count:>8} 块  {frame.filename}:{frame.lineno}")
+        return lines
+
+
+class SessionRecorder:
+    """会话录制：app-api请求与响应、图片响应头（可选响应体）按行写入gzip JSONL归档
+
+    归档可交给 benchmark.py --replay 回放，离线复现翻页、缓存与过滤行为。
+    只挂接 api.requests 的 GET/HEAD，OAuth认证请求不会被录制。
+    """
+    DROP_HEADERS = frozenset({'set-cookie', 'content-encoding', 'transfer-encoding', 'connection'})
+
+    def __init__(self, path, include_bodies=False, command=None):
+        self.path = path
+        self.include_bodies = include_bodies
+        self.count = 0
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._write({
+            'type': 'session', 'version': 1,
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'command': command or [], 'include_bodies': include_bodies,
+        })
+
+    def _write(self, record):
+        with self._lock:
+            if self._file:
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def attach(self, api):
+        session = api.requests
+        for method in ('get', 'head'):
+            setattr(session, method, self._wrap(method.upper(), getattr(session, method)))
+
+    def _wrap(self, http_method, original):
+        def recorded_call(url, params=None, **kwargs):
+            start = time.monotonic()
+            res = original(url, params=params, **kwargs)
+            try:
+                self._record(http_method, url, params, res, start, time.monotonic() - start)
+            except Exception as e:
+                print(f"[会话录制失败] {str(e)}")
+            return res
+        return recorded_call
+
+    def _record(self, http_method, url, params, res, start, elapsed):
+        if params:
+            query = urlencode({k: v for k, v in params.items() if v is not None})
+            url = f"{url}{'&' if '?' in url else '?'}{query}"
+        # 按响应类型区分：API返回JSON，其余均视为图片/ZIP资源
+        kind = 'api' if 'json' in res.headers.get('Content-Type', '') else 'image'
+        record = {
+            'type': 'http', 'kind': kind, 'method': http_method, 'url': url,
+            't': round(start - self._started, 4), 'elapsed': round(elapsed, 4),
+            'status': res.status_code,
+            'headers': {k: v for k, v in res.headers.items() if k.lower() not in self.DROP_HEADERS},
+        }
+        if http_method == 'GET':
+            if kind == 'api':
+                record['body'] = res.text
+            elif self.include_bodies and res.status_code == 200:
+                # 一次性读入内容，并把原始流换成内存流供下载器继续读取
+                record['body_b64'] = base64.b64encode(res.content).decode('ascii')
+                res.raw = io.BytesIO(res.content)
+        self._write(record)
+        self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+        print(f"会话已录制: {self.count} 个请求 → {self.path}")
+
+
+def resolve_output_format(output_formats):
+    """解析输出格式配置，返回 (Pillow格式, 扩展名, 色彩模式)；配置为original时返回None"""
+    if isinstance(output_formats, list) and len(output_formats) > 0:
+        fmt = str(output_formats[0]).lower().strip()
+    else:
+        fmt = str(output_formats).lower().strip()
+    if fmt == 'original':
+        return None
+
+    # 处理格式别名
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    if fmt not in OUTPUT_FORMATS:
+        print(f"无效格式配置: {fmt}，使用默认JPG")
+        fmt = 'jpg'
+    console.detail(f"目标格式: {fmt}")
+    return OUTPUT_FORMATS[fmt]
+
+def converted_path(original_path, target):
+    """转换结果的保存路径（与原图同名，扩展名换成目标格式）"""
+    return os.path.splitext(original_path)[0] + target[1]
+
+def render_image(original_path, temp_path, target, quality):
+    """按目标格式重新编码图像并写入 temp_path
+
+    只读写文件、不访问数据库，可在 convert-worker 的子进程中运行
+    """
+    from PIL import Image
+    pillow_fmt, _, color_mode = target
+    with Image.open(original_path) as img:
+        # 透明度处理
+        if img.mode in ('RGBA', 'LA') and color_mode == 'RGB':
+            console.detail("处理透明度通道")
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            convert_img = background
+        else:
+            convert_img = img
+
+        # 色彩模式转换
+        if convert_img.mode != color_mode:
+            console.detail(f"转换色彩模式: {convert_img.mode} → {color_mode}")
+            convert_img = convert_img.convert(color_mode)
+
+        # 保存参数
+        save_params = {}
+        if pillow_fmt == 'JPEG':
+            quality = min(max(quality, 10), 95)
+            save_params = {
+                'quality': quality,
+                'optimize': True,
+                'subsampling': 0  # 强制使用4:4:4避免报错
+            }
+            console.detail(f"JPEG质量参数: Q{quality}")
+        elif pillow_fmt == 'WEBP':
+            save_params['quality'] = min(quality, 100)
+        convert_img.save(temp_path, format=pillow_fmt, **save_params)
+
+def _timed_render(original_path, temp_path, target, quality):
+    """在转换子进程中执行 render_image，返回编码耗时（秒），不含在进程池中排队的时间"""
+    start = time.perf_counter()
+    render_image(original_path, temp_path, target, quality)
+    return time.perf_counter() - start
+
+def _lower_priority():
+    """转换子进程降低调度优先级，只占用空闲CPU"""
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+
 class PixivDownloader:
     def __init__(self, refresh_token, user_id, root_dir=download_dir, proxies=None, **kwargs):
+        from pixivpy3 import AppPixivAPI
         self.api = AppPixivAPI(proxies=proxies)
-        self.api.auth(refresh_token=refresh_token)
+        if kwargs.get('api_host'):
+            self.api.hosts = kwargs['api_host']  # 指向替身服务（基准测试）
+        self.pximg_host = kwargs.get('pximg_host', 'https://i.pximg.net').rstrip('/')
+        self.adapters = {}
+        self._pool_sizes = {}
+        self._transport_options = kwargs
+        self._task_workers = max(TASK_WORKERS, 1)  # TASK_WORKERS为0时由 execute_batch 按任务数放大
+        self._configure_transport(kwargs)
+        self.recorder = None
         self.user_id = user_id
         self.root_dir = root_dir
-        self.db = DBCache(root_dir=root_dir)
+        self.metrics = Metrics()
+        self.bandwidth = BandwidthLimiter(kwargs.get('bandwidth_limit_kbps', BANDWIDTH_LIMIT_KBPS),
+                                          kwargs.get('bandwidth_schedule', BANDWIDTH_SCHEDULE),
+                                          metrics=self.metrics)
+        self.auth = None
+        if kwargs.get('access_token'):
+            # 已持有有效令牌时跳过OAuth
+            self.api.set_auth(kwargs['access_token'], refresh_token)
+        else:
+            # 缓存的访问令牌有效时跳过OAuth往返，临近过期后台刷新
+            self.auth = AuthSession(self.api, refresh_token,
+                                    os.path.join(root_dir, '.auth_token.json'),
+                                    metrics=self.metrics)
+            self.auth.login()
+        self.durability = Durability(kwargs.get('durability', DURABILITY),
+                                     DURABILITY_BATCH_FILES, DURABILITY_BATCH_SECONDS, self.metrics)
+        self.db = DBCache(root_dir=root_dir, metrics=self.metrics, durability=self.durability)
 
         # 初始化目录
         self.ranking_dir = os.path.join(root_dir, "ranking")
@@ -405,34 +1861,152 @@ class PixivDownloader:
         os.makedirs(self.following_dir, exist_ok=True)
         os.makedirs(self.bookmarks_dir, exist_ok=True)
         os.makedirs(self.search_dir, exist_ok=True)
+        # 收藏与搜索结果可按作品ID分片存放，避免单个目录文件过多
+        self.shard_size = int(kwargs.get('shard_size', SHARD_SIZE if SHARDED_LAYOUT else 0))
 
         self.ranking_max = kwargs.get('ranking_max', 100)
         self.follow_max = kwargs.get('follow_max', 100)
         self.request_interval = kwargs.get('request_interval', 2)
-        self.exclude_tags = {
-            tag.strip().lower()  # 仅做标准化处理
+        self.exclude_tags = frozenset(
+            tag.strip().lower()  # 仅做标准化处理，构造时一次性完成
             for tag in kwargs.get('exclude_tags', [])
-        }
+        )
         # 修复的API调试钩子
         if DEBUG_API_RESPONSE:
             self._enable_api_debug()
+        # 全局API限速与图片下载并发控制（多线程共享）
+        self.rate_limiter = RateLimiter(kwargs.get('api_min_interval', API_MIN_INTERVAL))
+        self.download_slots = threading.BoundedSemaphore(kwargs.get('download_workers', DOWNLOAD_WORKERS))
+        self.artist_workers = kwargs.get('artist_workers', ARTIST_WORKERS)
+        self.search_workers = kwargs.get('search_workers', SEARCH_WORKERS)
+        self.stop_event = threading.Event()  # 通知工作线程保存进度并尽快退出
+        self.progress = console.progress  # 所有线程共享同一进度显示
+        self._enable_api_rate_limit()
+        if self.auth:
+            self._enable_auth_refresh()
+        # 列表接口响应缓存
+        self.api_cache = None
+        if kwargs.get('api_cache', API_CACHE_ENABLED):
+            self.api_cache = ApiResponseCache(
+                os.path.join(root_dir, '.api_cache'),
+                max_bytes=int(API_CACHE_MAX_MB * 1024 * 1024),
+                ttl_overrides=API_CACHE_TTL,
+                metrics=self.metrics
+            )
+            self._enable_api_cache()
         # 新增格式转换参数
         self.output_formats = kwargs.get('output_format', 'original')
         self.quality = kwargs.get('quality', 90) 
+        # 转换队列模式：下载只入库原图，转换由 convert-worker 完成
+        self.convert_queue = (bool(kwargs.get('convert_queue', CONVERT_QUEUE))
+                              and str(self.output_formats).lower().strip() != 'original')
 
         # 其他初始化代码保持不变...
         self.exclude_manga = kwargs.get('exclude_manga', True)
-        self.chunk_size = 4 * 1024 * 1024
-        self.max_buffer_size = 16 * 1024 * 1024  # 16MB内存缓冲
-        self.write_buffer = b''
+        self._stream_buffers = threading.local()
+        self._download_failures = threading.local()  # 当前线程正在处理的作品的下载失败类型
         self.headers = {
             'Referer': 'https://www.pixiv.net/',
             'User-Agent': 'PixivAndroidApp/5.0.234 (Android 11; Pixel 5)',
             'Accept-Encoding': 'gzip, deflate'
         }       
         
+        self._temp_dirs = set()
+        self._temp_lock = threading.Lock()
+        self._claims = {}  # (作品ID, 页码) -> [锁, 等待数]，并发任务处理同一作品页时串行
+        self._claims_lock = threading.Lock()
         self.clean_temp_files()
 
+    def _configure_transport(self, kwargs):
+        """按主机挂载连接池与重试策略：连接失败与429/5xx响应由urllib3按指数退避自动重试，
+        连接池不小于该主机的并发数，避免连接用完即弃、反复经代理握手；
+        配置了连接上限的主机使用阻塞连接池，超出上限的请求等待空闲连接"""
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        session = self.api.requests
+        retry = Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES, status=HTTP_RETRIES,
+                      backoff_factor=HTTP_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset({'GET', 'HEAD'}), raise_on_status=False)
+
+        api_workers = (kwargs.get('artist_workers', ARTIST_WORKERS)
+                       + kwargs.get('search_workers', SEARCH_WORKERS) + self._task_workers)
+        pools = {}
+        for prefix, size in ((self.api.hosts, api_workers),
+                             ('https://oauth.secure.pixiv.net', 1),
+                             (self.pximg_host, kwargs.get('download_workers', DOWNLOAD_WORKERS) + 2)):
+            prefix = prefix.rstrip('/')
+            size = HTTP_POOL_SIZE.get(urlsplit(prefix).hostname, size)
+            pools[prefix] = pools.get(prefix, 0) + size  # 替身服务等多个角色共用同一主机时合并
+
+        base = session.get_adapter('https://')
+        for prefix, size in pools.items():
+            if self._pool_sizes.get(prefix) == size:
+                continue  # 重新配置时只替换大小有变化的连接池
+            self._pool_sizes[prefix] = size
+            options = {'pool_connections': 2, 'pool_maxsize': size, 'max_retries': retry}
+            cap = HOST_CONNECTION_LIMITS.get(urlsplit(prefix).hostname)
+            if cap:
+                options.update(pool_maxsize=cap, pool_block=True)
+            if prefix.startswith('https://') and hasattr(base, 'ssl_context'):
+                # 沿用cloudscraper的TLS配置
+                adapter = type(base)(ssl_context=base.ssl_context,
+                                     source_address=getattr(base, 'source_address', None), **options)
+            else:
+                adapter = HTTPAdapter(**options)
+            session.mount(prefix + '/', adapter)
+            previous = self.adapters.get(urlsplit(prefix).hostname)
+            if previous is not None:
+                previous.close()
+            self.adapters[urlsplit(prefix).hostname] = adapter
+
+    def set_task_concurrency(self, workers):
+        """批量任务的实际并发数超过构造时的估计时，按其重建连接池，避免连接用完即弃"""
+        if workers > self._task_workers:
+            self._task_workers = workers
+            self._configure_transport(self._transport_options)
+
+    def _record_connection_stats(self):
+        """把各主机连接池的请求数与新建连接数记入运行指标（两者之差即keep-alive复用次数）"""
+        for host, adapter in self.adapters.items():
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            requests_made = connections = 0
+            for manager in managers:
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        requests_made += pool.num_requests
+                        connections += pool.num_connections
+            if requests_made:
+                self.metrics.set('http_requests', requests_made, host=host)
+                self.metrics.set('http_connections', connections, host=host)
+
+    def _retry_download(self, error, attempt, attempts):
+        """下载失败后是否重新下载：HTTP状态错误已由连接层重试过（或为404等不可恢复错误），
+        内容校验失败、传输中断等按同样的指数退避重新下载"""
+        from requests import HTTPError
+        if isinstance(error, HTTPError):
+            status = getattr(error.response, 'status_code', 0) or 0
+            self._note_failure(400 <= status < 500 and status != 429)
+            return False
+        if attempt >= attempts - 1:
+            self._note_failure(False)
+            return False
+        wait = HTTP_BACKOFF * (2 ** attempt)
+        console.detail(f"{wait:.0f}秒后重试...")
+        self.metrics.incr('retries', kind='download')
+        with self.metrics.timer('retry_wait'):
+            time.sleep(wait)
+        return True
+
+    def _note_failure(self, permanent):
+        """记录本线程当前作品的下载失败类型：4xx（作品删除、不可见等）为不可恢复"""
+        setattr(self._download_failures, 'permanent' if permanent else 'transient', True)
+
+    def _failed_permanently(self):
+        """当前作品的失败是否全部不可恢复（重试也不会成功）"""
+        failures = self._download_failures
+        return getattr(failures, 'permanent', False) and not getattr(failures, 'transient', False)
+
     def _enable_api_debug(self):
         """修复版API调试钩子"""
         original_get = self.api.requests.get
@@ -481,32 +2055,181 @@ class PixivDownloader:
 
         self.api.requests.get = debug_wrapper
 
+    def _enable_api_rate_limit(self):
+        """为所有API接口加上全局限速（缓存命中的请求不占用配额）"""
+        limiter = self.rate_limiter
+        metrics = self.metrics
+
+        def make_wrapper(original):
+            def limited_call(*args, **kwargs):
+                with metrics.timer('rate_limit_wait'):
+                    limiter.wait()
+                with metrics.timer('api_request'):
+                    return original(*args, **kwargs)
+            return limited_call
+
+        for method in ('illust_ranking', 'user_following', 'user_illusts',
+                       'user_bookmarks_illust', 'search_illust', 'illust_follow',
+                       'illust_detail', 'ugoira_metadata'):
+            setattr(self.api, method, make_wrapper(getattr(self.api, method)))
+
+    def _enable_auth_refresh(self):
+        """访问令牌失效（invalid_grant）时同步重新认证并重试一次"""
+        auth = self.auth
+
+        def make_wrapper(original):
+            def refreshing_call(*args, **kwargs):
+                token = self.api.access_token
+                res = original(*args, **kwargs)
+                error = res.get('error') if isinstance(res, dict) else None
+                if error and 'invalid_grant' in str(error.get('message') or ''):
+                    print("访问令牌已失效，重新认证...")
+                    auth.refresh(stale_token=token)
+                    res = original(*args, **kwargs)
+                return res
+            return refreshing_call
+
+        for method in ('illust_ranking', 'user_following', 'user_illusts',
+                       'user_bookmarks_illust', 'search_illust', 'illust_follow',
+                       'illust_detail', 'ugoira_metadata'):
+            setattr(self.api, method, make_wrapper(getattr(self.api, method)))
+
+    def _enable_api_cache(self):
+        """为列表接口包装透明响应缓存"""
+        cache = self.api_cache
+
+        def make_wrapper(method, original):
+            def cached_call(*args, **kwargs):
+                if args:
+                    return original(*args, **kwargs)
+                body = cache.get(method, kwargs)
+                if body is not None:
+                    return self.api.parse_json(body)
+                res = original(**kwargs)
+                # 仅缓存正常响应（错误响应包含error字段）
+                if isinstance(res, dict) and 'error' not in res:
+                    cache.put(method, kwargs, json.dumps(res, ensure_ascii=False))
+                return res
+            return cached_call
+
+        for method in ('illust_ranking', 'user_following', 'user_illusts',
+                       'user_bookmarks_illust', 'search_illust', 'illust_follow'):
+            if cache.is_cacheable(method):
+                setattr(self.api, method, make_wrapper(method, getattr(self.api, method)))
+
+    @contextmanager
+    def _illust_claim(self, illust_id, page_idx):
+        """独占处理某个作品页：缓存检查、下载与写缓存在同一把锁内完成，避免并发任务重复下载"""
+        key = (illust_id, page_idx)
+        with self._claims_lock:
+            entry = self._claims.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._claims_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._claims[key]
+
+    def _adopt_cached_file(self, illust_id, page_idx, target_dir, priority, tags):
+        """作品已由较低优先级的任务下载时，把文件移到当前任务的目录而不是重新下载"""
+        entry = self.db.get_cache_entry(illust_id, page_idx)
+        if not entry or entry[1] >= priority:
+            return False
+        old_path = entry[0]
+        new_path = os.path.join(target_dir, os.path.basename(old_path))
+        if new_path != old_path:
+            try:
+                os.makedirs(target_dir, exist_ok=True)
+                os.replace(old_path, new_path)
+            except OSError as e:
+                console.detail(f"移动已缓存文件失败，改为重新下载: {str(e)}")
+                return False
+        try:
+            self.db.relocate_cache(illust_id, page_idx, priority, old_path, new_path, tags)
+        except sqlite3.Error:
+            os.replace(new_path, old_path)
+            return False
+        console.detail(f"⇨ 已缓存 [P{entry[1]}→P{priority}]，移动到: {new_path}")
+        return True
+
+    def _track_temp(self, temp_path):
+        """登记临时文件所在目录（每个目录每次运行只写一次数据库），返回原路径"""
+        directory = os.path.dirname(os.path.abspath(temp_path))
+        with self._temp_lock:
+            if directory in self._temp_dirs:
+                return temp_path
+            self._temp_dirs.add(directory)
+        self.db.register_temp_dir(directory)
+        return temp_path
+
     def clean_temp_files(self):
-        """清理残留临时文件"""
+        """清理以往运行登记过的目录中的残留临时文件"""
+        dirs = self.db.get_temp_dirs()
+        for directory in dirs:
+            try:
+                with os.scandir(directory) as entries:
+                    names = [e.name for e in entries if e.name.endswith('.tmp') and e.is_file()]
+            except OSError:
+                continue  # 目录已被删除
+            for name in names:
+                self._remove_temp_file(os.path.join(directory, name))
+        self.db.remove_temp_dirs(dirs)
+
+    def sweep_temp_files(self):
+        """遍历整个下载目录清理残留临时文件（维护命令，图库较大时耗时较长）"""
+        removed = 0
         for root, _, files in os.walk(self.root_dir):
             for f in files:
                 if f.endswith('.tmp'):
-                    temp_path = os.path.join(root, f)
-                    try:
-                        os.remove(temp_path)
-                        print(f"清理残留文件：{f}")
-                    except Exception as e:
-                        print(f"清理失败：{f} ({str(e)})")
+                    removed += self._remove_temp_file(os.path.join(root, f))
+        self.db.remove_temp_dirs(self.db.get_temp_dirs())
+        print(f"临时文件清理完成，共删除 {removed} 个文件")
 
-    def _get_illust_info(self, illust_id):
-        """带重试机制的详情获取"""
-        retry_count = 3
-        for attempt in range(retry_count):
-            try:
-                res = self.api.illust_detail(illust_id)
-                if res.illust and res.illust.id == illust_id:
-                    return res.illust
-                raise ValueError("Invalid illust response")
-            except Exception as e:
-                if attempt == retry_count - 1:
-                    print(f"获取作品信息失败：{illust_id} - {str(e)}")
-                    return None
-                time.sleep(2**attempt)
+    def _remove_temp_file(self, temp_path):
+        try:
+            os.remove(temp_path)
+            print(f"清理残留文件：{os.path.basename(temp_path)}")
+            return True
+        except Exception as e:
+            print(f"清理失败：{os.path.basename(temp_path)} ({str(e)})")
+            return False
+
+    def _remember_illusts(self, res):
+        """将列表接口返回的作品信息写入本地元数据库"""
+        illusts = getattr(res, 'illusts', None) if res else None
+        if illusts:
+            self.db.save_illust_meta(illusts)
+
+    def _get_illust_info(self, illust_id, version=None, fetch=True):
+        """作品详情：优先读取本地元数据（指定 version 时须版本一致），fetch为False时不请求接口"""
+        cached = self.db.load_illust_meta(illust_id, version)
+        if cached:
+            self.metrics.incr('cache_lookups', cache='meta', result='hit')
+            return self.api.parse_json(cached)
+        self.metrics.incr('cache_lookups', cache='meta', result='miss')
+        if not fetch:
+            return None
+
+        # 连接失败与429/5xx由连接层的Retry按退避重试，这里只请求一次
+        try:
+            res = self.api.illust_detail(illust_id)
+            if res.illust and res.illust.id == illust_id:
+                self.db.save_illust_meta([res.illust])
+                return res.illust
+            raise ValueError((res.get('error') or {}).get('message') or "Invalid illust response")
+        except Exception as e:
+            print(f"获取作品信息失败：{illust_id} - {str(e)}")
+            return None
+
+    def _is_cached_tag_filtered(self, illust_id, page_idx):
+        """已缓存作品的标签复查：优先使用本地元数据中的最新标签，没有时退回下载时记录的标签"""
+        info = self._get_illust_info(illust_id, fetch=False)
+        if info is None:
+            return self.db._is_tag_filtered(f"illust_{illust_id}_p{page_idx}", self.exclude_tags)
+        return bool(set(self._get_illust_tags(info)) & self.exclude_tags)
 
     def _get_illust_pages(self, illust):
         """统一分页索引生成规则（修复动图处理）"""
@@ -557,6 +2280,8 @@ class PixivDownloader:
 
     def _validate_file(self, path, expected_size=None):
         """增强版文件校验"""
+        import zipfile
+        from PIL import Image
         try:
             if not os.path.exists(path):
                 print(f"文件不存在: {path}")
@@ -580,6 +2305,8 @@ class PixivDownloader:
                 try:
                     with Image.open(path) as img:
                         img.verify()
+                    # verify()之后图像对象不可再解码，需重新打开
+                    with Image.open(path) as img:
                         img.load()
                         if img.width < 50 or img.height < 50:
                             print("无效的图片尺寸")
@@ -614,21 +2341,22 @@ class PixivDownloader:
             print(f"文件校验异常：{str(e)}")
             return False
 
+    def _illust_tag_set(self, illust):
+        """直接从列表载荷提取小写标签集合（过滤阶段专用，不访问数据库）"""
+        return frozenset(
+            (tag.get('name') or '').strip().lower() if isinstance(tag, dict) else str(tag).strip().lower()
+            for tag in (illust.tags or [])
+        )
+
     def _has_excluded_tags(self, illust):
         if not self.exclude_tags:
-            print("\n[标签检查] 当前未设置排除标签")
             return False
-
-        tags = self._get_illust_tags(illust)
-        illust_tags = set(tags)
-        
-        print(f"\n[标签检查] 作品标签：{illust_tags}", end="\n", flush=True)
-        print(f"[标签检查] 排除标签：{self.exclude_tags}", end="\n", flush=True)
-        
-        intersection = illust_tags & self.exclude_tags
-        if intersection:
-            print(f"发现屏蔽标签：{intersection}", end="\n", flush=True)
-        return bool(intersection)
+        illust_tags = self._illust_tag_set(illust)
+        if illust_tags.isdisjoint(self.exclude_tags):
+            return False
+        if DEBUG_API_RESPONSE:
+            print(f"[标签检查] 发现屏蔽标签：{set(illust_tags & self.exclude_tags)}", end="\n", flush=True)
+        return True
 
     def _is_manga(self, illust):
         """综合漫画检测策略"""
@@ -641,22 +2369,75 @@ class PixivDownloader:
         #     return True
             
         # 标签检测
-        tags = getattr(illust, 'tags', [])
-        if '漫画' in tags or 'manga' in tags:
-            return True            
-        return False
+        return not self._illust_tag_set(illust).isdisjoint(MANGA_TAGS)
 
     def _is_confirmed(self,illust,match_num):
 
         num = int(getattr(illust, 'total_bookmarks', 0))
         return num >= int(match_num)
 
+    @contextmanager
+    def _transfer(self, expected_size=0):
+        """登记一个进行中的传输，产出按块上报字节数的函数，由进度显示统一节流刷新"""
+        token = self.progress.start(expected_size)
+        transferred = [0]
+
+        def report(nbytes):
+            transferred[0] += nbytes
+            self.progress.update(token, nbytes)
+            self.bandwidth.consume(nbytes)
+
+        try:
+            with self.metrics.timer('download'):
+                yield report
+        finally:
+            self.progress.finish(token)
+            self.metrics.incr('downloaded_bytes', transferred[0])
+
+    def _stream_to_file(self, res, temp_path, expected_size, report):
+        """把响应体读入线程复用的缓冲区后直接写入临时文件，返回写入字节数
+
+        不经 iter_content 拼接分块；已知长度时预分配文件空间，单个传输的内存占用固定为一块缓冲
+        """
+        local = self._stream_buffers
+        if not hasattr(local, 'view'):
+            local.view = memoryview(bytearray(STREAM_BUFFER_SIZE))
+        view = local.view
+        raw = res.raw
+        if res.headers.get('Content-Encoding', 'identity') != 'identity':
+            raw.decode_content = True  # 压缩传输时由urllib3解码
+
+        written = 0
+        with open(temp_path, 'wb') as f:
+            if expected_size:
+                self._preallocate(f, expected_size)
+            while True:
+                n = raw.readinto(view)
+                if not n:
+                    break
+                f.write(view[:n])
+                written += n
+                report(n)
+            if expected_size and written != expected_size:
+                f.truncate(written)  # 去掉预分配多出的部分，由调用方按大小校验
+        return written
+
+    @staticmethod
+    def _preallocate(f, size):
+        """预分配文件空间（不支持时直接顺序写入）"""
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+        except OSError:
+            pass
+
     def _download_file(self, url, path, priority):
         """优化的文件下载方法（使用初始化参数）"""
-        temp_path = f"{path}.{os.getpid()}.tmp"
+        temp_path = self._track_temp(f"{path}.{os.getpid()}.tmp")
         expected_size = 0
         attempts = 3
-        retry_wait = [3, 8, 15]  # 优化重试间隔
         
         headers = self.headers.copy()
         headers['Referer'] = 'https://www.pixiv.net/'
@@ -679,52 +2460,35 @@ class PixivDownloader:
                         res.close()  # 主动关闭连接
 
                 # ==== 阶段2：准备下载 ====
-                print(f"\n开始下载 [{priority}]：{os.path.basename(path)}", end="\n", flush=True)
+                console.detail(f"开始下载 [{priority}]：{os.path.basename(path)}")
                 if DEBUG_API_RESPONSE:
                     size_info = (f"\n[DEBUG]{expected_size/1024:.1f}KB" if expected_size < 1024*1024*10 
                                 else f"{expected_size/1024/1024:.1f}MB")
-                    print(f"\n[DEBUG]文件大小: {size_info} | 分块大小: {self.chunk_size//1024}KB", end="\n", flush=True)
+                    print(f"\n[DEBUG]文件大小: {size_info} | 读缓冲: {STREAM_BUFFER_SIZE//1024}KB", end="\n", flush=True)
                     print(f"\n[DEBUG]预期大小：{expected_size//1024}KB", end="\n", flush=True)
 
-                downloaded = 0
-                
                 # ==== 阶段3：执行下载 ====
-                with self.api.requests.get(url, headers=headers, stream=True, timeout=30) as res:
+                with self.download_slots, self.api.requests.get(url, headers=headers, stream=True, timeout=30) as res, \
+                        self._transfer(expected_size) as report:
                     res.raise_for_status()
-                    
-                    with open(temp_path, 'wb') as f:
-                        for chunk in res.iter_content(chunk_size=self.chunk_size):
-                            if chunk:
-                                f.write(chunk)                   
-                                downloaded += len(chunk)
-                                
-                                  
-                                # 自动选择显示单位
-                                display_unit = 'MB' if downloaded > 1024*1024 else 'KB'
-                                display_size = downloaded/1024/1024 if display_unit == 'MB' else downloaded/1024                                  
-                                
-                                print(f"\r下载进度: {display_size:.2f}{display_unit}",end="", flush=True)
-
-                        # 写入剩余缓冲
-                        if self.write_buffer:
-                            f.write(self.write_buffer)
-                            self.write_buffer = b''
+                    self._stream_to_file(res, temp_path,
+                                         int(res.headers.get('Content-Length', 0)) or expected_size, report)
 
                 # 增强校验（包含大小和基本内容验证）
-                if not self._validate_file(temp_path, expected_size):
+                with self.metrics.timer('validation'):
+                    valid = self._validate_file(temp_path, expected_size)
+                if not valid:
                     raise ValueError("文件校验失败")
                 
-                os.replace(temp_path, path)
+                self.durability.commit(temp_path, path)
                 return True
 
             except Exception as e:
                 print(f"下载失败（尝试 {attempt+1}/{attempts}）：{str(e)}", end="\n", flush=True)
                 if os.path.exists(temp_path):
                     os.remove(temp_path)
-                if attempt < attempts-1:
-                    wait = retry_wait[attempt]
-                    print(f"{wait}秒后重试...", end="\n", flush=True)
-                    time.sleep(wait)
+                if not self._retry_download(e, attempt, attempts):
+                    break
         
         print(f"无法完成下载：{os.path.basename(path)}")
         return False
@@ -732,130 +2496,81 @@ class PixivDownloader:
     def convert_image(self, original_path):
         """根据配置转换图像格式（支持original保留原格式）"""
         try:
+            target = resolve_output_format(self.output_formats)
             # 如果配置为original则直接返回
-            if str(self.output_formats).lower().strip() == "original":
-                print(f"\n保留原始格式: {os.path.basename(original_path)}", end="\n", flush=True)
+            if target is None:
+                console.detail(f"保留原始格式: {os.path.basename(original_path)}")
                 return [original_path]
 
-            # ================= 格式配置处理 =================
-            FORMAT_MAPPING = {
-                'jpg': ('JPEG', '.jpg', 'RGB'),
-                'j': ('JPEG', '.jpg', 'RGB'),
-                'webp': ('WEBP', '.webp', 'RGB'),
-                'w': ('WEBP', '.webp', 'RGB'),
-                'png': ('PNG', '.png', 'RGBA'),
-                'p': ('PNG', '.png', 'RGBA')
-            }
-
-            # 统一配置处理（支持字符串和列表）
-            raw_format = self.output_formats
-            if isinstance(raw_format, list) and len(raw_format) > 0:
-                fmt = str(raw_format[0]).lower().strip()
-            else:
-                fmt = str(raw_format).lower().strip()
-
-            # 处理格式别名
-            fmt = {'g': 'jpg', 'j': 'jpg', 'w': 'webp', 'p': 'png'}.get(fmt, fmt)
-            
-            # 获取目标格式参数
-            if fmt in FORMAT_MAPPING:
-                pillow_fmt, file_ext, color_mode = FORMAT_MAPPING[fmt]
-                print(f"\n目标格式: {fmt.lower()}")
-            else:
-                print(f"无效格式配置: {fmt}，使用默认JPG")
-                pillow_fmt, file_ext, color_mode = FORMAT_MAPPING['jpg']
+            # 安全保存
+            output_path = converted_path(original_path, target)
+            temp_path = self._track_temp(f"{output_path}.tmp")
+            try:
+                render_image(original_path, temp_path, target, self.quality)
+                self.durability.commit(temp_path, output_path)
+                console.detail(f"转换成功: {os.path.basename(output_path)}")
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
 
-            # ================= 核心转换逻辑 =================
-            base_name = os.path.splitext(original_path)[0]
-            output_path = f"{base_name}{file_ext}"
-            
-            with Image.open(original_path) as img:
-                # 透明度处理
-                if img.mode in ('RGBA', 'LA') and color_mode == 'RGB':
-                    print("处理透明度通道", end="\n", flush=True)
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[-1])
-                    convert_img = background
-                else:
-                    convert_img = img
-
-                # 色彩模式转换
-                if convert_img.mode != color_mode:
-                    print(f"转换色彩模式: {convert_img.mode} → {color_mode}", end="\n", flush=True)
-                    convert_img = convert_img.convert(color_mode)
-
-                # 保存参数
-                save_params = {}
-                if pillow_fmt == 'JPEG':
-                    quality = min(max(self.quality, 10), 95)
-                    save_params = {
-                        'quality': quality,
-                        'optimize': True,
-                        'subsampling': 0  # 强制使用4:4:4避免报错
-                    }
-                    print(f"JPEG质量参数: Q{quality}")
-                elif pillow_fmt == 'WEBP':
-                    save_params['quality'] = min(self.quality, 100)
-                
-                # 安全保存
-                temp_path = f"{output_path}.tmp"
+            # 清理原文件（仅当扩展名不同时）
+            if output_path != original_path:
                 try:
-                    convert_img.save(temp_path, format=pillow_fmt, **save_params)
-                    os.replace(temp_path, output_path)
-                    print(f"转换成功: {os.path.basename(output_path)}", end="\n", flush=True)
-                finally:
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
-
-                # 清理原文件（仅当扩展名不同时）
-                if not original_path.endswith(file_ext):
-                    try:
-                        os.remove(original_path)
-                    except Exception as e:
-                        print(f"删除原文件失败: {str(e)}", end="\n", flush=True)
+                    self.durability.remove(original_path)
+                except Exception as e:
+                    print(f"删除原文件失败: {str(e)}", end="\n", flush=True)
 
-                return [output_path]
+            return [output_path]
 
         except Exception as e:
             print(f"转换失败: {str(e)}", end="\n", flush=True)
             return []
     
     def download_image(self, illust, page_idx, url, save_path, priority):
+        """下载单页图片（同一作品页同一时刻只由一个任务处理）"""
+        with self._illust_claim(illust.id, page_idx):
+            return self._download_image(illust, page_idx, url, save_path, priority)
+
+    def _download_image(self, illust, page_idx, url, save_path, priority):
         """修改后的下载方法（包含格式转换）"""
         illust_id = None
         try:
             illust_id = illust.id
             tags = self._get_illust_tags(illust)
             
-            cache_key = f"illust_{illust_id}_{page_idx}"
-            
             # 检查缓存有效性
             if self.db.check_cache(illust_id, page_idx, priority):
-                if self.db._is_tag_filtered(cache_key, self.exclude_tags):
+                if self._is_cached_tag_filtered(illust_id, page_idx):
                     print(f"⇩ 删除过期缓存（标签变更）", end="\n", flush=True)
                     self.db.delete_cache(illust_id, page_idx)
                     return False
                 else:
-                    print(f"⇩ 已缓存 [P{priority}]: {os.path.basename(save_path)}", end="\n", flush=True)
-                    return False
+                    console.detail(f"⇩ 已缓存 [P{priority}]: {os.path.basename(save_path)}")
+                    return True
+            if self._adopt_cached_file(illust_id, page_idx, os.path.dirname(save_path), priority, tags):
+                return True
                 
             # 执行下载
             if self._download_file(url, save_path, priority):
+                if self.convert_queue:
+                    # 原图立即入库，格式转换交给 convert-worker 后台完成
+                    if self.db.update_cache(illust_id, page_idx, priority, save_path, tags):
+                        self.db.enqueue_conversions([save_path])
+                    console.detail(f"下载成功，已加入转换队列: {os.path.basename(save_path)}")
+                    return True
+
                 # 转换格式
                 converted_files = []
                 if self.output_formats:
-                    converted_files = self.convert_image(save_path)
+                    with self.metrics.timer('conversion'):
+                        converted_files = self.convert_image(save_path)
                 
-                # 确定最终缓存路径
-                final_path = save_path
-                if converted_files:
-                    # 如果原始文件被删除，使用第一个转换格式作为缓存路径
-                    if not os.path.exists(save_path):
-                        final_path = converted_files[0]
+                # 确定最终缓存路径（原图可能要等本批次落盘后才删除，不能按是否存在判断）
+                final_path = converted_files[0] if converted_files else save_path
                         
                 # 更新缓存
                 self.db.update_cache(illust_id, page_idx, priority, final_path, tags)
-                print(f"下载成功")
+                console.detail(f"下载成功: {os.path.basename(final_path)}")
                 return True
             return False
                   
@@ -868,33 +2583,28 @@ class PixivDownloader:
             return False
 
     def download_ugoira(self, illust, save_dir, priority):
+        """下载动图（与单页图片共用第0页的独占锁）"""
+        with self._illust_claim(illust.id, 0):
+            return self._download_ugoira(illust, save_dir, priority)
+
+    def _download_ugoira(self, illust, save_dir, priority):
         """基于最新CDN路径的动图下载方法（增强错误处理和日志）"""
+        import zipfile
+        from dateutil import parser
         try:
             illust_id = illust.id
-            cache_key = f"illust_{illust_id}_p0"
-            
-            # 优先检查缓存（增加文件有效性验证）
-            if self.db.check_cache(illust_id, 0, priority):
-                cached_path = os.path.join(save_dir, f"{illust_id}.gif")
-                if os.path.exists(cached_path):
-                    print(f"⇩ 已缓存动图 [P{priority}]: {illust_id}", end="\n", flush=True)
-                    return True
-                else:
-                    self.db.delete_cache(cache_key)
-
-            print(f"\n▶ 开始处理动图作品：{illust_id}", end="\n", flush=True)
             
-            # 增强元数据获取（带重试机制）
-            metadata = None
-            for _ in range(3):
-                try:
-                    metadata = self.api.ugoira_metadata(illust_id)
-                    if metadata and hasattr(metadata, 'ugoira_metadata'):
-                        break
-                except Exception as e:
-                    print(f"获取元数据失败（重试{_+1}/3）: {str(e)}", end="\n", flush=True)
-                    time.sleep(2)
+            # 优先检查缓存（check_cache 已校验记录中的文件存在且大小一致，可能位于其他任务的目录）
+            if self.db.check_cache(illust_id, 0, priority):
+                console.detail(f"⇩ 已缓存动图 [P{priority}]: {illust_id}")
+                return True
+            if self._adopt_cached_file(illust_id, 0, save_dir, priority, self._get_illust_tags(illust)):
+                return True
+
+            console.detail(f"▶ 开始处理动图作品：{illust_id}")
             
+            # 获取动图元数据（暂时性失败由连接层的Retry重试）
+            metadata = self.api.ugoira_metadata(illust_id)
             if not metadata or not hasattr(metadata, 'ugoira_metadata'):
                 raise ValueError("无法获取ugoira元数据，可能API响应结构变化")
             
@@ -916,7 +2626,7 @@ class PixivDownloader:
             resolutions = ['1920x1080', '1200x1200', '600x600']
             zip_url = None
             for res in resolutions:
-                test_url = f"https://i.pximg.net/img-zip-ugoira/img/{date_path}/{illust_id}_ugoira{res}.zip"
+                test_url = f"{self.pximg_host}/img-zip-ugoira/img/{date_path}/{illust_id}_ugoira{res}.zip"
                 if self.api.requests.head(test_url, headers=self.headers).status_code == 200:
                     zip_url = test_url
                     break
@@ -926,7 +2636,7 @@ class PixivDownloader:
 
             # 下载ZIP文件（增强校验）
             zip_path = os.path.join(save_dir, f"{illust_id}.zip")
-            print(f"下载动图ZIP: {zip_url}")
+            console.detail(f"下载动图ZIP: {zip_url}")
             if not self._download_with_retry(zip_url, zip_path, self.headers, priority):
                 raise ValueError("ZIP文件下载失败")
 
@@ -958,14 +2668,17 @@ class PixivDownloader:
 
                 # 生成GIF（增强参数校验）
                 gif_path = os.path.join(save_dir, f"{illust_id}.gif")
-                self._create_animated_gif(temp_dir, frames, gif_path)
+                with self.metrics.timer('gif'):
+                    self._create_animated_gif(temp_dir, frames, gif_path)
                 
                 # 严格验证输出文件
                 if not os.path.exists(gif_path) or os.path.getsize(gif_path) < 1024:
                     raise ValueError("生成的GIF文件无效")
                 
                 # 更新缓存（增加文件校验）
-                if self._validate_file(gif_path):
+                with self.metrics.timer('validation'):
+                    valid = self._validate_file(gif_path)
+                if valid:
                     self.db.update_cache(illust_id, 0, priority, gif_path, self._get_illust_tags(illust))
                     return True
                 return False
@@ -990,47 +2703,43 @@ class PixivDownloader:
 
     def _download_with_retry(self, url, path, headers, priority, retries=3):
         """带CDN刷新的下载器"""
-        temp_path = f"{path}.tmp"
+        temp_path = self._track_temp(f"{path}.tmp")
         for attempt in range(retries):
             try:
                 # 每次尝试添加不同随机参数
                 final_url = f"{url}?rand={random.randint(1000,9999)}" if attempt > 0 else url
                 
-                with self.api.requests.get(final_url, headers=headers, stream=True, timeout=30) as res:
+                with self.download_slots, self.api.requests.get(final_url, headers=headers, stream=True, timeout=30) as res:
                     res.raise_for_status()
                     total_size = int(res.headers.get('Content-Length', 0))
 
-                    print(f"\n开始下载 [{priority}]：{os.path.basename(path)}", end="\n", flush=True)
-                    print(f"最终地址: {res.url}", end="\n", flush=True)  # 显示实际下载地址
-                    print(f"预期大小: {total_size//1024}KB", end="\n", flush=True)
+                    console.detail(f"开始下载 [{priority}]：{os.path.basename(path)}")
+                    console.detail(f"最终地址: {res.url}")  # 显示实际下载地址
+                    console.detail(f"预期大小: {total_size//1024}KB")
 
-                    downloaded = 0
-                    with open(temp_path, 'wb') as f:
-                        for chunk in res.iter_content(chunk_size=1024*1024):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded += len(chunk)
-                                print(f"\r下载进度：{downloaded/1024/1024:.2f}MB", end="", flush=True)
+                    with self._transfer(total_size) as report:
+                        downloaded = self._stream_to_file(res, temp_path, total_size, report)
 
                     # 严格校验
                     if total_size > 0 and abs(downloaded - total_size) > 1024:
                         raise ValueError(f"大小差异超过1KB: {downloaded} vs {total_size}")
                     
-                    os.replace(temp_path, path)
-                    print(f"\n载成功!", end="\n", flush=True)
+                    self.durability.commit(temp_path, path)
+                    console.detail(f"下载成功: {os.path.basename(path)}")
                     return True
 
             except Exception as e:
                 print(f"\n下载失败（尝试 {attempt+1}/{retries}）: {str(e)}", end="\n", flush=True)
                 if os.path.exists(temp_path):
                     os.remove(temp_path)
-                time.sleep([2, 5, 10][attempt])
+                if not self._retry_download(e, attempt, retries):
+                    break
         
         return False
 
     def _download_ugoira_file(self, url, path, illust_id, priority):
         """动图专用下载方法"""
-        temp_path = f"{path}.ugoira.tmp"
+        temp_path = self._track_temp(f"{path}.ugoira.tmp")
         headers = {
             'Referer': f'https://www.pixiv.net/artworks/{illust_id}',
             'User-Agent': 'PixivAndroidApp/5.0.234 (Android 11; Pixel 5)',
@@ -1042,21 +2751,16 @@ class PixivDownloader:
                 if os.path.exists(temp_path):
                     os.remove(temp_path)
 
-                with self.api.requests.get(url, headers=headers, stream=True, timeout=30) as res:
+                with self.download_slots, self.api.requests.get(url, headers=headers, stream=True, timeout=30) as res:
                     res.raise_for_status()
                     total_size = int(res.headers.get('Content-Length', 0))
 
-                    print(f"\n开始下载 [{priority}]：{os.path.basename(path)}", end="\n", flush=True)
-                    print(f"来源URL: {res.url}", end="", flush=True)  # 显示最终重定向URL
-                    print(f"预期大小：{total_size//1024}KB", end="\n", flush=True)
+                    console.detail(f"开始下载 [{priority}]：{os.path.basename(path)}")
+                    console.detail(f"来源URL: {res.url}")  # 显示最终重定向URL
+                    console.detail(f"预期大小：{total_size//1024}KB")
 
-                    downloaded = 0
-                    with open(temp_path, 'wb') as f:
-                        for chunk in res.iter_content(chunk_size=1024*1024):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded += len(chunk)
-                                print(f"\r下载进度：{downloaded/1024/1024:.2f}MB", end="", flush=True)
+                    with self._transfer(total_size) as report:
+                        downloaded = self._stream_to_file(res, temp_path, total_size, report)
 
                     # 严格校验文件
                     if total_size > 0 and downloaded != total_size:
@@ -1064,21 +2768,23 @@ class PixivDownloader:
                     if downloaded < 1024*100:  # 小于100KB视为无效
                         raise ValueError("文件大小异常")
 
-                    os.replace(temp_path, path)
-                    print(f"\n下载成功 [{priority}]: {os.path.basename(path)}", end="\n", flush=True)
+                    self.durability.commit(temp_path, path)
+                    console.detail(f"下载成功 [{priority}]: {os.path.basename(path)}")
                     return True
 
             except Exception as e:
                 print(f"\n下载失败（尝试 {attempt+1}/3）: {str(e)}", end="\n", flush=True)
                 if os.path.exists(temp_path):
                     os.remove(temp_path)
-                time.sleep([5, 15, 30][attempt])
+                if not self._retry_download(e, attempt, 3):
+                    break
         
         return False
 
     def _create_animated_gif(self, temp_dir, frames, output_path):
         """优化版GIF生成（修复延迟处理）"""
-        print(f"生成GIF动画：{output_path}")
+        from PIL import Image
+        console.detail(f"生成GIF动画：{output_path}")
         
         # 确保输出路径使用.gif扩展名
         output_path = os.path.splitext(output_path)[0] + '.gif'
@@ -1107,7 +2813,7 @@ class PixivDownloader:
                     delays.append(delay // 10)  # 转换为百分秒
 
             # 两阶段保存优化
-            temp_path = f"{output_path}.tmp"
+            temp_path = self._track_temp(f"{output_path}.tmp")
             
             # 使用优化参数
             images[0].save(
@@ -1129,8 +2835,8 @@ class PixivDownloader:
                 raise ValueError("生成的GIF文件过小")
                 
             # 原子操作替换文件
-            os.replace(temp_path, output_path)
-            print(f"GIF生成成功，大小：{os.path.getsize(output_path)//1024}KB", end="\n", flush=True)
+            self.durability.commit(temp_path, output_path)
+            console.detail(f"GIF生成成功，大小：{os.path.getsize(output_path)//1024}KB")
             
         except Exception as e:
             if os.path.exists(temp_path):
@@ -1168,984 +2874,742 @@ class PixivDownloader:
             clean_username = clean_username[:50]
         return clean_username
 
-    def download_user_illusts(self, target_user_id, username):
-        try:
-            # 增强用户名清洗逻辑（新增）
-            clean_username = self._sanitize_name(username,target_user_id)
+    # ================= 通用下载流水线 =================
+    def _iter_pages(self, method, qs, pinned=None, retries=3, max_offset=None, status=None):
+        """惰性翻页生成器：逐页产出响应，qs 在翻页时原地更新，便于随时保存进度
 
-            save_dir = os.path.join(self.following_dir, f"{clean_username}_{target_user_id}")
-            
-            try:  # 新增目录创建验证
-                os.makedirs(save_dir, exist_ok=True)
-                # 验证目录是否实际存在（新增）
-                if not os.path.isdir(save_dir):
-                    raise OSError(f"Directory creation failed: {save_dir}")
-            except OSError as e:
-                print(f"无法创建目录 {save_dir}: {str(e)}", end="\n", flush=True)
-                return
+        max_offset: 接口偏移上限，下一页超过上限时停止并在 status['saturated'] 中标记
+        """
+        while True:
+            res = None
+            for attempt in range(retries):
+                res = method(**qs)
+                if res and res.illusts is not None:
+                    break
+                error = (res or {}).get('error') or {}
+                message = str(error.get('message') or error.get('user_message') or error)
+                if 'rate limit' in message.lower():
+                    print(f"触发API限流，60秒后重试（{attempt+1}/{retries}）")
+                    self.metrics.incr('retries', kind='api_rate_limit')
+                    with self.metrics.timer('retry_wait'):
+                        time.sleep(60)
+                elif error:
+                    print(f"API返回错误，停止翻页: {message}")
+                    return
+                else:
+                    print(f"API响应异常，等待重试（{attempt+1}/{retries}）...")
+                    self.metrics.incr('retries', kind='api')
+                    with self.metrics.timer('retry_wait'):
+                        time.sleep(5)
+            else:
+                raise ValueError("API响应异常，已达最大重试次数")
 
-            user_id_str = str(target_user_id)
-            progress_data = self.db.load_progress(user_id_str) or {}
-            current_qs = progress_data.get('next_qs') or {'user_id': target_user_id,"filter": "for_android"}
-            downloaded_ids = set(progress_data.get('downloaded_ids', []))
-            total = skipped_cache = skipped_tag = skipped_manga = success = 0
+            self._remember_illusts(res)
+            yield res
 
-            if progress_data:
-                print(f"继续上次进度 (已下载 {len(downloaded_ids)} 个作品)")
-            
-            while True:
-                try:                       
-                    # 获取作品列表
-                    res = self.api.user_illusts(**current_qs)
-                    if not res.illusts:
-                        print("没有更多作品")
-                        self.db.clear_progress(user_id_str)
-                        break
-                 
-                    has_new_content = False 
+            next_qs = self.api.parse_qs(res.next_url) if res.next_url else None
+            if not next_qs:
+                return
+            if max_offset and int(next_qs.get('offset') or 0) >= max_offset:
+                if status is not None:
+                    status['saturated'] = True
+                return
+            qs.update(next_qs)
+            if pinned:
+                qs.update(pinned)
 
-                    for illust in res.illusts:
-                        try:
-                            if illust.is_deleted:
-                                continue
+    def _tag_filter(self):
+        return ('tag', '屏蔽标签', self._has_excluded_tags)
 
-                            illust_id = illust.id
-                            total += 1
+    def _manga_filter(self):
+        return ('manga', '漫画', self._is_manga)
 
-                            # 严格缓存检查
-                            pages = self._get_illust_pages(illust)
-                            has_valid_cache = all(
-                                self.db.check_cache(illust_id, idx, 9)
-                                for idx in range(len(pages)))
-                            
-                            if has_valid_cache:
-                                if illust_id not in downloaded_ids:
-                                    downloaded_ids.add(illust_id)
-                                    skipped_cache += 1
-                                    print(f"⇩ 发现缓存作品 {illust_id}，更新进度")
-                                    self.db.save_progress(user_id_str, {
-                                        'next_qs': current_qs,
-                                        'downloaded_ids': list(downloaded_ids)
-                                    })
-                                continue                   
-   
-                            if self._has_excluded_tags(illust):
-                                print(f"排除含屏蔽标签作品：{illust_id}", end="\n", flush=True)
-                                skipped_tag += 1
-                                continue
-
-                            # 漫画类型处理
-                            if self.exclude_manga and illust.type == 'manga':
-                                print(f"跳过漫画作品：{illust_id}", end="\n", flush=True)
-                                skipped_manga += 1
-                                continue
-                            
-                            download_success = True
-                            has_new_content = True 
-
-                            # 动图类型处理
-                            if illust.type == 'ugoira':
-                                if not self.download_ugoira(illust, save_dir, 9):  # 日志在download_ugoira中打印
-                                    download_success = False
-                            else:                                              
-                                # ===== 普通图片处理 =====
-                                for idx, url in enumerate(pages):
-                                    if not url:
-                                        print(f"关注作品{illust_id}URL无效")                               
-                                    fname = os.path.basename(url)
-                                    save_path = os.path.join(save_dir, fname)
-                                    if not self.download_image(illust, idx, url, save_path, 9):
-                                        download_success = False
-                                        break                                   
-                            
-                            # ===== 新增：立即保存进度 =====
-                            if download_success:
-                                downloaded_ids.add(illust_id)
-                                success +=1
-                                self.db.save_progress(user_id_str, {
-                                    'next_qs': current_qs,
-                                    'downloaded_ids': list(downloaded_ids)
-                                })
-                            
-                            time.sleep(self.request_interval)
-
-                        except Exception as e:
-                            print(f"作品 {illust_id}处理失败: {str(e)}")
-
-                    # 修改后的进度保存逻辑
-                    next_qs = self.api.parse_qs(res.next_url) if res.next_url else None
-                    if next_qs:
-                        current_qs.update(next_qs)
-                        current_qs['user_id'] = target_user_id
-                        if has_new_content:
-                            print("保存分页进度")
-                            self.db.save_progress(user_id_str, {
-                                'next_qs': current_qs,
-                                'downloaded_ids': list(downloaded_ids)
-                            })
-                    else:
-                        if len(downloaded_ids) > 0:
-                                print(f"所有分页已完成，清除进度")
-                                self.db.clear_progress(user_id_str)      
-                        break
+    def _ai_filter(self):
+        return ('ai', 'AI', lambda illust: illust.illust_ai_type == 2)
 
-                except KeyboardInterrupt:
-                    print("\n用户中断，保存当前进度")
-                    self.db.save_progress(user_id_str, {
-                        'next_qs': current_qs,
-                        'downloaded_ids': list(downloaded_ids)
-                    })
-                    break
+    def _r18_filter(self):
+        # x_restrict: 0全年龄 1R-18 2R-18G
+        return ('r18', 'R-18', lambda illust: bool(illust.x_restrict)
+                or 'r-18' in self._illust_tag_set(illust))
 
-            print(f"用户 {clean_username} 下载统计:")
-            print(f"- 总作品数: {total}")
-            print(f"- 成功数: {success}")
-            print(f"- 跳过已缓存作品数: {skipped_cache}")
-            print(f"- 跳过屏蔽作品数: {skipped_tag}")           
-            if self.exclude_manga:
-                print(f"- 跳过漫画作品数: {skipped_manga}")
+    def _bookmark_filter(self, match_num):
+        return ('bookmark', '收藏数不足', lambda illust: not self._is_confirmed(illust, match_num))
 
-        except Exception as e:
-            print(f"用户作品下载失败: {str(e)}")
-            self.db.save_progress(user_id_str, {
-                'next_qs': current_qs,
-                'downloaded_ids': list(downloaded_ids)
-            })
+    def _save_illust(self, illust, pages, save_dir, priority):
+        """默认落地方式：动图走GIF流程，普通作品逐页下载"""
+        if illust.type == 'ugoira':
+            return self.download_ugoira(illust, save_dir, priority)
 
-    def download_following_new(self):
-        """从关注用户的新作品专用接口下载"""
-        try:           
-            jst = datetime.timezone(datetime.timedelta(hours=9))
-            now_jst = datetime.datetime.now(jst)
-            ranking_date = now_jst.date() - datetime.timedelta(days=1) if now_jst.hour < 12 else now_jst.date()
-            date_str = ranking_date.strftime('%Y-%m-%d')
+        download_success = True
+        for idx, url in enumerate(pages):
+            if not url:
+                print(f"作品{illust.id}第{idx}页URL无效")
+                download_success = False
+                continue
+            save_path = os.path.join(save_dir, os.path.basename(url))
+            if not self.download_image(illust, idx, url, save_path, priority):
+                download_success = False
+        return download_success
+
+    def _is_illust_cached(self, illust, pages, priority):
+        """作品全部页面均已有效缓存（动图按第0页判断）"""
+        if illust.type == 'ugoira':
+            return self.db.check_cache(illust.id, 0, priority)
+        return bool(pages) and all(
+            self.db.check_cache(illust.id, idx, priority)
+            for idx in range(len(pages)))
+
+    def _load_job_progress(self, progress_key, default_qs):
+        """读取任务进度，返回 (进度字典, 当前分页参数, 已下载ID集合)"""
+        progress_data = self.db.load_progress(progress_key) or {}
+        current_qs = progress_data.get('next_qs') or dict(default_qs)
+        downloaded_ids = set(progress_data.get('downloaded_ids', []))
+        if progress_data:
+            print(f"继续上次进度 (已下载 {len(downloaded_ids)} 个作品)")
+        return progress_data, current_qs, downloaded_ids
+
+    def _run_pipeline(self, label, progress_key, method, qs, pinned=None,
+                      filters=(), save_dir=None, sink=None, priority=9,
+                      max_items=None, stop_at=None, state=None,
+                      downloaded_ids=None, count_resumed=False,
+                      clear_on_finish=True, on_progress=None, max_offset=None):
+        """分页源 → 过滤阶段 → 落地（sink）的通用下载流程
+
+        filters: (名称, 显示名, 判定函数) 元组序列，判定函数返回True表示排除
+        save_dir: 保存目录，或根据作品返回目录的函数
+        sink: 自定义落地函数 sink(illust, pages) -> bool，默认按 save_dir 下载
+        stop_at: 作品ID不大于该值时停止翻页（增量同步水位线）
+        state: 需要随进度一起保存的附加字段
+        on_progress: 自定义进度保存函数（多个流水线共享一条进度记录时使用）
+        max_offset: 接口偏移上限，达到时 stats['saturated'] 为True
+        """
+        downloaded_ids = downloaded_ids if downloaded_ids is not None else set()
+        state = state if state is not None else {}
+        if sink is None:
+            def sink(illust, pages):
+                target_dir = save_dir(illust) if callable(save_dir) else save_dir
+                os.makedirs(target_dir, exist_ok=True)
+                return self._save_illust(illust, pages, target_dir, priority)
+
+        stats = {'total': len(downloaded_ids) if count_resumed else 0,
+                 'success': 0, 'skipped_cache': 0, 'failed': 0, 'failed_permanent': 0}
+        for name, _, _ in filters:
+            stats[f'skipped_{name}'] = 0
+            stats[f'saved_{name}'] = 0  # 被该阶段排除而省去的页面数
+        stats.update({'newest': state.get('newest'), 'oldest': None, 'saturated': False,
+                      'finished': False, 'interrupted': False})
+        page_status = {}
+
+        def progress():
+            data = dict(state)
+            data.update({'next_qs': qs, 'downloaded_ids': list(downloaded_ids)})
+            return data
+
+        def persist(data):
+            if on_progress:
+                on_progress(data)
+            else:
+                self.db.save_progress(progress_key, data)
 
-            save_dir = self.following_dir
-            os.makedirs(save_dir, exist_ok=True)
+        def save_progress():
+            persist(progress())
 
-            user_id_str = f"following_new_{date_str}"
-            progress_data = self.db.load_progress(user_id_str) or {}
-            current_qs = progress_data.get('next_qs') or {}
-            downloaded_ids = set(progress_data.get('downloaded_ids', []))
-            
-            print(f"\n▶ 正在下载 关注用户新作品")
-            if progress_data:
-                print(f"继续上次进度 (已下载 {len(downloaded_ids)} 个作品)")        
-
-            next_qs = {'restrict': 'public'} 
-            total = len(downloaded_ids)
-            success = 0
-            skipped_cache = skipped_tag = skipped_manga = 0 
-            
-            while total < self.follow_max:
-                try:
-                    res = self.api.illust_follow(**current_qs)
-                    if not res.illusts:
-                        break
-                        
-                    has_new_content = False
-
-                    # 按用户分组作品
-                    user_works = {}
-                    for illust in res.illusts:
-                        user_id = illust.user.id
-                        if user_id not in user_works:
-                            user_works[user_id] = {
-                                'name': illust.user.name,
-                                'works': []
-                            }
-                        user_works[user_id]['works'].append(illust)
-                    
-                    # 为每个用户创建目录并下载
-                    for uid, data in user_works.items():
-                        user_dir = os.path.join(save_dir, f"{self._sanitize_name(data['name'],uid)}_{uid}")
-                        os.makedirs(user_dir, exist_ok=True)
-                        
-                        for illust in data['works']:
-                            try:
-                                if illust.is_deleted:
-                                    continue
-
-                                illust_id = illust.id
-                                total += 1
-
-                                pages = self._get_illust_pages(illust)
-                                has_valid_cache = all(
-                                    self.db.check_cache(illust_id, idx, 9)
-                                    for idx in range(len(pages)))
-                                
-                                if has_valid_cache:
-                                    if illust_id not in downloaded_ids:
-                                        downloaded_ids.add(illust_id)
-                                        skipped_cache += 1
-                                        print(f"⇩ 发现缓存作品 {illust_id}，更新进度")
-                                        self.db.save_progress(user_id_str, {
-                                            'next_qs': current_qs,
-                                            'downloaded_ids': list(downloaded_ids)
-                                        })                                
-                                        continue
-
-                                if self._has_excluded_tags(illust):
-                                    print(f"排除含屏蔽标签作品：{illust_id}")
-                                    skipped_tag += 1
-                                    continue
-
-                                if self.exclude_manga and self._is_manga(illust):
-                                    print(f"跳过漫画作品：{illust_id}", end="\n", flush=True)
-                                    skipped_manga += 1
-                                    continue
-                    
+        try:
+            for res in self._iter_pages(method, qs, pinned, max_offset=max_offset, status=page_status):
+                if not res.illusts:
+                    break
 
-                                download_success = True
+                has_new_content = False
+                limit_reached = reached_mark = False
+                for illust in res.illusts:
+                    illust_id = illust.id
+                    try:
+                        if illust.is_deleted:
+                            continue
+                        if stop_at and illust_id <= stop_at:
+                            reached_mark = True
+                            break
+                        if stats['newest'] is None or illust_id > stats['newest']['illust_id']:
+                            stats['newest'] = state['newest'] = {
+                                'illust_id': illust_id, 'create_date': illust.create_date}
+                        if stats['oldest'] is None or illust_id < stats['oldest']['illust_id']:
+                            stats['oldest'] = {'illust_id': illust_id, 'create_date': illust.create_date}
+                        stats['total'] += 1
+
+                        # 过滤阶段只读取列表载荷，被排除的作品不会产生数据库或文件访问
+                        rejected = next((f for f in filters if f[2](illust)), None)
+                        if rejected:
+                            console.detail(f"排除{rejected[1]}作品：{illust_id}")
+                            stats[f'skipped_{rejected[0]}'] += 1
+                            stats[f'saved_{rejected[0]}'] += illust.page_count or 1
+                        else:
+                            pages = self._get_illust_pages(illust)
+                            if self._is_illust_cached(illust, pages, priority):
+                                if illust_id not in downloaded_ids:
+                                    downloaded_ids.add(illust_id)
+                                    stats['skipped_cache'] += 1
+                                    console.detail(f"⇩ 发现缓存作品 {illust_id}，更新进度")
+                                    save_progress()
+                            else:
                                 has_new_content = True
-
-                                if illust.type == 'ugoira':
-                                    if not self.download_ugoira(illust, user_dir, 9):
-                                        download_success = False                        
-                                else:                              
-                                    for idx, url in enumerate(pages):
-                                        if not url:
-                                            print(f"作品{illust_id}URL无效")   
-                                            continue
-                                        fname = os.path.basename(url)
-                                        save_path = os.path.join(user_dir, fname)
-                                        if not self.download_image(illust, idx, url, save_path, 9):
-                                            download_success = False
-                
-                                if download_success:
+                                vars(self._download_failures).clear()
+                                if sink(illust, pages):
                                     downloaded_ids.add(illust_id)
-                                    success += 1
-                                    self.db.save_progress(user_id_str, {
-                                        'next_qs': current_qs,
-                                        'downloaded_ids': list(downloaded_ids)
-                                    })
-
-                                if total >= self.follow_max:
-                                    print(f"达到最大数量限制 {self.follow_max}")
-                                    break  
-
-                                time.sleep(self.request_interval)
-
-                            except Exception as e:
-                                print(f"处理作品失败 {illust.id}: {str(e)}", end="\n", flush=True)
+                                    stats['success'] += 1
+                                    save_progress()
+                                else:
+                                    stats['failed'] += 1
+                                    if self._failed_permanently():
+                                        stats['failed_permanent'] += 1
+                                with self.metrics.timer('request_interval'):
+                                    time.sleep(self.request_interval)
 
-                        if total >= self.follow_max:
-                            break  
+                    except Exception as e:
+                        stats['failed'] += 1
+                        print(f"作品 {illust_id} 处理失败: {str(e)}", end="\n", flush=True)
 
-                    # 处理分页
-                    next_qs = self.api.parse_qs(res.next_url) if res.next_url else None
-                    if total >= self.follow_max:
-                        print(f"已下载{total}个作品，达到上限，清除进度")
-                        self.db.clear_progress(user_id_str)
-                        break
-                    elif next_qs:
-                        current_qs.update(next_qs)
-                        if has_new_content:
-                            print("保存分页进度")
-                            self.db.save_progress(user_id_str, {
-                                'next_qs': current_qs,
-                                'downloaded_ids': list(downloaded_ids)
-                            })
-                    else:
-                        if len(downloaded_ids)> 0:
-                            print("所有分页已完成，清除进度")
-                            self.db.clear_progress(user_id_str)
+                    if max_items and stats['total'] >= max_items:
+                        print(f"达到最大数量限制 {max_items}")
+                        limit_reached = True
                         break
 
-                except KeyboardInterrupt:
-                    print("\n用户中断，保存进度...")
-                    self.db.save_progress(user_id_str, {
-                        'next_qs': current_qs,
-                        'downloaded_ids': list(downloaded_ids),
-                    })
+                if limit_reached or reached_mark:
+                    print("已到达水位线，停止翻页" if reached_mark else f"已处理{stats['total']}个作品，达到上限")
                     break
-            # 最终处理
-            print(f"关注用户新作品下载下载统计:")
-            print(f"- 总作品: {total}")
-            print(f"- 成功数: {success}")
-            print(f"- 跳过已缓存作品数: {skipped_cache}")
-            print(f"- 跳过屏蔽作品数: {skipped_tag}")
-            if self.exclude_manga:
-                print(f"- 跳过漫画作品数: {skipped_manga}")
-
+                if self.stop_event.is_set():
+                    print(f"收到停止信号，保存 {label} 的进度")
+                    stats['interrupted'] = True
+                    save_progress()
+                    return stats
+                if has_new_content and res.next_url:
+                    console.detail("保存分页进度")
+                    next_qs = self.api.parse_qs(res.next_url)
+                    persist(dict(progress(), next_qs={**qs, **next_qs, **(pinned or {})}))
+
+            stats['saturated'] = page_status.get('saturated', False)
+            stats['finished'] = True
+            if clear_on_finish:
+                print("所有分页已完成，清除进度")
+                self.db.clear_progress(progress_key)
+
+        except KeyboardInterrupt:
+            print("\n用户中断，保存进度...")
+            stats['interrupted'] = True
+            save_progress()
         except Exception as e:
-            print(f"下载失败: {str(e)}")
-            self.db.save_progress(user_id_str, {
-                'next_qs': current_qs,
-                'downloaded_ids': list(downloaded_ids)
-            })                      
-
+            print(f"{label}下载失败: {str(e)}")
+            save_progress()
+
+        return stats
+
+    def _print_stats(self, label, stats, filters=()):
+        if console.json_log:
+            counters = {k: v for k, v in stats.items() if isinstance(v, (int, bool))}
+            console.event('stats', f"{label}下载统计", label=label.strip(), **counters)
+            return
+        print(f"{label}下载统计:")
+        print(f"- 总作品: {stats['total']}")
+        print(f"- 成功数: {stats['success']}")
+        print(f"- 跳过已缓存作品数: {stats['skipped_cache']}")
+        for name, display, _ in filters:
+            skipped = stats.get(f'skipped_{name}', 0)
+            saved = stats.get(f'saved_{name}', 0)
+            note = f"（省去 {saved} 页的缓存查询与下载）" if saved else ""
+            print(f"- 跳过{display}作品数: {skipped}{note}")
+        if stats['failed']:
+            permanent = stats.get('failed_permanent', 0)
+            note = f"（其中 {permanent} 个不可恢复）" if permanent else ""
+            print(f"- 失败数: {stats['failed']}{note}")
+
+    def start_recording(self, path, include_bodies=False):
+        """录制本次运行的HTTP流量，用于离线回放"""
+        if self.api_cache:
+            print("提示: API响应缓存已启用，命中缓存的请求不会被录制")
+        self.recorder = SessionRecorder(path, include_bodies, command=sys.argv[1:])
+        self.recorder.attach(self.api)
+
+    def stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def report_metrics(self, metrics_file=None):
+        """输出本次运行的指标汇总，并按需写入指标文件"""
+        self._record_connection_stats()
+        if console.json_log:
+            console.event('metrics', "运行指标汇总", **self.metrics.to_dict())
+        else:
+            print("\n" + "\n".join(self.metrics.summary_lines()))
+        metrics_file = metrics_file or METRICS_FILE
+        if metrics_file:
+            try:
+                self.metrics.write_file(metrics_file)
+                console.detail(f"指标已写入: {metrics_file}")
+            except OSError as e:
+                print(f"指标文件写入失败: {str(e)}")
 
-    def download_bookmarks(self):
-        """下载收藏（带进度管理）"""
+    def _is_full_sync_due(self, watermark):
+        """判断画师是否需要全量扫描（无水位线或超过全量扫描间隔）"""
+        if not watermark or not watermark.get('last_full_sync'):
+            return True
         try:
-            user_id_str = f"bookmarks_{self.user_id}"
-            progress_data = self.db.load_progress(user_id_str) or {}
-            current_qs = progress_data.get('next_qs') or {'user_id': self.user_id,"filter": "for_android"}
-            downloaded_ids = set(progress_data.get('downloaded_ids', []))
-            total = success = 0
-
-            print("\n▶ 正在下载收藏作品...", end="\n", flush=True)
-            if progress_data:
-                print(f"继续上次进度 (已下载 {len(downloaded_ids)} 个作品)")
-
-            total = skipped_cache = skipped_tag = skipped_manga = success = 0
- 
-            while True:
-                try:
-                    res = self.api.user_bookmarks_illust(**current_qs)
-                    if not res.illusts:
-                        print("没有更多收藏作品")
-                        self.db.clear_progress(user_id_str)
-                        break
-                
-                    has_new_content = False
-
-                    for illust in res.illusts:
-                        try:
-                            if illust.is_deleted:
-                                continue
-
-                            illust_id = illust.id
-                            total += 1
+            last_full = datetime.datetime.fromisoformat(str(watermark['last_full_sync']))
+        except ValueError:
+            return True
+        return datetime.datetime.now() - last_full >= datetime.timedelta(days=FOLLOW_FULL_SYNC_DAYS)
 
-                            # 严格缓存检查
-                            pages = self._get_illust_pages(illust)
-                            has_valid_cache = all(
-                                self.db.check_cache(illust_id, idx, 10)
-                                for idx in range(len(pages)))
-                            
-                            if has_valid_cache:
-                                if illust_id not in downloaded_ids:
-                                    downloaded_ids.add(illust_id)
-                                    skipped_cache += 1
-                                    print(f"⇩ 发现缓存作品 {illust_id}，更新进度")
-                                    self.db.save_progress(user_id_str, {
-                                        'next_qs': current_qs,
-                                        'downloaded_ids': list(downloaded_ids)
-                                    })                                
-                                    continue
-
-                            download_success = True
-                            has_new_content = True
-
-                            if illust.type == 'ugoira':
-                                if not self.download_ugoira(illust, self.bookmarks_dir, 10):
-                                    download_success = False                        
-                            else:                                                      
-                                for idx, url in enumerate(pages):
-                                    if not url:
-                                        print(f"收藏作品{illust.id}URL无效")
-                                        continue
-                                    fname = os.path.basename(url)
-                                    save_path = os.path.join(self.bookmarks_dir, fname)
-                                    if not self.download_image(illust, idx, url, save_path, 10):
-                                        download_success = False
-                            
-                            if download_success:
-                                downloaded_ids.add(illust_id)
-                                success +=1
-                                # 每完成一个作品立即保存进度
-                                self.db.save_progress(user_id_str, {
-                                    'next_qs': current_qs,
-                                    'downloaded_ids': list(downloaded_ids)
-                                })
-
-                            time.sleep(self.request_interval)
-
-                        except Exception as e:
-                            print(f"处理收藏作品失败 {illust.id}: {str(e)}", end="\n", flush=True)
-
-
-                    next_qs = self.api.parse_qs(res.next_url) if res.next_url else None
-                    if next_qs:
-                        current_qs.update(next_qs)
-                        current_qs['user_id'] = self.user_id
-                        if has_new_content:
-                            print("保存分页进度")
-                            self.db.save_progress(user_id_str, {
-                                'next_qs': current_qs,
-                                'downloaded_ids': list(downloaded_ids)
-                            })
-                    else:
-                        if len(downloaded_ids) > 0:
-                            print(f"所有分页已完成，清除进度")
-                            self.db.clear_progress(user_id_str)
-                        break
+    def download_user_illusts(self, target_user_id, username, incremental=None):
+        """下载画师作品（增量模式下遇到水位线即停止翻页）"""
+        if incremental is None:
+            incremental = FOLLOW_INCREMENTAL
 
-                except KeyboardInterrupt:
-                    print("\n用户中断，保存进度...")
-                    self.db.save_progress(user_id_str, {
-                        'next_qs': current_qs,
-                        'downloaded_ids': list(downloaded_ids),
-                    })
-                    break               
-
-            print(f"收藏下载下载统计:")
-            print(f"- 总作品: {total}")
-            print(f"- 成功数: {success}")
-            print(f"- 跳过已缓存作品数: {skipped_cache}")
+        # 增强用户名清洗逻辑（新增）
+        clean_username = self._sanitize_name(username,target_user_id)
 
-        except Exception as e:
-            print(f"收藏下载失败: {str(e)}")
-            self.db.save_progress(user_id_str, {
-                'next_qs': current_qs,
-                'downloaded_ids': list(downloaded_ids)
-            })
+        save_dir = os.path.join(self.following_dir, f"{clean_username}_{target_user_id}")
 
-    def download_ranking(self, mode, category, mode_name, priority):
-        """智能排行榜下载（支持分页和漫画过滤）"""
-        try:
-            # 准备存储目录（使用category参数）
-            jst = datetime.timezone(datetime.timedelta(hours=9))
-            now_jst = datetime.datetime.now(jst)
-            ranking_date = now_jst.date() - datetime.timedelta(days=1) if now_jst.hour < 12 else now_jst.date()
-            date_str = ranking_date.strftime('%Y-%m-%d')
-            
-            save_dir = os.path.join(self.ranking_dir, category, f"{date_str}_{mode_name}")
+        try:  # 新增目录创建验证
             os.makedirs(save_dir, exist_ok=True)
+            # 验证目录是否实际存在（新增）
+            if not os.path.isdir(save_dir):
+                raise OSError(f"Directory creation failed: {save_dir}")
+        except OSError as e:
+            print(f"无法创建目录 {save_dir}: {str(e)}", end="\n", flush=True)
+            return
+
+        user_id_str = str(target_user_id)
+        progress_data, current_qs, downloaded_ids = self._load_job_progress(
+            user_id_str, {'user_id': target_user_id, 'filter': 'for_android'})
+
+        # 水位线：续传时沿用上次的扫描模式，避免中断的全量扫描被提前截断
+        watermark = self.db.get_watermark(user_id_str)
+        if progress_data:
+            full_sweep = progress_data.get('full_sweep', True)
+        else:
+            full_sweep = not incremental or self._is_full_sync_due(watermark)
+        stop_at = None if full_sweep or not watermark else watermark['last_illust_id']
+        if stop_at:
+            print(f"增量同步：遇到作品 {stop_at} 即停止")
+        elif incremental:
+            print("全量扫描画师作品")
+
+        filters = [self._tag_filter()]
+        if self.exclude_manga:
+            filters.append(self._manga_filter())
+
+        stats = self._run_pipeline(
+            f"用户 {clean_username} ", user_id_str, self.api.user_illusts, current_qs,
+            pinned={'user_id': target_user_id}, filters=filters, save_dir=save_dir,
+            priority=9, stop_at=stop_at,
+            state={'full_sweep': full_sweep, 'newest': progress_data.get('newest')},
+            downloaded_ids=downloaded_ids)
+
+        # 完整走完（到达水位线或末页）且无失败时推进水位线，失败作品留待下次重试
+        newest = stats['newest']
+        if stats['finished'] and stats['failed']:
+            print(f"有 {stats['failed']} 个作品处理失败，保留原水位线")
+        elif stats['finished'] and newest:
+            self.db.update_watermark(user_id_str, newest['illust_id'],
+                                     newest['create_date'], full_sync=full_sweep)
+        elif stats['finished'] and full_sweep and watermark:
+            self.db.update_watermark(user_id_str, watermark['last_illust_id'],
+                                     watermark['last_create_date'], full_sync=True)
+
+        self._print_stats(f"用户 {clean_username} ", stats, filters)
+        return stats
+
+    def _last_activity(self, user_preview):
+        """根据user_previews附带的最新作品估计画师最近活跃度（作品ID随时间递增）"""
+        illusts = getattr(user_preview, 'illusts', None) or []
+        return max((illust.id for illust in illusts), default=0)
+
+    def sync_following(self, users, incremental=None):
+        """并发同步多个关注画师（按最近活跃排序，逐个输出画师统计）"""
+        if incremental is None:
+            incremental = FOLLOW_INCREMENTAL
+
+        # 最近活跃的画师优先；增量模式下预览中无新作品的画师直接跳过
+        queue = []
+        skipped_idle = 0
+        for u in sorted(users, key=self._last_activity, reverse=True):
+            if incremental:
+                watermark = self.db.get_watermark(str(u.user.id))
+                latest = self._last_activity(u)
+                if (watermark and latest and latest <= watermark['last_illust_id']
+                        and not self._is_full_sync_due(watermark)):
+                    skipped_idle += 1
+                    continue
+            queue.append(u)
+
+        print(f"\n▶ 同步 {len(queue)} 位画师（{self.artist_workers} 并发），"
+              f"{skipped_idle} 位无新作品已跳过", end="\n", flush=True)
+
+        self.stop_event.clear()
+        totals = {'total': 0, 'success': 0, 'skipped_cache': 0,
+                  'skipped_tag': 0, 'skipped_manga': 0, 'failed': 0}
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.artist_workers)) as executor:
+            futures = {
+                executor.submit(self.download_user_illusts, u.user.id, u.user.name, incremental): u
+                for u in queue
+            }
+            try:
+                for future in as_completed(futures):
+                    u = futures[future]
+                    done += 1
+                    try:
+                        stats = future.result() or {}
+                    except Exception as e:
+                        print(f"[{done}/{len(queue)}] {u.user.name} 同步失败: {str(e)}", end="\n", flush=True)
+                        continue
+                    for key in totals:
+                        totals[key] += stats.get(key, 0)
+                    print(f"[{done}/{len(queue)}] {u.user.name}: 新下载 {stats.get('success', 0)}，"
+                          f"缓存 {stats.get('skipped_cache', 0)}，失败 {stats.get('failed', 0)}",
+                          end="\n", flush=True)
+            except KeyboardInterrupt:
+                print("\n用户中断，等待进行中的画师保存进度...")
+                self.stop_event.set()
+                for future in futures:
+                    future.cancel()
+
+        print("关注同步统计:")
+        print(f"- 同步画师数: {done}")
+        print(f"- 跳过无新作品画师数: {skipped_idle}")
+        print(f"- 总作品: {totals['total']}")
+        print(f"- 成功数: {totals['success']}")
+        print(f"- 跳过已缓存作品数: {totals['skipped_cache']}")
+        print(f"- 失败数: {totals['failed']}")
+        return totals
 
-            user_id_str = f"ranking_{category}_{mode}_{ranking_date}"
-            progress_data = self.db.load_progress(user_id_str) or {}
-            current_qs = progress_data.get('next_qs') or {'mode': mode,"filter": "for_android"}
-            downloaded_ids = set(progress_data.get('downloaded_ids', []))
+    def download_following_new(self):
+        """从关注用户的新作品专用接口下载"""
+        jst = datetime.timezone(datetime.timedelta(hours=9))
+        now_jst = datetime.datetime.now(jst)
+        ranking_date = now_jst.date() - datetime.timedelta(days=1) if now_jst.hour < 12 else now_jst.date()
+        date_str = ranking_date.strftime('%Y-%m-%d')
 
- 
-            print(f"\n▶ 正在下载 {category} {mode_name}（模式：{mode}）")
-            if progress_data:
-                print(f"继续上次进度 (已下载 {len(downloaded_ids)} 个作品)")
-            next_qs = {'mode': mode}
+        os.makedirs(self.following_dir, exist_ok=True)
 
-            total = len(downloaded_ids)
-            success = 0
-            skipped_cache = skipped_tag = skipped_manga = 0 
+        print("\n▶ 正在下载 关注用户新作品")
+        user_id_str = f"following_new_{date_str}"
+        _, current_qs, downloaded_ids = self._load_job_progress(user_id_str, {})
 
-            while total < self.ranking_max:
-                try:
-                    res = self.api.illust_ranking(**current_qs) 
-                    if not res or not hasattr(res, 'illusts'):
-                        print("API响应异常，等待重试...")
-                        time.sleep(5)
-                        continue
+        def user_dir(illust):
+            """按作者分目录保存"""
+            uid = illust.user.id
+            return os.path.join(self.following_dir, f"{self._sanitize_name(illust.user.name, uid)}_{uid}")
 
-                    if not res.illusts:               
-                        print("没有更多排行榜作品")
-                        self.db.clear_progress(user_id_str)
-                        break
+        filters = [self._tag_filter()]
+        if self.exclude_manga:
+            filters.append(self._manga_filter())
 
-                    has_new_content = False
+        stats = self._run_pipeline(
+            "关注用户新作品", user_id_str, self.api.illust_follow, current_qs,
+            filters=filters, save_dir=user_dir, priority=9,
+            max_items=self.follow_max, downloaded_ids=downloaded_ids,
+            count_resumed=True)
+        self._print_stats("关注用户新作品", stats, filters)
+        return stats
 
-                    for illust in res.illusts:
-                        try:
-                            if illust.is_deleted:
-                                continue
+    def download_bookmarks(self):
+        """下载收藏（带进度管理）"""
+        print("\n▶ 正在下载收藏作品...", end="\n", flush=True)
+        user_id_str = f"bookmarks_{self.user_id}"
+        _, current_qs, downloaded_ids = self._load_job_progress(
+            user_id_str, {'user_id': self.user_id, 'filter': 'for_android'})
+
+        stats = self._run_pipeline(
+            "收藏", user_id_str, self.api.user_bookmarks_illust, current_qs,
+            pinned={'user_id': self.user_id}, save_dir=self._layout_dir(self.bookmarks_dir),
+            priority=10, downloaded_ids=downloaded_ids)
+        self._print_stats("收藏", stats)
+        return stats
 
-                            illust_id = illust.id
-                            total += 1
+    def download_ranking(self, mode, category, mode_name, priority):
+        """智能排行榜下载（支持分页和漫画过滤）"""
+        # 准备存储目录（使用category参数）
+        jst = datetime.timezone(datetime.timedelta(hours=9))
+        now_jst = datetime.datetime.now(jst)
+        ranking_date = now_jst.date() - datetime.timedelta(days=1) if now_jst.hour < 12 else now_jst.date()
+        date_str = ranking_date.strftime('%Y-%m-%d')
+
+        save_dir = os.path.join(self.ranking_dir, category, f"{date_str}_{mode_name}")
+        os.makedirs(save_dir, exist_ok=True)
+
+        print(f"\n▶ 正在下载 {category} {mode_name}（模式：{mode}）")
+        user_id_str = f"ranking_{category}_{mode}_{ranking_date}"
+        _, current_qs, downloaded_ids = self._load_job_progress(
+            user_id_str, {'mode': mode, 'filter': 'for_android'})
+
+        filters = [self._tag_filter()]
+        if self.exclude_manga:
+            filters.append(self._manga_filter())
+
+        stats = self._run_pipeline(
+            f"{category}_{mode}排行榜", user_id_str, self.api.illust_ranking, current_qs,
+            pinned={'mode': mode}, filters=filters, save_dir=save_dir,
+            priority=priority, max_items=self.ranking_max,
+            downloaded_ids=downloaded_ids, count_resumed=True)
+        # 仅剩不可恢复的失败（作品已删除、不可见）时也视为完成，重跑不会有变化
+        if stats['finished'] and stats['failed'] == stats['failed_permanent']:
+            self.db.mark_task_complete(user_id_str)
+        self._print_stats(f"{category}_{mode}排行榜", stats, filters)
+        return stats
+
+    def _layout_dir(self, base_dir):
+        """收藏/搜索的保存目录：开启分片时返回按作品ID选择分片子目录的函数"""
+        if not self.shard_size:
+            return base_dir
+        return lambda illust: os.path.join(base_dir, shard_name(illust.id, self.shard_size))
+
+    def _merge_stats(self, totals, stats):
+        for key, value in stats.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _download_search_windows(self, label, progress_key, progress_data, base_qs,
+                                 filters, save_dir, downloaded_ids):
+        """时间窗口分片并发搜索：窗口交给工作线程池，每个窗口独立记录偏移以便续传
+
+        窗口大小按结果密度自适应：触及偏移上限的窗口拆分重排并缩小后续窗口，
+        结果稀疏时放大后续窗口；调整后的大小按搜索词保存
+        """
+        from dateutil import parser
+        jst = datetime.timezone(datetime.timedelta(hours=9))
+        earliest = SEARCH_EARLIEST_DATE
+        min_days, max_days = SEARCH_WINDOW_DAYS
+        word = base_qs['word']
+        window_days = self.db.get_search_window(word) or 30
+        print(f"时间窗口大小: {window_days} 天")
+        lock = threading.Lock()
+        totals = {}
+
+        # 进度结构：frontier 为尚未分配的最新日期，windows 为已分配但未完成的窗口
+        windows = dict(progress_data.get('windows') or {})
+        frontier = progress_data.get('frontier')
+        legacy = progress_data.get('current_window')
+        if frontier:
+            frontier = datetime.date.fromisoformat(frontier)
+        elif legacy:
+            # 兼容旧版单窗口进度
+            start = parser.parse(legacy['start']).astimezone(jst).date()
+            end = parser.parse(legacy['end']).astimezone(jst).date()
+            windows[f"{start}~{end}"] = {'start': start.isoformat(), 'end': end.isoformat()}
+            frontier = start - datetime.timedelta(days=1)
+        else:
+            frontier = datetime.datetime.now(jst).date()
+
+        pending = sorted(windows.values(), key=lambda w: w['end'], reverse=True)
+        if pending:
+            print(f"续传 {len(pending)} 个未完成的时间窗口")
+
+        def save_state():
+            with lock:
+                record = {
+                    'next_qs': base_qs,
+                    'downloaded_ids': list(downloaded_ids),
+                    'frontier': frontier.isoformat(),
+                    'windows': windows
+                }
+                self.db.save_progress(progress_key, record)
+
+        def next_window():
+            nonlocal frontier
+            with lock:
+                if frontier < earliest:
+                    return None
+                end = frontier
+                start = max(earliest, end - datetime.timedelta(days=window_days - 1))
+                frontier = start - datetime.timedelta(days=1)
+                window = {'start': start.isoformat(), 'end': end.isoformat()}
+                windows[f"{start}~{end}"] = window
+                return window
+
+        def run_window(window):
+            key = f"{window['start']}~{window['end']}"
+            print(f"\n当前时间窗口: {window['start']} 至 {window['end']}", end="\n", flush=True)
+            current_qs = base_qs.copy()
+            current_qs.pop('duration', None)  # 指定日期时不再使用duration
+            current_qs.update({'start_date': window['start'], 'end_date': window['end']})
+            if window.get('offset'):
+                current_qs['offset'] = window['offset']
+
+            def on_progress(data):
+                with lock:
+                    downloaded_ids.update(data['downloaded_ids'])
+                    if key in windows:
+                        windows[key]['offset'] = data['next_qs'].get('offset')
+                save_state()
+
+            return self._run_pipeline(
+                f"{label}[{key}]", progress_key, self.api.search_illust, current_qs,
+                filters=filters, save_dir=save_dir, priority=9,
+                downloaded_ids=set(), clear_on_finish=False, on_progress=on_progress,
+                max_offset=SEARCH_OFFSET_LIMIT)
+
+        def split_saturated(window, stats):
+            """窗口触及偏移上限：返回需要补扫的子窗口"""
+            start = datetime.date.fromisoformat(window['start'])
+            end = datetime.date.fromisoformat(window['end'])
+            if start >= end:
+                print(f"时间窗口 {start} 仅一天仍超过偏移上限，部分结果无法获取")
+                return []
+            # 按日期倒序时，只需补扫最后一个结果之前的部分（含当天）
+            if base_qs.get('sort') == 'date_desc' and stats['oldest']:
+                last = parser.parse(stats['oldest']['create_date']).astimezone(jst).date()
+                if start <= last < end:
+                    return [(start, last)]
+            mid = start + (end - start) // 2
+            return [(mid + datetime.timedelta(days=1), end), (start, mid)]
+
+        def adapt(window, stats):
+            """根据窗口结果调整后续窗口大小，返回需补扫的子窗口"""
+            nonlocal window_days
+            if stats['saturated']:
+                window_days = max(min_days, window_days // 2)
+                print(f"时间窗口 {window['start']}~{window['end']} 结果过多，缩小为 {window_days} 天")
+                return split_saturated(window, stats)
+            if stats['total'] < SEARCH_SPARSE_RESULTS and window_days < max_days:
+                window_days = min(max_days, window_days * 2)
+                print(f"结果稀疏，时间窗口放大为 {window_days} 天")
+            return []
 
-                            # 严格缓存检查
-                            pages = self._get_illust_pages(illust)
-                            has_valid_cache = all(
-                                self.db.check_cache(illust_id, idx, priority)
-                                for idx in range(len(pages)))
-                            
-                            if has_valid_cache:
-                                if illust_id not in downloaded_ids:
-                                    downloaded_ids.add(illust_id)
-                                    skipped_cache += 1
-                                    print(f"⇩ 发现缓存作品 {illust_id}，更新进度")
-                                    self.db.save_progress(user_id_str, {
-                                        'next_qs': current_qs,
-                                        'downloaded_ids': list(downloaded_ids)
-                                    })                                
-                                    continue
-
-                            if self._has_excluded_tags(illust):
-                                print(f"排除含屏蔽标签作品：{illust_id}")
-                                skipped_tag += 1
-                                continue
-
-                            if self.exclude_manga and self._is_manga(illust):
-                                print(f"跳过漫画作品：{illust_id}", end="\n", flush=True)
-                                skipped_manga += 1
-                                continue
-
-                            download_success = True
-                            has_new_content = True
-
-
-                            if illust.type == 'ugoira':
-                                if not self.download_ugoira(illust, save_dir, priority):
-                                    download_success = False                        
-                            else:                              
-                                for idx, url in enumerate(pages):
-                                    if not url:
-                                        print(f"排行榜作品{illust_id}URL无效")   
-                                        continue
-                                    fname = os.path.basename(url)
-                                    save_path = os.path.join(save_dir, fname)
-                                    if not self.download_image(illust, idx, url, save_path, priority):
-                                        download_success = False
-            
-                            if download_success:
-                                downloaded_ids.add(illust_id)
-                                success += 1
-                                self.db.save_progress(user_id_str, {
-                                    'next_qs': current_qs,
-                                    'downloaded_ids': list(downloaded_ids)
-                                })
-
-                            if total >= self.ranking_max:
-                                print(f"达到最大数量限制 {self.ranking_max}")
-                                break  
-
-                            time.sleep(self.request_interval)
-
-                        except Exception as e:
-                            print(f"处理作品失败 {illust.id}: {str(e)}", end="\n", flush=True)
-
-                    # 处理分页
-                    next_qs = self.api.parse_qs(res.next_url) if res.next_url else None
-                    if total >= self.ranking_max:
-                        print(f"已下载{total}个作品，达到上限，清除进度")
-                        self.db.clear_progress(user_id_str)
+        self.stop_event.clear()
+        failed_windows = 0
+        futures = {}
+        workers = max(1, self.search_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # 补满工作线程：先续传未完成窗口，再从frontier继续向前分配
+                while len(futures) < workers and not self.stop_event.is_set():
+                    window = pending.pop(0) if pending else next_window()
+                    if window is None:
                         break
-                    elif next_qs:
-                        current_qs.update(next_qs)
-                        current_qs['mode'] = mode
-                        if has_new_content:
-                            print("保存分页进度")
-                            self.db.save_progress(user_id_str, {
-                                'next_qs': current_qs,
-                                'downloaded_ids': list(downloaded_ids)
-                            })
-                    else:
-                        if len(downloaded_ids)> 0:
-                            print("所有分页已完成，清除进度")
-                            self.db.clear_progress(user_id_str)
-                        break                         
+                    futures[executor.submit(run_window, window)] = window
+                if not futures:
+                    break
 
+                try:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
                 except KeyboardInterrupt:
-                    print("\n用户中断，保存进度...")
-                    self.db.save_progress(user_id_str, {
-                        'next_qs': current_qs,
-                        'downloaded_ids': list(downloaded_ids),
-                    })
-                    break
-   
-            # 最终处理
-            print(f"{category}_{mode}排行榜下载下载统计:")
-            print(f"- 总作品: {total}")
-            print(f"- 成功数: {success}")
-            print(f"- 跳过已缓存作品数: {skipped_cache}")
-            print(f"- 跳过屏蔽作品数: {skipped_tag}")
-            if self.exclude_manga:
-                print(f"- 跳过漫画作品数: {skipped_manga}")
+                    print("\n用户中断，等待进行中的窗口保存进度...")
+                    self.stop_event.set()
+                    continue
+
+                for future in done:
+                    window = futures.pop(future)
+                    key = f"{window['start']}~{window['end']}"
+                    try:
+                        stats = future.result()
+                    except Exception as e:
+                        print(f"时间窗口 {key} 处理失败: {str(e)}")
+                        failed_windows += 1
+                        continue
+                    with lock:
+                        self._merge_stats(totals, stats)
+                        if stats['finished']:
+                            windows.pop(key, None)
+                            for sub_start, sub_end in adapt(window, stats):
+                                sub = {'start': sub_start.isoformat(), 'end': sub_end.isoformat()}
+                                windows[f"{sub_start}~{sub_end}"] = sub
+                                pending.insert(0, sub)
+                    if stats['finished']:
+                        print(f"时间窗口 {key} 分页完成", end="\n", flush=True)
+                    elif not stats['interrupted']:
+                        failed_windows += 1
+                    save_state()
+
+        self.db.save_search_window(word, window_days)
+        if self.stop_event.is_set():
+            print("已保存各时间窗口进度，下次运行将继续")
+        elif failed_windows or windows:
+            print(f"{failed_windows} 个时间窗口未完成，已保留进度")
+        else:
+            print("已搜索到最早时间范围")
+            self.db.clear_progress(progress_key)
+        return totals
 
-        except Exception as e:
-            print(f"排行榜下载失败: {str(e)}")
-            self.db.save_progress(user_id_str, {
-                'next_qs': current_qs,
-                'downloaded_ids': list(downloaded_ids)
-            })
-    
     def download_search(self, search_word, search_target='partial_match_for_tags', 
                     sort='date_desc', duration=None, exclude_ai=True,
                     exclude_18=False, num_choice=True):
-        try:
-            # 提取收藏数标签
-            match = re.search(r"(\d+)users入り$", search_word)
-            use_num_tag = num_choice and match is not None
-            match_num = match.group(1) if match else None
-
-            # 清理搜索词（保留收藏数标签）
-            if use_num_tag:
-                clean_word = re.sub(r'[\\/*?:"<>|]', '_', search_word.strip()).lower()
-            else:
-                temp_word = re.sub(r"\d+users入り$", "", search_word).strip()
-                clean_word = re.sub(r'[\\/*?:"<>|]', '_', temp_word.strip()).lower()
-
-            # 创建保存目录
-            save_dir = os.path.join(self.search_dir, clean_word)
-            os.makedirs(save_dir, exist_ok=True)
-
-            # 初始化基础参数
-            base_qs = {
-                'word': clean_word,
-                'search_target': search_target,
-                'sort': sort,
-                'filter': 'for_android'
-            }
-            if duration:
-                base_qs['duration'] = duration
-
-            # 进度管理
-            user_id_str = f"search_{clean_word}"
-            progress_data = self.db.load_progress(user_id_str) or {}
-            downloaded_ids = set(progress_data.get('downloaded_ids', []))
-            total = success = 0
-            skipped_cache = skipped_tag = skipped_manga = skipped_ai = 0
-
-            print(f"\n▶ 正在搜索下载: {search_word}")
-            if progress_data:
-                print(f"继续上次进度 (已下载 {len(downloaded_ids)} 个作品)")
-
-            # ================== 分流处理逻辑 ==================
-            if use_num_tag:
-                # 高效模式（禁用时间窗口）
-                current_qs = base_qs.copy()
-                if 'offset' in progress_data.get('next_qs', {}):
-                    current_qs['offset'] = progress_data['next_qs']['offset']
-                if 'duration' in progress_data.get('next_qs', {}):
-                    current_qs['duration'] = progress_data['next_qs']['duration']
-
-                while True:
-                    try:
-                        res = self.api.search_illust(**current_qs)
-                        if not res.illusts:
-                            print("没有更多结果")
-                            self.db.clear_progress(user_id_str)
-                            break
-
-                        has_new_content = False
-                        for illust in res.illusts:
-                            try:
-                                # [原有的作品处理逻辑，保持不动]
-                                # 包括：标签检查、下载等...
-                                
-                                # 示例处理流程（需保持原有逻辑）：
-                                if illust.is_deleted:
-                                    continue
-
-                                illust_id = getattr(illust, 'id', '未知ID')
-
-                                # 收藏数验证
-                                if self._is_confirmed(illust, match_num) != True:
-                                    print(f"排除不符合收藏数作品：{illust_id}", end="\n", flush=True)
-                                    continue
-                                
-                                # 过滤检查
-                                if exclude_18 and 'r-18' in self._get_illust_tags(illust):
-                                    print(f"排除R-18作品：{illust_id}", end="\n", flush=True)
-                                    continue
-                                    
-                                # 下载处理...
-                                total += 1
-
-                                # 严格缓存检查
-                                pages = self._get_illust_pages(illust)
-                                has_valid_cache = all(
-                                    self.db.check_cache(illust_id, idx, 9)
-                                    for idx in range(len(pages)))
-                                
-                                if has_valid_cache:
-                                    if illust_id not in downloaded_ids:
-                                        downloaded_ids.add(illust_id)
-                                        skipped_cache += 1
-                                        print(f"⇩ 发现缓存作品 {illust_id}，更新进度")
-                                        self.db.save_progress(user_id_str, {
-                                            'next_qs': current_qs,
-                                            'downloaded_ids': list(downloaded_ids),
-                                            'current_window': {
-                                            'start': start_date.isoformat(),
-                                            'end': end_date.isoformat()
-                                            }
-                                        })
-                                    continue  
-
-                                if self._has_excluded_tags(illust):
-                                    print(f"排除含屏蔽标签作品：{illust_id}", end="\n", flush=True)
-                                    skipped_tag += 1
-                                    continue
-                                
-                                # AI类型处理
-                                if exclude_ai and illust.illust_ai_type == 2:
-                                    print(f"跳过AI作品：{illust_id}", end="\n", flush=True)
-                                    skipped_ai += 1
-                                    continue
-
-                                # 漫画类型处理
-                                if self.exclude_manga and illust.type == 'manga':
-                                    print(f"跳过漫画作品：{illust_id}", end="\n", flush=True)
-                                    skipped_manga += 1
-                                    continue                 
-                                
-                                download_success = True
-                                has_new_content = True 
-
-                                # 动图类型处理
-                                if illust.type == 'ugoira':
-                                    if not self.download_ugoira(illust, save_dir, 9):  # 日志在download_ugoira中打印
-                                        download_success = False
-                                else:                                              
-                                    # ===== 普通图片处理 =====
-                                    for idx, url in enumerate(pages):
-                                        if not url:
-                                            print(f"搜索作品{illust_id}URL无效")                               
-                                        fname = os.path.basename(url)
-                                        save_path = os.path.join(save_dir, fname)
-                                        if not self.download_image(illust, idx, url, save_path, 9):
-                                            download_success = False
-                                            break                                   
-                                
-                                # ===== 新增：立即保存进度 =====
-                                if download_success:
-                                    downloaded_ids.add(illust_id)
-                                    success +=1
-                                    self.db.save_progress(user_id_str, {
-                                        'next_qs': current_qs,
-                                        'downloaded_ids': list(downloaded_ids),
-                                        'current_window': {
-                                        'start': start_date.isoformat(),
-                                        'end': end_date.isoformat()
-                                        }
-                                    })
-                                
-                                time.sleep(self.request_interval)
-                                
-                            except Exception as e:
-                                print(f"作品处理失败: {str(e)}")
-
-                        # 更新分页参数
-                        next_qs = self.api.parse_qs(res.next_url)
-                        if next_qs:
-                            current_qs.update(next_qs)
-                            print("保存分页进度")
-                            if 'duration' in base_qs:
-                                current_qs['duration'] = base_qs['duration']
-                            self.db.save_progress(user_id_str, {
-                                'next_qs': current_qs,
-                                'downloaded_ids': list(downloaded_ids),
-                                'current_window': None  # 明确标记非时间窗口模式
-                            })
-                        else:
-                            if len(downloaded_ids)> 0:
-                                print("所有分页已完成，清除进度")
-                                self.db.clear_progress(user_id_str)
-                            break
-
-                        # 请求间隔
-                        time.sleep(self.request_interval)
-
-                    except KeyboardInterrupt:
-                        print("\n用户中断，保存分页进度")
-                        self.db.save_progress(user_id_str, {
-                            'next_qs': current_qs,
-                            'downloaded_ids': list(downloaded_ids),
-                            'current_window': None
-                        })
-                        break
-
-            else:
-                # 时间窗口模式（原有逻辑，但已优化）
-                jst = datetime.timezone(datetime.timedelta(hours=9))
-                window_size = datetime.timedelta(days=30)
-                
-                # 初始化时间窗口
-                current_window = progress_data.get('current_window')
-                if current_window:
-                    start_date = parser.parse(current_window['start']).astimezone(jst)
-                    end_date = parser.parse(current_window['end']).astimezone(jst)
-                else:
-                    end_date = datetime.datetime.now(jst).replace(hour=0, minute=0, second=0)
-                    start_date = end_date - window_size
-
-                while True:
-                    print(f"\n当前时间窗口: {start_date.date()} 至 {end_date.date()}")
-
-                    # 构造时间参数
-                    current_qs = base_qs.copy()
-                    current_qs.update({
-                        'start_date': start_date.strftime('%Y-%m-%d'),
-                        'end_date': end_date.strftime('%Y-%m-%d')
-                    })
-                    if duration:
-                        current_qs.pop('duration', None) 
-                    # [原有时间窗口内的分页处理逻辑，保持不动]
-                    # 包括分页循环、作品处理等...
-
-
-                    while True:
-                        try:
-                            res = self.api.search_illust(**current_qs)
-                            if not res.illusts:
-                                print("当前时间窗口无更多结果")
-                                break
-
-                            has_new_content = False
-                            for illust in res.illusts:
-                                try:
-                                    if illust.is_deleted:
-                                        continue
-
-                                    illust_id = getattr(illust, 'id', '未知ID')
-
-                                    if self._is_confirmed(illust,match_num) != True:
-                                        print(f"排除不符合收藏数作品：{illust_id}", end="\n", flush=True)
-                                        continue
-
-                                    if exclude_18 and 'r-18' in self._get_illust_tags(illust):
-                                        print(f"排除R-18作品：{illust_id}", end="\n", flush=True)
-                                        continue
-
-                                    total += 1
-
-                                    # 严格缓存检查
-                                    pages = self._get_illust_pages(illust)
-                                    has_valid_cache = all(
-                                        self.db.check_cache(illust_id, idx, 9)
-                                        for idx in range(len(pages)))
-                                    
-                                    if has_valid_cache:
-                                        if illust_id not in downloaded_ids:
-                                            downloaded_ids.add(illust_id)
-                                            skipped_cache += 1
-                                            print(f"⇩ 发现缓存作品 {illust_id}，更新进度")
-                                            self.db.save_progress(user_id_str, {
-                                                'next_qs': current_qs,
-                                                'downloaded_ids': list(downloaded_ids),
-                                                'current_window': {
-                                                'start': start_date.isoformat(),
-                                                'end': end_date.isoformat()
-                                                }
-                                            })
-                                        continue    
-
-                                    if self._has_excluded_tags(illust):
-                                        print(f"排除含屏蔽标签作品：{illust_id}", end="\n", flush=True)
-                                        skipped_tag += 1
-                                        continue
-                                    
-                                    # AI类型处理
-                                    if exclude_ai and illust.illust_ai_type == 2:
-                                        print(f"跳过AI作品：{illust_id}", end="\n", flush=True)
-                                        skipped_ai += 1
-                                        continue
-
-                                    # 漫画类型处理
-                                    if self.exclude_manga and illust.type == 'manga':
-                                        print(f"跳过漫画作品：{illust_id}", end="\n", flush=True)
-                                        skipped_manga += 1
-                                        continue               
-                                    
-                                    download_success = True
-                                    has_new_content = True 
-
-                                    # 动图类型处理
-                                    if illust.type == 'ugoira':
-                                        if not self.download_ugoira(illust, save_dir, 9):  # 日志在download_ugoira中打印
-                                            download_success = False
-                                    else:                                              
-                                        # ===== 普通图片处理 =====
-                                        for idx, url in enumerate(pages):
-                                            if not url:
-                                                print(f"搜索作品{illust_id}URL无效")                               
-                                            fname = os.path.basename(url)
-                                            save_path = os.path.join(save_dir, fname)
-                                            if not self.download_image(illust, idx, url, save_path, 9):
-                                                download_success = False
-                                                break                                   
-                                    
-                                    # ===== 新增：立即保存进度 =====
-                                    if download_success:
-                                        downloaded_ids.add(illust_id)
-                                        success +=1
-                                        self.db.save_progress(user_id_str, {
-                                            'next_qs': current_qs,
-                                            'downloaded_ids': list(downloaded_ids),
-                                            'current_window': {
-                                            'start': start_date.isoformat(),
-                                            'end': end_date.isoformat()
-                                            }
-                                        })
-                                    
-                                    time.sleep(self.request_interval)
-
-                                except Exception as e:
-                                    print(f"作品 {illust_id}处理失败: {str(e)}")
-
-                            # 修改后的进度保存逻辑
-                            if 'offset' in current_qs:
-                                print(f"当前偏移{current_qs['offset']}")
-                            next_qs = self.api.parse_qs(res.next_url) if res.next_url else None
-                            if next_qs:
-                                current_qs.update(next_qs)
-                                if has_new_content:
-                                    print("保存分页进度")
-                                    self.db.save_progress(user_id_str, {
-                                        'next_qs': current_qs,
-                                        'downloaded_ids': list(downloaded_ids),
-                                        'current_window': {
-                                        'start': start_date.isoformat(),
-                                        'end': end_date.isoformat()
-                                        }
-                                    })
-                            else:
-                                print(f"当前窗口分页完成")
-                                break
-
-                        except KeyboardInterrupt:
-                            print("\n用户中断，保存当前进度")
-                            self.db.save_progress(user_id_str, {
-                                'next_qs': current_qs,
-                                'downloaded_ids': list(downloaded_ids),
-                                'current_window': {
-                                'start': start_date.isoformat(),
-                                'end': end_date.isoformat()
-                                }
-                            })
-                            break
-
-                        except Exception as e:
-                            print(f"搜索失败: {str(e)}")
-
-                    # 滑动时间窗口
-                    new_end_date = start_date - datetime.timedelta(days=1)
-                    new_start_date = new_end_date - window_size + datetime.timedelta(days=1)  # 修正窗口计算
-
-                    # 边界检查
-                    if new_start_date < datetime.datetime(2007, 9, 10, tzinfo=jst):
-                        print("已搜索到最早时间范围")
-                        self.db.clear_progress(user_id_str)
-                        break
-
-                    start_date = new_start_date
-                    end_date = new_end_date
-
-                    # 保存窗口进度
-                    self.db.save_progress(user_id_str, {
-                        'next_qs': base_qs,  # 保存基础参数
-                        'downloaded_ids': list(downloaded_ids),
-                        'current_window': {
-                            'start': start_date.isoformat(),
-                            'end': end_date.isoformat()
-                        }
-                    })
-                    time.sleep(1)
-
-            # ================== 最终处理 ==================
-            if not os.listdir(save_dir):
-                print('目录下无文件，删除目录')
-                os.rmdir(save_dir)
-                self.db.clear_progress(user_id_str)
-
-            print(f"搜索 {search_word} 下载统计:")
-            print(f"- 总作品数: {total}")
-            print(f"- 成功数: {success}")
-            print(f"- 跳过已缓存作品数: {skipped_cache}")
-            print(f"- 跳过屏蔽标签作品数: {skipped_tag}")
-            if self.exclude_manga:
-                print(f"- 跳过漫画作品数: {skipped_manga}")
-            if exclude_ai:
-                print(f"- 跳过AI作品数: {skipped_ai}")
+        # 提取收藏数标签
+        match = re.search(r"(\d+)users入り$", search_word)
+        use_num_tag = num_choice and match is not None
+        match_num = match.group(1) if match else None
+
+        # 清理搜索词（保留收藏数标签）
+        if use_num_tag:
+            clean_word = re.sub(r'[\\/*?:"<>|]', '_', search_word.strip()).lower()
+        else:
+            temp_word = re.sub(r"\d+users入り$", "", search_word).strip()
+            clean_word = re.sub(r'[\\/*?:"<>|]', '_', temp_word.strip()).lower()
+
+        # 创建保存目录
+        save_dir = os.path.join(self.search_dir, clean_word)
+        os.makedirs(save_dir, exist_ok=True)
+
+        # 初始化基础参数
+        base_qs = {
+            'word': clean_word,
+            'search_target': search_target,
+            'sort': sort,
+            'filter': 'for_android'
+        }
+        if duration:
+            base_qs['duration'] = duration
+
+        # 进度管理
+        user_id_str = f"search_{clean_word}"
+        print(f"\n▶ 正在搜索下载: {search_word}")
+        progress_data, saved_qs, downloaded_ids = self._load_job_progress(user_id_str, base_qs)
+
+        # 过滤阶段（收藏数、R-18在前，与原有判断顺序一致）
+        filters = []
+        if match_num:
+            filters.append(self._bookmark_filter(match_num))
+        if exclude_18:
+            filters.append(self._r18_filter())
+        filters.append(self._tag_filter())
+        if exclude_ai:
+            filters.append(self._ai_filter())
+        if self.exclude_manga:
+            filters.append(self._manga_filter())
+
+        label = f"搜索 {search_word} "
+        totals = {}
+        layout_dir = self._layout_dir(save_dir)
+
+        # ================== 分流处理逻辑 ==================
+        if use_num_tag:
+            # 高效模式（禁用时间窗口）
+            current_qs = base_qs.copy()
+            if 'offset' in saved_qs:
+                current_qs['offset'] = saved_qs['offset']
+            stats = self._run_pipeline(
+                label, user_id_str, self.api.search_illust, current_qs,
+                pinned={'duration': duration} if duration else None,
+                filters=filters, save_dir=layout_dir, priority=9,
+                state={'current_window': None}, downloaded_ids=downloaded_ids)
+            self._merge_stats(totals, stats)
 
-        except Exception as e:
-            print(f"搜索下载失败: {str(e)}")
-            self.db.save_progress(user_id_str, {
-                'next_qs': current_qs if 'current_qs' in locals() else base_qs,
-                'downloaded_ids': list(downloaded_ids),
-                'current_window': current_window if not use_num_tag else None
-            })
+        else:
+            # 时间窗口模式：从今天向前分片，多个窗口并发处理
+            totals = self._download_search_windows(
+                label, user_id_str, progress_data, base_qs,
+                filters, layout_dir, downloaded_ids)
+
+        # ================== 最终处理 ==================
+        if self.shard_size:
+            _remove_empty_shards(save_dir)
+        if _is_dir_empty(save_dir):
+            print('目录下无文件，删除目录')
+            os.rmdir(save_dir)
+            self.db.clear_progress(user_id_str)
+
+        self._print_stats(label, totals, filters)
+        return totals
     
         
 def clear_screen():
@@ -2182,9 +3646,7 @@ def handle_following(downloader):
                     input("未关注任何用户！")
                     continue
                 
-                for u in users:
-                    print(f"\n▶ 正在下载 {u.user.name} 的作品...", end="\n", flush=True)
-                    downloader.download_user_illusts(u.user.id, u.user.name)
+                downloader.sync_following(users)
                 input("\n操作完成，按回车返回...")
             except Exception as e:
                 print(f"发生错误: {str(e)}")
@@ -2210,9 +3672,7 @@ def handle_following(downloader):
                     input("无效的选择！")
                     continue
                 
-                for u in selected:
-                    print(f"\n▶ 正在下载 {u.user.name} 的作品...", end="\n", flush=True)
-                    downloader.download_user_illusts(u.user.id, u.user.name)
+                downloader.sync_following(selected)
                 input("\n下载完成，按回车返回...")
                 
             except Exception as e:
@@ -2678,11 +4138,55 @@ def execute_ranking_download(downloader, args):
 
 
 # 新增函数：处理命令行接口
-def handle_command_line():
-    """增强的命令行处理"""
+def build_global_parser():
+    """可出现在子命令前后的全局选项"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--quiet', action='store_true', help='只输出汇总与错误')
+    parser.add_argument('--json-log', action='store_true', help='每行输出一个JSON对象，便于无人值守运行时采集')
+    parser.add_argument('--metrics-file', help='运行结束后写入指标文件（.prom为Prometheus文本格式，其余为JSON）')
+    parser.add_argument('--record', help='将本次会话的HTTP流量录制到gzip JSONL归档（供 benchmark.py --replay 回放）')
+    parser.add_argument('--record-bodies', action='store_true', help='录制时同时保存图片响应体')
+    parser.add_argument('--profile', action='store_true', help='剖析本次运行，输出pstats文件与分阶段报告')
+    parser.add_argument('--profile-mode', choices=['cprofile', 'tracemalloc'], default='cprofile',
+                        help='剖析方式：cprofile统计函数耗时，tracemalloc统计内存分配（默认cprofile）')
+    return parser
+
+def parse_global_options(argv):
+    """解析全局选项，返回 (选项, 剩余参数)"""
+    return build_global_parser().parse_known_args(argv)
+
+def start_run(downloader, options):
+    """按全局选项启用本次运行的附加功能（会话录制等）"""
+    if options.record:
+        downloader.start_recording(options.record, include_bodies=options.record_bodies)
+
+def finish_run(downloader, options):
+    """运行结束：落盘剩余批次、停止录制并输出运行指标"""
+    downloader.durability.flush()
+    downloader.stop_recording()
+    downloader.report_metrics(options.metrics_file)
+
+def create_downloader():
+    """按config.py配置创建下载器"""
+    return PixivDownloader(
+        refresh_token=REFRESH_TOKEN,
+        user_id=USER_ID,
+        root_dir=download_dir,
+        proxies=PROXY,
+        exclude_manga=EXCLUDE_MANGA,
+        exclude_tags=EXCLUDE_TAGS,
+        ranking_max=RANKING_MAX_ITEMS,
+        follow_max=FOLLOW_MAX_ITEMS,
+        request_interval=REQUEST_INTERVAL,
+        output_format=OUTPUT_FORMAT,
+        quality=QUALITY
+    )
+
+def build_command_parser():
+    """子命令解析器（命令行与批量任务共用）"""
     parser = argparse.ArgumentParser(
-        description="Pixiv批量下载器命令行模式",
-        add_help=False
+        description="Pixiv批量下载器命令行模式（不带参数运行进入交互菜单）",
+        parents=[build_global_parser()]
     )
     
     subparsers = parser.add_subparsers(dest='command', help='可用命令')
@@ -2699,47 +4203,379 @@ def handle_command_line():
     
     follow_parser = subparsers.add_parser('follow', help='下载关注新作品')
 
-    args = parser.parse_args()
+    batch_parser = subparsers.add_parser('batch', help='在同一进程内执行任务文件中的全部任务')
+    batch_parser.add_argument('task_file', help='任务文件（manager.py 生成的 ranking_tasks.json）')
+    batch_parser.add_argument('--workers', type=int, default=TASK_WORKERS, help='同时运行的任务数（0为全部同时运行）')
 
-    downloader = PixivDownloader(
-        refresh_token=REFRESH_TOKEN,
-        user_id=USER_ID,
-        root_dir=download_dir,
-        proxies=PROXY,
-        exclude_manga=EXCLUDE_MANGA,
-        exclude_tags=EXCLUDE_TAGS,
-        ranking_max=RANKING_MAX_ITEMS,
-        follow_max=FOLLOW_MAX_ITEMS,
-        request_interval=REQUEST_INTERVAL,
-        output_format=OUTPUT_FORMAT,
-        quality=QUALITY
-    )
+    subparsers.add_parser('clean-temp', help='遍历整个下载目录清理残留临时文件（启动时只清理登记过的目录）')
+
+    convert_parser = subparsers.add_parser('convert-worker', help='处理格式转换队列（可中断，下次运行继续）')
+    convert_parser.add_argument('--workers', type=int, default=CONVERT_WORKERS, help='转换进程数（0为CPU核数减一）')
+    reconvert_parser = subparsers.add_parser('reconvert-all', help='按当前格式与质量配置重新转换全部已下载图片')
+    reconvert_parser.add_argument('--workers', type=int, default=CONVERT_WORKERS, help='转换进程数（0为CPU核数减一）')
+
+    layout_parser = subparsers.add_parser('migrate-layout', help='把收藏与搜索目录迁移为按作品ID分片的布局')
+    layout_parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='每个分片目录容纳的作品ID跨度')
+    layout_parser.add_argument('--flat', action='store_true', help='还原为不分片的平铺布局')
+
+    # 本地查询：只读数据库，不认证、不加载网络与图像库
+    subparsers.add_parser('cache', help='查看缓存统计')
+    subparsers.add_parser('progress', help='查看未完成的下载进度')
+    return parser
+
+def run_task(downloader, args):
+    """执行单个下载子命令，返回是否成功"""
+    try:
+        if args.command == 'ranking':
+            execute_ranking_download(downloader, args)
+        elif args.command == 'follow':
+            downloader.download_following_new()
+        return True
+    except SystemExit as e:
+        return not e.code
+    except Exception as e:
+        print(f"任务执行异常: {str(e)}")
+        return False
+
+def load_batch_tasks(task_file):
+    """读取任务文件，返回 [(任务名, 子命令参数)]（忽略命令中的程序路径部分）"""
+    with open(task_file, 'rb') as f:
+        tasks = json.loads(f.read().decode('utf-8'))
+    parsed = []
+    for task in tasks:
+        command = task.get('command') or []
+        idx = next((i for i, part in enumerate(command) if part in ('ranking', 'follow')), None)
+        if idx is None:
+            print(f"跳过无法识别的任务: {task.get('name')}")
+            continue
+        name = task.get('name') or command[idx]
+        if task.get('category'):
+            name = f"{task['category']} {name}"  # 不同分类的同名榜单需区分
+        parsed.append((name, command[idx:]))
+    return parsed
+
+def execute_batch(downloader, task_file, parser, workers=None):
+    """复用同一下载器（认证、HTTP连接、数据库与线程池）并发执行全部任务
+
+    各任务共享下载器的API限速与图片下载并发配额，单个任务失败不影响其余任务
+    """
+    try:
+        tasks = load_batch_tasks(task_file)
+    except (OSError, ValueError) as e:
+        print(f"任务文件读取失败: {str(e)}")
+        return False
+    if not tasks:
+        print("没有可执行的任务")
+        return True
+
+    workers = workers if workers is not None else TASK_WORKERS
+    workers = min(workers, len(tasks)) if workers > 0 else len(tasks)
+    print(f"\n▶ 批量执行 {len(tasks)} 个任务（{workers} 并发）")
+    downloader.set_task_concurrency(workers)
+    if workers > 1:
+        console.prefix_tasks()
+
+    def run(name, argv):
+        with console.task(name):
+            print(f"开始执行，参数: {' '.join(argv)}")
+            started = time.monotonic()
+            try:
+                args = parser.parse_args(argv)
+            except SystemExit:
+                args = None
+            ok = args is not None and run_task(downloader, args)
+            return ok, time.monotonic() - started
+
+    results = {}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, name, argv): idx for idx, (name, argv) in enumerate(tasks)}
+        pending = set(futures)
+        while pending:
+            try:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                print("\n用户中断，等待进行中的任务保存进度...")
+                downloader.stop_event.set()
+                for future in pending:
+                    future.cancel()
+                continue
+            for future in done:
+                if future.cancelled():
+                    continue
+                idx = futures[future]
+                name = tasks[idx][0]
+                ok, seconds = future.result()
+                results[idx] = (ok, seconds)
+                console.event('task', f"任务 {name} {'完成' if ok else '失败'}，耗时 {seconds:.1f} 秒",
+                              task=name, ok=ok, seconds=round(seconds, 3))
+
+    print(f"\n{'━'*30}")
+    for idx, (name, _) in enumerate(tasks):
+        ok, seconds = results.get(idx, (None, 0))
+        status = '未执行' if ok is None else ('成功' if ok else '失败')
+        print(f"{status}  {seconds:7.1f}s  {name}")
+    succeeded = sum(1 for ok, _ in results.values() if ok)
+    print(f"批量任务完成: 成功 {succeeded} / 共 {len(tasks)}，总耗时 {time.monotonic() - started:.1f} 秒")
+    return succeeded == len(tasks)
+
+def run_query(command):
+    """本地数据库查询命令"""
+    db = DBCache(root_dir=download_dir)
+    if command == 'cache':
+        print(f"缓存记录数: {db.get_cache_count()}")
+        counts = db.get_conversion_counts()
+        if counts:
+            print(f"转换队列: 待处理 {counts.get('pending', 0) + counts.get('running', 0)}，"
+                  f"失败 {counts.get('failed', 0)}")
+    elif command == 'progress':
+        progress_list = db.get_all_progress()
+        if not progress_list:
+            print("暂无进行中的下载任务")
+        for idx, progress in enumerate(progress_list, 1):
+            timestamp = str(progress['updated_at']).split('.')[0]
+            print(f"{idx}. [用户ID: {progress['user_id']}] 最后更新时间: {timestamp}")
+
+def run_convert_worker(workers=0, root_dir=download_dir):
+    """处理格式转换队列，直到队列中没有可领取的任务
+
+    编码在低优先级子进程中进行；主进程负责落盘、在事务中改写缓存路径并删除原图。
+    随时中断后再次运行即可继续：处理中的任务回到队列，已完成的任务补做原图清理
+    """
+    target = resolve_output_format(OUTPUT_FORMAT)
+    if target is None:
+        print("OUTPUT_FORMAT 为 original，无需转换")
+        return True
+    workers = workers or CONVERT_WORKERS or max(1, (os.cpu_count() or 2) - 1)
+    metrics = Metrics()
+    durability = Durability(DURABILITY, DURABILITY_BATCH_FILES, DURABILITY_BATCH_SECONDS, metrics)
+    db = DBCache(root_dir=root_dir, metrics=metrics, durability=durability)
+
+    def settle(done):
+        """删除已被取代的原图，落盘后再移除对应任务"""
+        for original, output in done:
+            if output and output != original:
+                try:
+                    durability.remove(original)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"删除原文件失败: {str(e)}", end="\n", flush=True)
+        durability.flush()
+        db.remove_conversions([original for original, _ in done])
+
+    settle(db.recover_conversions())
+    temp_dirs = set()
+    converted = failed = 0
+    print(f"开始处理转换队列（{workers} 个进程）")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_lower_priority) as pool:
+        while True:
+            batch = db.claim_conversions(workers * 4)
+            if not batch:
+                break
+            futures = {}
+            for original in batch:
+                output = converted_path(original, target)
+                temp_path = f"{output}.tmp"
+                directory = os.path.dirname(os.path.abspath(temp_path))
+                if directory not in temp_dirs:
+                    temp_dirs.add(directory)
+                    db.register_temp_dir(directory)
+                future = pool.submit(_timed_render, original, temp_path, target, QUALITY)
+                futures[future] = (original, output, temp_path)
+
+            done = []
+            for future in as_completed(futures):
+                original, output, temp_path = futures[future]
+                try:
+                    metrics.observe('conversion', future.result())
+                    durability.commit(temp_path, output)
+                    db.complete_conversion(original, output)
+                    done.append((original, output))
+                    converted += 1
+                    console.detail(f"转换成功: {os.path.basename(output)}")
+                except Exception as e:
+                    failed += 1
+                    print(f"转换失败 {os.path.basename(original)}: {str(e)}", end="\n", flush=True)
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    if os.path.exists(original):
+                        db.fail_conversion(original, str(e))
+                    else:
+                        db.remove_conversions([original])  # 原图已不存在，任务作废
+            settle(done)
+
+    counts = db.get_conversion_counts()
+    print(f"转换队列处理完成：成功 {converted}，失败 {failed}，"
+          f"剩余 {counts.get('pending', 0)}，放弃 {counts.get('failed', 0)}")
+    if converted or failed:
+        print("\n" + "\n".join(metrics.summary_lines()))
+    return failed == 0
+
+def reconvert_library(workers=0, root_dir=download_dir):
+    """按当前 OUTPUT_FORMAT / QUALITY 重新转换整个图库"""
+    if resolve_output_format(OUTPUT_FORMAT) is None:
+        print("OUTPUT_FORMAT 为 original，无需转换")
+        return True
+    db = DBCache(root_dir=root_dir)
+    count = db.enqueue_library_conversions()
+    print(f"已将 {count} 个文件加入转换队列（原图转换后不保留，已有的有损格式会再次压缩）")
+    return run_convert_worker(workers, root_dir)
+
+def _plan_layout(base_dir, shard_size):
+    """列出目录内作品文件在两种布局下的路径，返回 [(旧路径, 新路径, 是否需要移动)]
+
+    已在目标位置的文件也会列出，以便中断后重跑时补写数据库路径
+    """
+    plan = []
+    if not os.path.isdir(base_dir):
+        return plan
+    with os.scandir(base_dir) as entries:
+        top = list(entries)
+    for entry in top:
+        if entry.is_dir() and entry.name.isdigit():
+            with os.scandir(entry.path) as shard_entries:
+                files = [(e.name, e.path) for e in shard_entries if e.is_file()]
+        elif entry.is_file():
+            files = [(entry.name, entry.path)]
+        else:
+            continue
+        for name, path in files:
+            match = re.match(r'(\d+)[_.]', name)
+            if not match or name.endswith('.tmp'):
+                continue
+            flat_path = os.path.join(base_dir, name)
+            if shard_size:
+                new = os.path.join(base_dir, shard_name(match.group(1), shard_size), name)
+            else:
+                new = flat_path
+            # 已在目标位置的文件，数据库中可能仍是迁移前的平铺路径
+            old = path if path != new else flat_path
+            if old != new:
+                plan.append((old, new, path != new))
+    return plan
+
+def migrate_layout(shard_size, root_dir=download_dir):
+    """把收藏与搜索目录迁移到分片布局（shard_size为0时还原为平铺）
+
+    数据库中的 file_path 在同一事务内改写，文件移动失败时回滚事务并移回已移动的文件
+    """
+    search_root = os.path.join(root_dir, "search")
+    bases = [os.path.join(root_dir, "bookmarks")]
+    if os.path.isdir(search_root):
+        with os.scandir(search_root) as entries:
+            bases.extend(entry.path for entry in entries if entry.is_dir())
+
+    plan = []
+    for base in bases:
+        plan.extend(_plan_layout(base, shard_size))
+    moves = []
+    for old, new, move in plan:
+        if move and os.path.exists(new):
+            print(f"目标文件已存在，跳过: {new}")
+            continue
+        moves.append((old, new, move))
+    if not any(move for _, _, move in moves):
+        print("文件布局已是目标布局，无需移动")
+
+    db = DBCache(root_dir=root_dir)
+    moved = []
+    try:
+        with db._get_connection() as conn:
+            before = conn.total_changes
+            conn.executemany('''
+                UPDATE illust_cache SET file_path = ?, updated_at = datetime('now', 'localtime')
+                WHERE file_path = ?
+            ''', [(new, old) for old, new, _ in moves])
+            rewritten = conn.total_changes - before
+            # 转换队列中的原图与已完成任务的输出路径一并改写
+            pairs = [(new, old) for old, new, _ in moves]
+            conn.executemany('''
+                UPDATE convert_queue SET file_path = ?, updated_at = datetime('now', 'localtime')
+                WHERE file_path = ?
+            ''', pairs)
+            conn.executemany('UPDATE convert_queue SET output_path = ? WHERE output_path = ?', pairs)
+            for old, new, move in moves:
+                if move:
+                    os.makedirs(os.path.dirname(new), exist_ok=True)
+                    os.replace(old, new)
+                    moved.append((old, new))
+            # 提交前让目录项落盘，避免数据库指向尚未持久化的新位置
+            for directory in {os.path.dirname(path) for pair in moved for path in pair}:
+                _fsync_path(directory, directory=True)
+    except Exception as e:
+        print(f"迁移失败，已回滚: {str(e)}")
+        for old, new in reversed(moved):
+            os.replace(new, old)
+        return False
+
+    if not shard_size:
+        for base in bases:
+            _remove_empty_shards(base)
+    print(f"迁移完成：移动 {len(moved)} 个文件，更新 {rewritten} 条缓存记录")
+    print(f"请在config.py中设置 SHARDED_LAYOUT = {bool(shard_size)}" +
+          (f"，SHARD_SIZE = {shard_size}" if shard_size else ""))
+    return True
+
+def handle_command_line(argv, options):
+    """增强的命令行处理"""
+    parser = build_command_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+    if args.command in ('cache', 'progress'):
+        run_query(args.command)
+        return
+    if args.command in ('convert-worker', 'reconvert-all'):
+        run = run_convert_worker if args.command == 'convert-worker' else reconvert_library
+        if not run(args.workers):
+            sys.exit(1)
+        return
+    if args.command == 'migrate-layout':
+        if not migrate_layout(0 if args.flat else args.shard_size):
+            sys.exit(1)
+        return
 
-    if args.command == 'ranking':
-        execute_ranking_download(downloader, args)
-    if args.command == 'follow':
-        downloader.download_following_new()
+    downloader = create_downloader()
+    start_run(downloader, options)
+    try:
+        if args.command == 'batch':
+            ok = execute_batch(downloader, args.task_file, parser, args.workers)
+        else:
+            ok = True
+            if args.command == 'ranking':
+                execute_ranking_download(downloader, args)
+            if args.command == 'follow':
+                downloader.download_following_new()
+            if args.command == 'clean-temp':
+                downloader.sweep_temp_files()
+    finally:
+        finish_run(downloader, options)
+    if not ok:
+        sys.exit(1)
 
 def main():
 
     # 先处理命令行参数
-    if len(sys.argv) > 1:
-        handle_command_line()
-        return
-      
-    downloader = PixivDownloader(
-        refresh_token=REFRESH_TOKEN,
-        user_id=USER_ID,
-        root_dir=download_dir,
-        proxies=PROXY,
-        exclude_manga=EXCLUDE_MANGA,
-        exclude_tags=EXCLUDE_TAGS,
-        ranking_max=RANKING_MAX_ITEMS,
-        follow_max=FOLLOW_MAX_ITEMS,
-        request_interval=REQUEST_INTERVAL,
-        output_format=OUTPUT_FORMAT,
-        quality=QUALITY
-    )
+    options, argv = parse_global_options(sys.argv[1:])
+    console.configure(quiet=options.quiet, json_log=options.json_log)
+    profiler = Profiler(options.profile_mode) if options.profile else None
+    if profiler:
+        profiler.start()
+    try:
+        if argv:
+            handle_command_line(argv, options)
+        else:
+            run_interactive(options)
+    finally:
+        if profiler:
+            profiler.stop()
+
+def run_interactive(options):
+    """交互菜单模式"""
+    downloader = create_downloader()
+    start_run(downloader, options)
     
     while True:
         display_main_menu()
@@ -2759,12 +4595,15 @@ def main():
         elif choice == '6':  # 新增进度管理
             handle_progress(downloader)
         elif choice == '0':
+            finish_run(downloader, options)
             print("感谢使用，再见！")
             break
         else:
             input("无效输入，请重新选择！")
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # 打包后 convert-worker 的子进程需要
     try:
         main()
     except Exception as e:
@@ -6,6 +6,9 @@ import os
 import sys
 import json
 import subprocess
+import time
+import sqlite3
+import datetime
 from typing import List, Dict
 import importlib.util
 
@@ -52,6 +55,13 @@ def resolve_exe_path():
 
 EXE_PATH, IS_PYTHON_SCRIPT = resolve_exe_path()
 TASK_FILE = os.path.join(DOWNLOAD_DIR, "ranking_tasks.json")  # 任务配置文件
+DAEMON_TASK_FILE = os.path.join(DOWNLOAD_DIR, "daemon_tasks.json")  # 定时调度本轮到期的任务
+DB_PATH = os.path.join(DOWNLOAD_DIR, "pixiv_cache.db")
+RANKING_DELAY_MINUTES = getattr(config, 'RANKING_DELAY_MINUTES', 30)
+FOLLOW_SYNC_MINUTES = getattr(config, 'FOLLOW_SYNC_MINUTES', 60)
+DAEMON_RETRY_MINUTES = getattr(config, 'DAEMON_RETRY_MINUTES', 30)
+DAEMON_MAX_RETRIES = getattr(config, 'DAEMON_MAX_RETRIES', 3)
+JST = datetime.timezone(datetime.timedelta(hours=9))
 ENCODINGS = ['utf-8', 'gbk', 'cp936']
 
 # === 编码环境初始化 ================================================
@@ -100,19 +110,23 @@ class RankingManager:
             print(f"配置保存失败: {str(e)}")
             return False
 
+    def _base_command(self):
+        """下载器启动命令前缀（EXE或 Python + 脚本）"""
+        if IS_PYTHON_SCRIPT:
+            if not os.path.isfile(PYTHON_PATH):
+                print(f"错误: Python解释器不存在于 {PYTHON_PATH}")
+                return None
+            return [PYTHON_PATH, EXE_PATH]
+        return [EXE_PATH]
+
     def add_task(self, mode: str, category: str, name: str):
         if any(t.get('mode') == mode for t in self.tasks):
             print(f"任务 {name} 已存在")
             return False
 
-        base_cmd = []
-        if IS_PYTHON_SCRIPT:
-            if not os.path.isfile(PYTHON_PATH):
-                print(f"错误: Python解释器不存在于 {PYTHON_PATH}")
-                return False
-            base_cmd = [PYTHON_PATH, EXE_PATH]
-        else:
-            base_cmd = [EXE_PATH]
+        base_cmd = self._base_command()
+        if base_cmd is None:
+            return False
 
         new_task = {
             "mode": mode,
@@ -133,14 +147,9 @@ class RankingManager:
             print(f"任务已存在")
             return False
 
-        base_cmd = []
-        if IS_PYTHON_SCRIPT:
-            if not os.path.isfile(PYTHON_PATH):
-                print(f"错误: Python解释器不存在于 {PYTHON_PATH}")
-                return False
-            base_cmd = [PYTHON_PATH, EXE_PATH]
-        else:
-            base_cmd = [EXE_PATH]
+        base_cmd = self._base_command()
+        if base_cmd is None:
+            return False
 
         new_task = {
             "name": 'follow',
@@ -159,24 +168,34 @@ class RankingManager:
             return self.save_tasks()
         return False
 
-    def execute_task(self, task: Dict):
+    def execute_batch(self, task_file=TASK_FILE, name='全部任务'):
+        """在单个下载进程内执行任务文件中的任务（共享认证、连接、缓存与线程池）"""
+        base_cmd = self._base_command()
+        if base_cmd is None:
+            return False
+        return self._run_process(name, base_cmd + ['batch', task_file])
+
+    def _run_process(self, name: str, command: List[str]):
         print(f"\n{'━'*30}")
-        print(f"执行任务: {task['name']}")
-        print(f"命令: {' '.join(task['command'])}")
+        print(f"执行任务: {name}")
+        print(f"命令: {' '.join(command)}")
         print(f"{'━'*30}")
 
+        started = time.monotonic()
         try:
             env = os.environ.copy()
-            env["PYTHONUNBUFFERED"] = "1"
+            # 子进程自行按行缓冲输出；PYTHONUNBUFFERED会使其退回逐次写入
+            env.pop("PYTHONUNBUFFERED", None)
             env["PYTHONIOENCODING"] = "utf-8"
             
             process = subprocess.Popen(
-                task["command"],
+                command,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
                 text=True,
                 encoding='utf-8',
-                errors='replace'
+                errors='replace',
+                env=env
             )
 
             while True:
@@ -186,15 +205,116 @@ class RankingManager:
                 if line:
                     print(line.strip())
 
+            elapsed = time.monotonic() - started
             if process.returncode != 0:
-                print(f"任务执行失败，退出码: {process.returncode}")
+                print(f"任务执行失败，退出码: {process.returncode}，耗时 {elapsed:.1f} 秒")
                 return False
+            print(f"任务执行完成，耗时 {elapsed:.1f} 秒")
             return True
 
         except Exception as e:
             print(f"执行异常: {str(e)}")
             return False
 
+# === 定时调度 =======================================================
+def current_ranking_date(now):
+    """当前可下载的榜单日期（JST中午前为前一天，与download.py一致）"""
+    return now.date() - datetime.timedelta(days=1) if now.hour < 12 else now.date()
+
+def next_ranking_trigger(now):
+    """下一次榜单更新（JST中午）后的触发时间"""
+    trigger = now.replace(hour=12, minute=0, second=0, microsecond=0) \
+        + datetime.timedelta(minutes=RANKING_DELAY_MINUTES)
+    if trigger <= now:
+        trigger += datetime.timedelta(days=1)
+    return trigger
+
+def ranking_task_key(task: Dict, now):
+    """与download.py中排行榜进度记录相同的任务标识"""
+    return f"ranking_{task['category']}_{task['mode']}_{current_ranking_date(now)}"
+
+def is_ranking_complete(task: Dict, now):
+    """目标日期的榜单是否已完整下载（读取下载器数据库中的完成标记）"""
+    if not os.path.exists(DB_PATH):
+        return False
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            row = conn.execute('SELECT 1 FROM task_completion WHERE task_key = ?',
+                               (ranking_task_key(task, now),)).fetchone()
+        finally:
+            conn.close()
+        return row is not None
+    except sqlite3.Error:
+        return False  # 旧版数据库尚无完成标记表
+
+def initial_due(task: Dict, now):
+    """启动时的首次触发时间：排行榜在更新后的延迟期内等待到触发时间，其余立即检查"""
+    if "ranking" in task["command"]:
+        trigger = next_ranking_trigger(now)
+        if trigger.date() == now.date() and now.hour >= 12:
+            return trigger
+    return now
+
+def run_daemon(manager: RankingManager):
+    """常驻调度：按各任务的触发时间休眠，到期任务合并为一次批量执行"""
+    if not manager.tasks:
+        print("没有可执行的任务")
+        return
+
+    now = datetime.datetime.now(JST)
+    schedule = [[initial_due(task, now), task] for task in manager.tasks]
+    attempts = {}  # 排行榜任务标识 -> 当日已执行次数
+    print(f"定时调度已启动：{len(schedule)} 个任务，榜单更新后 {RANKING_DELAY_MINUTES} 分钟下载排行榜，"
+          f"每 {FOLLOW_SYNC_MINUTES} 分钟同步关注新作品")
+
+    while True:
+        now = datetime.datetime.now(JST)
+        next_due = min(due for due, _ in schedule)
+        if next_due > now:
+            print(f"下一次触发: {next_due.strftime('%Y-%m-%d %H:%M')} (JST)")
+            try:
+                time.sleep((next_due - now).total_seconds())
+            except KeyboardInterrupt:
+                print("\n定时调度已停止")
+                return
+            continue
+
+        # 所有已到期的触发合并为一轮；执行期间新到期的触发在下一轮合并执行
+        batch = []
+        for entry in schedule:
+            due, task = entry
+            if due > now:
+                continue
+            if "ranking" in task["command"] and is_ranking_complete(task, now):
+                print(f"[{task['category']}] {task['name']} {current_ranking_date(now)} 已完成，跳过")
+                entry[0] = next_ranking_trigger(now)
+                continue
+            batch.append(entry)
+        if not batch:
+            continue
+
+        with open(DAEMON_TASK_FILE, 'wb') as f:
+            f.write(json.dumps([task for _, task in batch], ensure_ascii=False, indent=2).encode('utf-8'))
+        manager.execute_batch(DAEMON_TASK_FILE, f"定时任务 ({len(batch)} 个)")
+
+        finished = datetime.datetime.now(JST)
+        for entry in batch:
+            task = entry[1]
+            if "ranking" not in task["command"]:
+                entry[0] = finished + datetime.timedelta(minutes=FOLLOW_SYNC_MINUTES)
+                continue
+            key = ranking_task_key(task, finished)
+            attempts[key] = attempts.get(key, 0) + 1
+            if is_ranking_complete(task, finished):
+                entry[0] = next_ranking_trigger(finished)
+            elif attempts[key] > DAEMON_MAX_RETRIES:
+                print(f"[{task['category']}] {task['name']} {current_ranking_date(finished)} "
+                      f"已重试 {DAEMON_MAX_RETRIES} 次仍未完成，等待下一次榜单更新")
+                entry[0] = next_ranking_trigger(finished)
+            else:
+                entry[0] = finished + datetime.timedelta(minutes=DAEMON_RETRY_MINUTES)
+
 # === 命令行接口 =====================================================
 def main_menu(manager: RankingManager):
     while True:
@@ -305,6 +425,9 @@ def remove_task_menu(manager: RankingManager):
 
 def list_tasks(manager: RankingManager):
     clear_screen()
+    print_tasks(manager)
+
+def print_tasks(manager: RankingManager):
     if not manager.tasks:
         print("当前没有配置任务")
         return
@@ -333,10 +456,10 @@ def execute_all_tasks(manager: RankingManager):
     if input("\n确认执行? (y/n): ").lower() != 'y':
         return
 
-    for task in manager.tasks:
-        if not manager.execute_task(task):
-            print(f"任务 {task['name']} 执行失败，停止后续任务")
-            break
+    if not manager.save_tasks():
+        return
+    if not manager.execute_batch():
+        print("存在执行失败的任务")
 
 def change_exe_path():
     global EXE_PATH, IS_PYTHON_SCRIPT
@@ -353,4 +476,13 @@ if __name__ == "__main__":
         sys.exit(1)
 
     manager = RankingManager()
-    main_menu(manager)
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'daemon':
+        run_daemon(manager)
+    elif command == 'list':
+        print_tasks(manager)
+    elif command is None:
+        main_menu(manager)
+    else:
+        print("用法: manager.py [daemon | list]")
+        sys.exit(2)
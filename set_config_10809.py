@@ -41,6 +41,57 @@ RANKING_MAX_ITEMS = 100      # 榜单最大下载数量
 FOLLOW_MAX_ITEMS = 100      # 关注最大下载数量
 REQUEST_INTERVAL = 2         # 请求间隔(秒)
 
+# API响应缓存
+API_CACHE_ENABLED = True     # 是否缓存列表接口响应
+API_CACHE_MAX_MB = 200       # 缓存目录大小上限(MB)，超出按最近最少使用淘汰
+API_CACHE_TTL = {{}}           # 按接口覆盖缓存时间(秒)，None为永久，如 {{'search_illust': 600}}
+
+# 关注增量同步
+FOLLOW_INCREMENTAL = True    # 按画师水位线增量同步，遇到已同步的作品即停止翻页
+FOLLOW_FULL_SYNC_DAYS = 30   # 每隔多少天对画师做一次全量扫描（捕获作品修改）
+
+# 并发配置
+ARTIST_WORKERS = 4           # "下载全部关注"时同时同步的画师数
+DOWNLOAD_WORKERS = 8         # 全局同时进行的图片下载数
+API_MIN_INTERVAL = 1.0       # 全局API请求最小间隔(秒)，所有线程共享
+SEARCH_WORKERS = 3           # 搜索下载时并发处理的时间窗口数
+TASK_WORKERS = 0             # 批量执行任务（manager.py）时同时运行的任务数，0为全部同时运行；各任务共享上面的下载与API限速配额
+
+# 输出配置
+PROGRESS_REFRESH_HZ = 4      # 终端下载进度每秒最多刷新次数（多个下载合并显示）
+
+# 运行指标
+METRICS_FILE = ''            # 运行结束后写入的指标文件，.prom结尾为Prometheus textfile格式，其余为JSON；留空不写入
+
+# 定时任务（manager.py daemon）
+RANKING_DELAY_MINUTES = 30   # JST中午榜单更新后延迟多少分钟开始下载排行榜任务
+FOLLOW_SYNC_MINUTES = 60     # 关注新作品任务的同步间隔(分钟)
+DAEMON_RETRY_MINUTES = 30    # 排行榜未能完整下载时的重试间隔(分钟)
+DAEMON_MAX_RETRIES = 3       # 同一日期排行榜最多重试次数，超过后等待下一次榜单更新
+
+# 网络连接
+HTTP_POOL_SIZE = {{}}          # 按主机覆盖连接池大小，如 {{'i.pximg.net': 16}}；默认按上面的并发配置计算
+HTTP_RETRIES = 3             # 连接失败与429/5xx响应由连接层自动重试的次数
+HTTP_BACKOFF = 1.0           # 自动重试的指数退避基数(秒)，重试间隔依次翻倍
+
+# 带宽与连接限制
+BANDWIDTH_LIMIT_KBPS = 0     # 全局下载带宽上限(KB/s)，所有并发下载共享，0为不限
+BANDWIDTH_SCHEDULE = []      # 按时段覆盖带宽上限（本地时间，可跨零点），如 [('08:00', '23:00', 2048)] 表示白天限速2MB/s、夜间按上一项
+HOST_CONNECTION_LIMITS = {{}}  # 每个主机同时占用的连接上限，如 {{'i.pximg.net': 4}}，超出时等待空闲连接
+
+# 落盘策略
+DURABILITY = 'batch'         # none: 不主动fsync；batch: 按批次fsync文件、目录与数据库WAL；strict: 每个文件都fsync
+DURABILITY_BATCH_FILES = 50  # batch模式下每累计多少个文件落盘一次
+DURABILITY_BATCH_SECONDS = 10  # batch模式下距上次落盘超过多少秒即落盘
+
+# 目录布局
+SHARDED_LAYOUT = False       # 收藏与搜索结果按作品ID分片存放（如 bookmarks/12345/），已有文件用 download.py migrate-layout 迁移
+SHARD_SIZE = 10000           # 每个分片目录容纳的作品ID跨度
+
+# 后台格式转换
+CONVERT_QUEUE = False        # True时下载只保存原图并加入转换队列，由 download.py convert-worker 在空闲时转换
+CONVERT_WORKERS = 0          # convert-worker 使用的进程数，0为CPU核数减一
+
 # API响应调试
 DEBUG_API_RESPONSE = False 
 '''